@@ -0,0 +1,152 @@
+"""
+Game actions requested by players
+
+A request carries a batch of actions which are applied through the
+session's GameEngine in one go, so the whole batch is written with a
+single commit or not at all. The reply only describes what the batch
+changed, see state_delta.
+
+Actions are dicts with an "action" key:
+
+    {"action": "draw", "from": deck id, "to": deck id, "count": 1}
+    {"action": "play", "from": deck id, "to": deck id, "index": 0,
+        "top": true}
+    {"action": "shuffle", "deck": deck id}
+    {"action": "end_phase"}
+
+Players may take cards from and shuffle their own decks and the decks of
+the session, and put cards into any deck of the session.
+"""
+from controller.delta import describe_decks, revision
+
+
+class ActionError(ValueError):
+    """
+    Raised for an action that is malformed or not allowed
+    """
+
+
+def _deck(engine, action, key):
+    """
+    @return: id of the session deck named by action[key]
+    """
+    try:
+        deck_id = int(action[key])
+    except (KeyError, TypeError, ValueError):
+        raise ActionError("%s needs a deck id in %s" % (action["action"], key))
+    if deck_id not in engine.decks:
+        raise ActionError("Deck %d is not part of this game" % deck_id)
+    return deck_id
+
+
+def _own_deck(engine, player, action, key):
+    """
+    @return: id of a deck the player may take cards from
+    """
+    deck_id = _deck(engine, action, key)
+    if engine.decks[deck_id].user_id not in (player.id, engine.session.id):
+        raise ActionError("Deck %d belongs to another player" % deck_id)
+    return deck_id
+
+
+def _count(action):
+    """
+    @return: number of cards action asks for, a non-negative int
+    """
+    count = action.get("count", 1)
+    if isinstance(count, bool) or not isinstance(count, (int, long)) or \
+            count < 0:
+        raise ActionError("%s needs a count of 0 or more cards" %
+                action["action"])
+    return count
+
+
+def _draw(engine, player, action):
+    from_id = _own_deck(engine, player, action, "from")
+    to_id = _deck(engine, action, "to")
+    count = _count(action)
+    try:
+        engine.draw_cards(from_id, to_id, num_cards=count)
+    except IndexError, error:
+        raise ActionError(str(error))
+    return [from_id, to_id]
+
+
+def _play(engine, player, action):
+    from_id = _own_deck(engine, player, action, "from")
+    to_id = _deck(engine, action, "to")
+    try:
+        engine.play_card(from_id, to_id, index=int(action.get("index", 0)),
+                top=bool(action.get("top", True)))
+    except IndexError, error:
+        raise ActionError(str(error))
+    return [from_id, to_id]
+
+
+def _shuffle(engine, player, action):
+    deck_id = _own_deck(engine, player, action, "deck")
+    engine.shuffle(deck_id)
+    return [deck_id]
+
+
+def _end_phase(engine, player, action):
+    if engine.current_player_id() != player.id:
+        raise ActionError("It is not your turn")
+    engine.next_phase()
+    return []
+
+
+ACTIONS = {
+        "draw": _draw,
+        "play": _play,
+        "shuffle": _shuffle,
+        "end_phase": _end_phase,
+        }
+
+
+def apply_actions(engine, player, actions):
+    """
+    Apply a batch of actions atomically
+
+    @param engine: GameEngine of the session
+    @param player: Player making the request
+    @param actions: list of action dicts
+    @return: state delta of everything the batch touched
+    @raise ActionError: if any action fails, nothing is applied
+    """
+    if not isinstance(actions, list):
+        raise ActionError("actions must be a list")
+    touched = set()
+    with engine:
+        for action in actions:
+            if not isinstance(action, dict):
+                raise ActionError("Every action must be an object")
+            handler = ACTIONS.get(action.get("action"))
+            if handler is None:
+                raise ActionError("Unknown action %r" % action.get("action"))
+            touched.update(handler(engine, player, action))
+    return state_delta(engine, player, touched)
+
+
+def state_delta(engine, player, deck_ids):
+    """
+    Describe the session and the given decks as the player may see them,
+    see controller.delta.describe_decks
+
+    @param engine: GameEngine of the session
+    @param player: Player the delta is for
+    @param deck_ids: ids of the decks to describe
+    @return: dict ready to be serialized to JSON
+    """
+    decks = [ engine.decks[deck_id] for deck_id in deck_ids ]
+    orders = dict([ (deck_id, engine.card_ids(deck_id))
+            for deck_id in deck_ids ])
+    lengths = dict([ (deck_id, len(order))
+            for deck_id, order in orders.items() ])
+    return {
+            "revision": revision(engine.session),
+            "turn": engine.turn,
+            "phase": engine.phase,
+            "player": engine.current_player_id(),
+            "decks": describe_decks(decks, orders, lengths, player),
+            }
@@ -0,0 +1,166 @@
+"""
+Compute what changed in a session since a revision
+
+The revision of a session is the seq of the last GameEvent it logged. Seqs
+are numbered per session and commit in order, so a client never sees a
+revision before every event up to it is readable. A client sends the
+revision it last saw and gets back only the decks and seats touched by
+the events logged since, read straight from the event log instead of by
+comparing full states. The reads grow with the number of changed decks,
+not with the size of the game.
+"""
+from django.db.models import Count
+from game.models.card import Card, CardDefinition
+from game.models.deck import Deck
+from game.models.session import Session
+
+
+# Position in the event args of the deck ids each move touches
+DECK_ARGS = {
+        "fill": (0,),
+        "insert_card": (0,),
+        "remove_card": (0,),
+        "transfer": (0, 1),
+        "shuffle": (0,),
+        }
+SESSION_ACTIONS = ("next_turn", "next_phase", "add_phase")
+PLAYER_ACTIONS = (
+        "add_player", "remove_player", "shuffle_players", "swap_players")
+
+
+def revision(session):
+    """
+    @param session: Session
+    @return: seq of the last event logged by the session, 0 if none
+    """
+    last = session.events.order_by("-seq").values_list("seq", flat=True)[:1]
+    return last[0] if last else 0
+
+
+def shown(deck, player_id):
+    """
+    @param deck: Deck
+    @param player_id: id of the Player looking at it
+    @return: "all" if the player sees every card of the deck, "top" if
+        only its top card and None if only its size
+    """
+    if deck.user_id == player_id or deck.show_prop == "all":
+        return "all"
+    if deck.show_prop == "top":
+        return "top"
+    return None
+
+
+def describe_decks(decks, orders, lengths, player):
+    """
+    Describe decks as a player may see them: every card of their own
+    decks and of decks shown to all, the top card of decks that show it
+    and only the size of the rest
+
+    @param decks: list of Deck objects
+    @param orders: dict of deck id to card ids in order, needed for the
+        decks the player can see into
+    @param lengths: dict of deck id to number of cards
+    @param player: Player the description is for
+    @return: dict of deck id to deck description
+    """
+    visible = {}
+    for deck in decks:
+        view = shown(deck, player.id)
+        if view == "all":
+            visible[deck.id] = orders[deck.id]
+        elif view == "top":
+            visible[deck.id] = orders[deck.id][:1]
+    card_ids = set()
+    for order in visible.values():
+        card_ids.update(order)
+    definitions = {}
+    if card_ids:
+        definitions = dict(Card.objects.filter(
+                id__in=card_ids).values_list("id", "definition"))
+    names = dict([ (def_id, definition.name) for def_id, definition in
+            CardDefinition.get_cached(definitions.values()).items() ])
+    described = {}
+    for deck in decks:
+        described[deck.id] = {"name": deck.name, "length": lengths[deck.id]}
+        if deck.id in visible:
+            described[deck.id]["cards"] = [
+                    {"id": card_id, "name": names[definitions[card_id]]}
+                    for card_id in visible[deck.id] ]
+    return described
+
+
+def _sees_into(deck, player):
+    return shown(deck, player.id) is not None
+
+
+def changes_since(session, player, since=None):
+    """
+    Build the delta a player needs to catch up from a revision
+
+    @param session: Session
+    @param player: Player asking
+    @param since: revision the player last saw, None or 0 for everything
+    @return: dict with the new revision and, when they changed, the
+        session fields, the seating and the touched decks
+    """
+    if since:
+        events = list(session.events.filter(seq__gt=since).order_by("seq"))
+        if not events and since > revision(session):
+            # A revision from before seqs, or of another database
+            return changes_since(session, player)
+        deck_ids = set()
+        session_changed = players_changed = False
+        for event in events:
+            for index in DECK_ARGS.get(event.action, ()):
+                deck_ids.add(event.args[index])
+            session_changed = (session_changed or
+                    event.action in SESSION_ACTIONS)
+            players_changed = (players_changed or
+                    event.action in PLAYER_ACTIONS)
+        current = events[-1].seq if events else since
+        decks = list(Deck.objects.filter(id__in=deck_ids))
+    else:
+        session_changed = players_changed = True
+        current = revision(session)
+        owners = [session.id] + list(
+                session.players.values_list("id", flat=True))
+        decks = list(Deck.objects.filter(user__in=owners))
+    delta = {"revision": current}
+    if session_changed or players_changed:
+        # Read the session after its events so it is at least as new as
+        # the revision handed out
+        session = Session.objects.get(id=session.id)
+    if session_changed:
+        delta["session"] = {
+                "turn": session.turn,
+                "phase": session.phase,
+                "phase_list": session.phase_list,
+                }
+    if players_changed:
+        players = session.players.select_related("user__user").in_bulk(
+                [ player_id for player_id in session._player_list
+                    if player_id ])
+        delta["players"] = [ player_id and {
+                "id": player_id,
+                "name": players[player_id].user.user.username,
+                } for player_id in session._player_list ]
+    if decks:
+        orders = dict([ (deck.id, []) for deck in decks
+                if _sees_into(deck, player) ])
+        if orders:
+            rows = Card.objects.filter(deck__in=orders.keys()).order_by(
+                    "position").values_list("deck", "id")
+            for deck_id, card_id in rows:
+                orders[deck_id].append(card_id)
+        lengths = dict([ (deck_id, len(order))
+                for deck_id, order in orders.items() ])
+        hidden = [ deck.id for deck in decks if deck.id not in orders ]
+        if hidden:
+            lengths.update([ (row["deck"], row["cnt"]) for row in
+                    Card.objects.filter(deck__in=hidden).values(
+                        "deck").annotate(cnt=Count("id")).order_by() ])
+        for deck in decks:
+            lengths.setdefault(deck.id, 0)
+        delta["decks"] = describe_decks(decks, orders, lengths, player)
+    return delta
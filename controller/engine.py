@@ -0,0 +1,402 @@
+"""
+In-memory game state engine
+
+Session and Deck write to the database on nearly every call. GameEngine
+loads a live session once, applies moves against in-memory card orders
+(see controller.order) and writes whatever changed back in a single
+transaction, either at turn boundaries or once a configurable interval
+has passed. Moves are queued
+for the session's event log and inserted with the same flush.
+
+The database always holds the state as of the last successful flush.
+A flush is atomic across the session row and every deck, so a crash or
+failed flush loses the moves made since the previous flush but never
+leaves a half written turn behind.
+
+A flush only writes if the session version and the revision of every
+deck it changes are still the ones read by load. If a player joined or a
+deck was moved by anyone else in the meantime the batch is rejected and
+the engine reloaded, instead of writing back orders and seats that no
+longer exist.
+"""
+from django.conf import settings
+from controller.order import DeckOrder
+from game.models.card import Card
+from game.models.deck import Deck, DeckConflict, claim_revisions, \
+        write_positions
+from game.models.event import GameEvent, CHECKPOINT_INTERVAL, \
+        logging_transaction
+from game.models.session import SeatConflict, Session
+from game.replay import checkpoint
+import random
+import threading
+import time
+
+
+# Seconds between flushes, None only flushes at turn boundaries
+FLUSH_INTERVAL = getattr(settings, "GAME_ENGINE_FLUSH_INTERVAL", None)
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(session, **kwargs):
+    """
+    Return the live engine of a session, creating it if needed. Only for
+    a process that owns the session for as long as the engine lives, a
+    shared engine does not see seats or decks added by anyone else until
+    a flush conflicts, requests load a GameEngine of their own instead.
+
+    @param session: Session to drive
+    @return: GameEngine shared by every caller in this process
+    """
+    with _engines_lock:
+        engine = _engines.get(session.id)
+        if engine is None:
+            engine = GameEngine(session, **kwargs)
+            _engines[session.id] = engine
+        return engine
+
+
+def release_engine(session):
+    """
+    Flush and drop the live engine of a session
+
+    @param session: Session whose engine should be released
+    """
+    with _engines_lock:
+        engine = _engines.pop(session.id, None)
+    if engine is not None:
+        engine.flush()
+
+
+def _deck_id(deck):
+    """
+    Accept either a Deck or its id
+    """
+    return getattr(deck, "id", deck)
+
+
+class GameEngine(object):
+    """
+    Hold a session's turn, phase, seating and deck order in memory
+
+    Use as a context manager to apply a group of moves atomically, the
+    moves are flushed together on a clean exit, never part way through,
+    and discarded if an exception is raised. Nested blocks join the
+    outermost one, which alone flushes or discards the moves.
+    """
+
+    def __init__(self, session, **kwargs):
+        """
+        @param session: Session to load
+        @param flush_interval: seconds between flushes
+            (default GAME_ENGINE_FLUSH_INTERVAL setting)
+        @param flush_on_turn: flush when the turn advances (default True)
+        @param seed: seed of the session's random number generator, the
+            seed of every shuffle is drawn from it (default random)
+        @param rng: random number generator used to draw shuffle seeds,
+            overrides seed
+        """
+        self.session = session
+        self.flush_interval = kwargs.get("flush_interval", FLUSH_INTERVAL)
+        self.flush_on_turn = kwargs.get("flush_on_turn", True)
+        self.rng = kwargs.get("rng") or random.Random(kwargs.get("seed"))
+        self._lock = threading.RLock()
+        self._batch = 0
+        self.load()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._batch = self._batch + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._batch = self._batch - 1
+            if self._batch:
+                return
+            if exc_type is None:
+                self.flush()
+            else:
+                self.rollback()
+        finally:
+            self._lock.release()
+
+    def load(self):
+        """
+        Load the session state, dropping any change not yet flushed
+        """
+        with self._lock:
+            session = self.session
+            self.turn = session.turn
+            self.phase = session.phase
+            self.phase_list = list(session.phase_list)
+            self.player_list = list(session._player_list)
+            owners = [session.id] + list(
+                    session.players.values_list("id", flat=True))
+            # Revisions are read before the orders, so a move made in
+            # between is caught by the flush rather than overwritten
+            self.decks = dict([ (deck.id, deck) for deck in
+                    Deck.objects.no_cache().filter(user__in=owners) ])
+            self.revisions = dict([ (deck_id, deck.revision)
+                    for deck_id, deck in self.decks.items() ])
+            orders = dict([ (deck_id, []) for deck_id in self.decks ])
+            rows = Card.objects.filter(
+                    deck__in=self.decks.keys()).order_by(
+                    "position").values_list("deck", "id")
+            for deck_id, card_id in rows:
+                orders[deck_id].append(card_id)
+            self.orders = dict([ (deck_id, DeckOrder(order))
+                    for deck_id, order in orders.items() ])
+            self._dirty_session = False
+            self._dirty_decks = set()
+            self._events = []
+            self._last_flush = time.time()
+            self._since_checkpoint = 0
+
+    def rollback(self):
+        """
+        Return to the state of the last flush
+        """
+        with self._lock:
+            self.session = Session.objects.get(id=self.session.id)
+            self.load()
+
+    @property
+    def dirty(self):
+        """
+        Return True if there are moves not yet written to the database
+        """
+        return self._dirty_session or bool(self._dirty_decks)
+
+    def flush(self):
+        """
+        Write every changed session field and deck order in one
+        transaction, conditional on the session version and on the
+        revisions of the changed decks. On a conflict the batch is
+        dropped and the engine reloaded before the error is raised.
+
+        @raise SeatConflict: if the session changed since it was loaded
+        @raise DeckConflict: if a changed deck moved since it was loaded
+        """
+        with self._lock:
+            if self.dirty:
+                try:
+                    self._write()
+                except (DeckConflict, SeatConflict):
+                    self.rollback()
+                    raise
+                for deck_id in self._dirty_decks:
+                    deck = self.decks[deck_id]
+                    self.revisions[deck_id] = self.revisions[deck_id] + 1
+                    deck.revision = self.revisions[deck_id]
+                    deck._reset_order()
+                    deck._order = list(self.orders[deck_id])
+                    deck._positions = dict([ (card_id, position)
+                            for position, card_id in enumerate(deck._order) ])
+                self._dirty_session = False
+                self._dirty_decks = set()
+                self._events = []
+            self._last_flush = time.time()
+
+    def _write(self):
+        with logging_transaction(using=self.session._state.db):
+            claim_revisions(dict([ (deck_id, self.revisions[deck_id])
+                    for deck_id in self._dirty_decks ]),
+                    using=self.session._state.db)
+            if self._dirty_session:
+                session = self.session
+                session.turn = self.turn
+                session.phase = self.phase
+                session.phase_list = list(self.phase_list)
+
+                def reseat(seats):
+                    seats[:] = self.player_list
+                # Marks the seats as changed, so save raises SeatConflict
+                # if the version moved since load
+                session._change_seats(reseat, save=False)
+                session.save()
+            for deck_id in self._dirty_decks:
+                deck = self.decks[deck_id]
+                order = self.orders[deck_id]
+                write_positions(
+                        [ (card_id, position)
+                            for position, card_id in enumerate(order) ],
+                        deck=deck, using=deck._state.db)
+                deck._invalidate_cards(order)
+            GameEvent.log_many(self.session.id, self._events,
+                    using=self.session._state.db)
+            self._since_checkpoint += len(self._events)
+            if self._since_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoint(self.session)
+                self._since_checkpoint = 0
+
+    def _log(self, action, *args):
+        """
+        Queue a move for the event log, queued moves are inserted with
+        one bulk_create when the engine flushes
+        """
+        self._events.append(GameEvent(
+                session_id=self.session.id, action=action, args=list(args)))
+
+    def _changed(self, *deck_ids, **kwargs):
+        """
+        Mark state dirty and flush if a turn ended or the interval passed
+
+        @param turn_ended: True if the move advanced the turn
+        """
+        if deck_ids:
+            self._dirty_decks.update(deck_ids)
+        else:
+            self._dirty_session = True
+        if self._batch:
+            return
+        if kwargs.get("turn_ended") and self.flush_on_turn:
+            self.flush()
+        elif (self.flush_interval is not None and
+                time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def card_ids(self, deck):
+        """
+        @param deck: Deck or deck id
+        @return: list of card ids in deck order
+        """
+        return list(self.orders[_deck_id(deck)])
+
+    def draw_cards(self, from_deck, to_deck, **kwargs):
+        """
+        Move cards from the top of one deck to the top of another, in
+        the same order as DeckUser.draw_cards
+
+        @param num_cards: number of cards to draw (default 1)
+        @param all: draw every card in from_deck
+        """
+        with self._lock:
+            from_id = _deck_id(from_deck)
+            to_id = _deck_id(to_deck)
+            from_order = self.orders[from_id]
+            if kwargs.get("all"):
+                num_cards = len(from_order)
+            else:
+                num_cards = kwargs.get("num_cards", 1)
+            to_order = self.orders[to_id]
+            card_ids = from_order.take_top(num_cards)
+            for card_id in card_ids:
+                to_order.push_top(card_id)
+            self._log("transfer", from_id, to_id, num_cards, card_ids)
+            self._changed(from_id, to_id)
+
+    def play_card(self, from_deck, to_deck, **kwargs):
+        """
+        Move a single card between decks, in the same order as
+        Deck.remove_card followed by Deck.insert_card
+
+        @param index: index of the card in from_deck (default 0, the top)
+        @param top: put the card on top of to_deck, False for the bottom
+            (default True)
+        @return: id of the moved card
+        """
+        with self._lock:
+            from_id = _deck_id(from_deck)
+            to_id = _deck_id(to_deck)
+            from_order = self.orders[from_id]
+            index = kwargs.get("index", 0)
+            if not -len(from_order) <= index < len(from_order):
+                raise IndexError("No card at index %d" % index)
+            card_id = from_order.pop(index)
+            to_order = self.orders[to_id]
+            to_index = 0 if kwargs.get("top", True) else len(to_order)
+            to_order.insert(to_index, card_id)
+            self._log("remove_card", from_id, index, card_id)
+            self._log("insert_card", to_id, card_id, to_index)
+            self._changed(from_id, to_id)
+            return card_id
+
+    def shuffle(self, deck, seed=None):
+        """
+        Shuffle deck order
+
+        @param deck: Deck or deck id
+        @param seed: seed of the shuffle (default drawn from rng)
+        """
+        with self._lock:
+            deck_id = _deck_id(deck)
+            if seed is None:
+                seed = self.rng.getrandbits(32)
+            self.orders[deck_id].shuffle(seed)
+            self._log("shuffle", deck_id, seed, True)
+            self._changed(deck_id)
+
+    def next_turn(self):
+        """
+        Advance the gameplay to the next turn
+        """
+        with self._lock:
+            self.turn = self.turn + 1
+            self._log("next_turn")
+            self._changed(turn_ended=True)
+
+    def next_phase(self):
+        """
+        Advance the gameplay to the next phase
+        """
+        with self._lock:
+            self.phase = self.phase + 1
+            self._log("next_phase")
+            if self.phase >= len(self.phase_list):
+                self.phase = 0
+                self.turn = self.turn + 1
+                self._changed(turn_ended=True)
+            else:
+                self._changed()
+
+    def current_phase(self):
+        """
+        Return the current phase
+        """
+        return self.phase_list[self.phase]
+
+    def current_player_id(self):
+        """
+        Return the id of the current player
+        """
+        return self.player_list[self.turn % len(self.player_list)]
+
+    def add_phase(self, phase_name):
+        """
+        Add a phase to the phase list
+
+        @param phase_name: Name of the phase to add
+        """
+        with self._lock:
+            self.phase_list.append(phase_name)
+            self._log("add_phase", phase_name)
+            self._changed()
+
+    def shuffle_players(self, seed=None):
+        """
+        Shuffle player order
+
+        @param seed: seed of the shuffle (default drawn from rng)
+        """
+        with self._lock:
+            if seed is None:
+                seed = self.rng.getrandbits(32)
+            random.Random(seed).shuffle(self.player_list)
+            self._log("shuffle_players", seed)
+            self._changed()
+
+    def swap_players(self, player_a, player_b):
+        """
+        Swap two players around
+
+        @param player_a: index of player to swap
+        @param player_b: index of player to swap
+        """
+        with self._lock:
+            self.player_list[player_a], self.player_list[player_b] = (
+                    self.player_list[player_b], self.player_list[player_a])
+            self._log("swap_players", player_a, player_b)
+            self._changed()
@@ -0,0 +1,215 @@
+"""
+Card order of a deck held by GameEngine
+
+DeckOrder keeps the card ids bottom first, so the top of the deck is the
+end of a list: drawing from or putting on the top is a list pop or append.
+Cards taken from the bottom only move a start offset forward and the list
+is compacted once half of it is unused, cards put at the bottom fill the
+free slots in front of the start, so both ends cost O(1) amortized.
+
+Shuffles are lazy. After shuffle(seed) the cards stay where they are and
+are only marked unsettled; every draw from the top settles just the card
+it takes with one step of a Fisher-Yates shuffle. A shuffle followed by k
+draws therefore costs O(k) instead of O(n). The steps are the ones
+game.models.deck.shuffle_order takes, so the deck always ends in the same
+order as the eager shuffle the event log replays. Anything that needs
+the cards in the middle of an unsettled stretch, like reading the whole
+order or drawing from the bottom right after a shuffle, settles the rest
+first.
+"""
+import random
+
+
+# Free slots added in front of the list when a card is put at the bottom
+MIN_SLACK = 16
+
+
+class DeckOrder(object):
+    """
+    Card ids of one deck, see the module documentation
+    """
+
+    def __init__(self, card_ids=()):
+        """
+        @param card_ids: card ids top first
+        """
+        self._items = list(card_ids)
+        self._items.reverse()
+        self._start = 0
+        # Unsettled stretch of _items, from _low to _high inclusive
+        self._low = self._high = None
+        self._rng = None
+
+    def __len__(self):
+        return len(self._items) - self._start
+
+    def __iter__(self):
+        """
+        Iterate over the card ids top first
+        """
+        self.settle()
+        for index in xrange(len(self._items) - 1, self._start - 1, -1):
+            yield self._items[index]
+
+    def __repr__(self):
+        return "DeckOrder(%r)" % list(self)
+
+    @property
+    def shuffling(self):
+        """
+        True while some cards are not settled yet
+        """
+        return self._rng is not None
+
+    def _step(self):
+        """
+        Settle the top card of the unsettled stretch
+        """
+        items, low, high = self._items, self._low, self._high
+        index = high - int(self._rng.random() * (high - low + 1))
+        items[high], items[index] = items[index], items[high]
+        self._high = high - 1
+        if self._high <= low:
+            self._low = self._high = self._rng = None
+
+    def settle(self):
+        """
+        Settle every card, after which the list is in its final order
+        """
+        while self._rng is not None:
+            self._step()
+
+    def shuffle(self, seed):
+        """
+        Shuffle lazily, in the order shuffle_order gives for seed
+
+        @param seed: seed of the shuffle
+        """
+        self.settle()
+        if len(self) < 2:
+            return
+        self._low, self._high = self._start, len(self._items) - 1
+        self._rng = random.Random(seed)
+
+    def push_top(self, card_id):
+        """
+        Put a card on top of the deck
+        """
+        self._items.append(card_id)
+
+    def push_bottom(self, card_id):
+        """
+        Put a card at the bottom of the deck
+        """
+        if not self._start:
+            slack = max(MIN_SLACK, len(self))
+            self._items[0:0] = [None] * slack
+            self._start = slack
+            if self._rng is not None:
+                self._low = self._low + slack
+                self._high = self._high + slack
+        self._start = self._start - 1
+        self._items[self._start] = card_id
+
+    def pop_top(self):
+        """
+        Take the top card
+
+        @return: card id
+        @raise IndexError: if the deck is empty
+        """
+        items = self._items
+        if len(items) == self._start:
+            raise IndexError("Cannot draw from an empty deck")
+        if self._rng is not None and self._high == len(items) - 1:
+            self._step()
+        return items.pop()
+
+    def pop_bottom(self):
+        """
+        Take the bottom card
+
+        @return: card id
+        @raise IndexError: if the deck is empty
+        """
+        items, start = self._items, self._start
+        if len(items) == start:
+            raise IndexError("Cannot draw from an empty deck")
+        if self._rng is not None and self._low == start:
+            self.settle()
+        card_id = items[start]
+        items[start] = None
+        self._start = start = start + 1
+        if start > MIN_SLACK and start * 2 > len(items):
+            self._compact()
+        return card_id
+
+    def _compact(self):
+        """
+        Drop the free slots in front of the start
+        """
+        del self._items[:self._start]
+        if self._rng is not None:
+            self._low = self._low - self._start
+            self._high = self._high - self._start
+        self._start = 0
+
+    def _position(self, index):
+        """
+        @return: position in _items of the card at top first index
+        """
+        if index < 0:
+            index = len(self) + index
+        if not 0 <= index < len(self):
+            raise IndexError("No card at index %d" % index)
+        return len(self._items) - 1 - index
+
+    def pop(self, index=0):
+        """
+        Take the card at a top first index, only the top and the bottom
+        are O(1)
+
+        @return: card id
+        """
+        if index == 0:
+            return self.pop_top()
+        if index == -1 or index == len(self) - 1:
+            return self.pop_bottom()
+        position = self._position(index)
+        self.settle()
+        return self._items.pop(position)
+
+    def insert(self, index, card_id):
+        """
+        Put a card at a top first index, like list.insert
+        """
+        if index < 0:
+            index = max(len(self) + index, 0)
+        if index == 0:
+            return self.push_top(card_id)
+        if index >= len(self):
+            return self.push_bottom(card_id)
+        self.settle()
+        self._items.insert(len(self._items) - index, card_id)
+
+    def take_top(self, num_cards):
+        """
+        Take cards from the top
+
+        @return: list of card ids in the order they were drawn
+        """
+        if num_cards > len(self):
+            raise IndexError(
+                    "Cannot move %d cards from a deck of %d" %
+                    (num_cards, len(self)))
+        return [ self.pop_top() for cnt in xrange(num_cards) ]
+
+    def top(self, num_cards=1):
+        """
+        @return: list of the top card ids, top first, without taking them
+        """
+        num_cards = min(num_cards, len(self))
+        while (self._rng is not None and
+                self._high >= len(self._items) - num_cards):
+            self._step()
+        return self._items[len(self._items) - num_cards:][::-1]
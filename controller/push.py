@@ -0,0 +1,278 @@
+"""
+Fan game events out to the players connected to a session
+
+The events of every committed transaction are published together, as one
+message on the channel of their session, if anybody listens to it. Each
+player is sent them as that player may see them when reading the channel
+(see player_events): shuffle seeds are never sent and card ids only where
+the player can see the card. Connected clients wait on the channel
+(long-poll or server-sent events, see game.views.session_events) instead
+of polling the Session and Deck tables, so waiting costs no queries at
+all.
+
+The default LocalBroker keeps channels in process memory, which works for
+a single server process. Set GAME_PUSH_BROKER to the dotted path of a
+class with the same interface to share channels between processes.
+"""
+from collections import deque
+from django.conf import settings
+from django.utils.importlib import import_module
+from controller.delta import DECK_ARGS, shown
+from game.models.deck import Deck
+from game.models.event import events_logged
+import threading
+import time
+
+
+# Messages kept per channel for clients catching up after a reconnect
+BACKLOG = getattr(settings, "GAME_PUSH_BACKLOG", 256)
+
+# Longest a long-poll request waits for a message, in seconds
+TIMEOUT = getattr(settings, "GAME_PUSH_TIMEOUT", 25)
+
+# Longest an event stream stays open before the client has to reconnect
+STREAM_TIME = getattr(settings, "GAME_PUSH_STREAM_TIME", 300)
+
+# Seconds a channel outlives its last listener, so long-poll clients
+# between two requests still get what was published meanwhile
+IDLE_TIME = getattr(settings, "GAME_PUSH_IDLE_TIME", 60)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class _Channel(object):
+    """
+    Numbered messages of a single channel
+    """
+
+    def __init__(self, backlog):
+        self.seq = 0
+        self.messages = deque(maxlen=backlog)
+        self.condition = threading.Condition()
+        # Listeners waiting now and when the last one left
+        self.listeners = 0
+        self.idle_since = time.time()
+
+    def since(self, seq):
+        """
+        @return: list of (seq, message) published after seq, or None if
+            some of them already fell out of the backlog or seq is from
+            before the channel was created
+        """
+        if seq > self.seq:
+            return None
+        if self.messages and seq < self.messages[0][0] - 1:
+            return None
+        if not self.messages and seq < self.seq:
+            return None
+        return [ item for item in self.messages if item[0] > seq ]
+
+
+class LocalBroker(object):
+    """
+    In-process publish/subscribe broker, channels are named by
+    channel_name. A channel is created by its first listener, messages
+    published to a channel nobody listens to are dropped, and a channel
+    is dropped once it had no listener for idle_time seconds.
+    """
+
+    def __init__(self, backlog=BACKLOG, idle_time=IDLE_TIME):
+        self.backlog = backlog
+        self.idle_time = idle_time
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._swept = time.time()
+
+    def _sweep(self, now):
+        """
+        Drop the channels idle for longer than idle_time, at most once
+        per idle_time, called with _lock held
+        """
+        if now - self._swept < self.idle_time:
+            return
+        self._swept = now
+        for name, channel in self._channels.items():
+            if not channel.listeners and \
+                    now - channel.idle_since >= self.idle_time:
+                del self._channels[name]
+
+    def subscribed(self, name):
+        """
+        @return: True if a channel has listeners, or had within idle_time
+        """
+        with self._lock:
+            self._sweep(time.time())
+            return name in self._channels
+
+    def publish(self, name, message):
+        """
+        Append a message to a channel and wake its listeners
+
+        @param name: name of the channel
+        @param message: JSON serializable message
+        @return: sequence number of the message, None if the channel has
+            no listeners and the message was dropped
+        """
+        with self._lock:
+            self._sweep(time.time())
+            channel = self._channels.get(name)
+        if channel is None:
+            return None
+        with channel.condition:
+            channel.seq = channel.seq + 1
+            channel.messages.append((channel.seq, message))
+            channel.condition.notify_all()
+            return channel.seq
+
+    def last(self, name):
+        """
+        @return: sequence number of the last message of a channel, 0 if
+            nobody listens to it
+        """
+        with self._lock:
+            channel = self._channels.get(name)
+        return channel.seq if channel is not None else 0
+
+    def listen(self, name, since, timeout=None):
+        """
+        Subscribe to a channel and wait for messages published after since
+
+        @param name: name of the channel
+        @param since: last sequence number the listener has seen
+        @param timeout: seconds to wait for a message (default forever)
+        @return: list of (seq, message), empty on timeout, or None if the
+            listener missed messages and has to reload the whole state
+        """
+        with self._lock:
+            self._sweep(time.time())
+            channel = self._channels.get(name)
+            if channel is None:
+                channel = _Channel(self.backlog)
+                self._channels[name] = channel
+            channel.listeners = channel.listeners + 1
+        try:
+            with channel.condition:
+                if channel.seq <= since and timeout != 0:
+                    channel.condition.wait(timeout)
+                return channel.since(since)
+        finally:
+            with self._lock:
+                channel.listeners = channel.listeners - 1
+                channel.idle_since = time.time()
+
+    def close(self, name):
+        """
+        Drop a channel nobody listens to any more
+        """
+        with self._lock:
+            self._channels.pop(name, None)
+
+
+def get_broker():
+    """
+    @return: the broker shared by this process
+    """
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            path = getattr(settings, "GAME_PUSH_BROKER", None)
+            if path:
+                module, name = path.rsplit(".", 1)
+                _broker = getattr(import_module(module), name)()
+            else:
+                _broker = LocalBroker()
+        return _broker
+
+
+def channel_name(session_id):
+    """
+    @return: name of the channel of a session
+    """
+    return "session:%d" % session_id
+
+
+def _sees(decks, deck_id, index, player_id):
+    """
+    @return: True if the player sees the card at index of a deck
+    """
+    deck = decks.get(deck_id)
+    view = deck and shown(deck, player_id)
+    return view == "all" or (view == "top" and index == 0)
+
+
+def event_message(event, decks, player_id):
+    """
+    Describe an event as one player may see it, with the same visibility
+    as controller.delta.describe_decks. Seeds are left out and the ids of
+    cards the player does not see are replaced with None.
+
+    @param event: dict of the action and args of a published event
+    @param decks: dict of deck id to Deck, holding the decks of event
+    @param player_id: id of the Player the message is for
+    @return: JSON serializable message for the event
+    """
+    action = event["action"]
+    args = list(event["args"])
+    if action == "fill":
+        deck_id, card_ids = args
+        args = [deck_id, [ card_id if _sees(decks, deck_id, index, player_id)
+                else None for index, card_id in enumerate(card_ids) ]]
+    elif action == "insert_card":
+        deck_id, card_id, index = args
+        if not _sees(decks, deck_id, index, player_id):
+            args[1] = None
+    elif action == "remove_card":
+        deck_id, index = args[:2]
+        card_id = args[2] if len(args) > 2 else None
+        if not _sees(decks, deck_id, index, player_id):
+            card_id = None
+        args = [deck_id, index, card_id]
+    elif action == "transfer":
+        from_id, to_id, num_cards = args[:3]
+        card_ids = args[3] if len(args) > 3 else [None] * num_cards
+        # The first card drawn was on top of from_id, the last one ends
+        # up on top of to_id
+        args = [from_id, to_id, num_cards, [ card_id
+                if _sees(decks, from_id, cnt, player_id) or
+                    _sees(decks, to_id, num_cards - cnt - 1, player_id)
+                else None for cnt, card_id in enumerate(card_ids) ]]
+    elif action == "shuffle":
+        args = args[:1]
+    elif action == "shuffle_players":
+        args = []
+    return {"action": action, "args": args}
+
+
+def player_events(messages, player_id):
+    """
+    Read published messages as one player may see them, loading the
+    decks they move cards of with a single query
+
+    @param messages: list of (seq, events) returned by the broker
+    @param player_id: id of the Player reading them
+    @return: list of event messages, each with the seq it was published at
+    """
+    deck_ids = set()
+    for seq, events in messages:
+        for event in events:
+            for index in DECK_ARGS.get(event["action"], ()):
+                deck_ids.add(event["args"][index])
+    decks = Deck.objects.in_bulk(deck_ids) if deck_ids else {}
+    return [ dict(event_message(event, decks, player_id), seq=seq)
+            for seq, events in messages for event in events ]
+
+
+def publish_events(sender, session_id, events, **kwargs):
+    """
+    Publish the newly committed events of a session as one message, if
+    anybody listens to the session
+    """
+    broker = get_broker()
+    name = channel_name(session_id)
+    if not broker.subscribed(name):
+        return
+    broker.publish(name, [ {"action": event.action, "args": list(event.args)}
+            for event in events ])
+
+events_logged.connect(publish_events)
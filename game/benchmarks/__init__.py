@@ -0,0 +1,38 @@
+"""
+Performance benchmarks for the game models
+
+Every module in this package exposes run(sizes) returning a list of
+result dicts, each with at least the benchmark name, the size, the
+seconds taken and the operations per second. Run them with:
+manage.py benchmark <module> ...
+"""
+from django.db import connection
+import time
+
+
+def timed(func, *args, **kwargs):
+    """
+    Time a single call
+
+    @return: (seconds taken, return value of func)
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def counted(func, *args, **kwargs):
+    """
+    Time a single call and count the queries it runs
+
+    @return: (seconds taken, number of queries, return value of func)
+    """
+    debug = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    connection.queries = []
+    try:
+        seconds, result = timed(func, *args, **kwargs)
+        return seconds, len(connection.queries), result
+    finally:
+        connection.use_debug_cursor = debug
+        connection.queries = []
@@ -0,0 +1,41 @@
+"""
+CardCatalog.load_catalog benchmark
+"""
+from game.benchmarks import timed
+from game.models.card import CardCatalog
+import types
+
+
+SIZES = (10000, 50000)
+
+
+def card_module(size, tag=""):
+    """
+    Build a game module streaming size card definitions
+
+    @param tag: appended to every image path to force an update
+    """
+    module = types.ModuleType("bench_cards_%d" % size)
+    module.CARD_LIST = ({
+            "name": "Card %d" % cnt,
+            "image": "card_images/%d%s.png" % (cnt, tag),
+            } for cnt in xrange(size))
+    return module
+
+
+def run(sizes=SIZES):
+    """
+    Time a first load, an unchanged reload and a full update per size
+    """
+    results = []
+    for size in sizes:
+        catalog = CardCatalog.objects.create(name="Bench %d" % size)
+        for name, tag in [("load", ""), ("reload", ""), ("update", "-v2")]:
+            seconds, stats = timed(catalog.load_catalog, card_module(size, tag))
+            results.append({
+                    "benchmark": "catalog.%s" % name,
+                    "size": size,
+                    "seconds": seconds,
+                    "ops_per_sec": size / seconds if seconds else None,
+                    })
+    return results
@@ -0,0 +1,77 @@
+"""
+Engine card order benchmark, DeckOrder against the plain lists the engine
+used before: an eager random.shuffle and list.pop(0) draws
+"""
+from controller.order import DeckOrder
+from game.benchmarks import timed
+import random
+
+
+SIZES = (100, 10000)
+
+# Cards moved per size over all the rounds of a benchmark
+WORK = 200000
+
+
+def list_shuffle_draw(size, draws, rounds):
+    for cnt in xrange(rounds):
+        order = range(size)
+        random.Random(cnt).shuffle(order)
+        for draw in xrange(draws):
+            order.pop(0)
+
+
+def order_shuffle_draw(size, draws, rounds):
+    for cnt in xrange(rounds):
+        order = DeckOrder(xrange(size))
+        order.shuffle(cnt)
+        for draw in xrange(draws):
+            order.pop_top()
+
+
+def list_cycle(size, rounds):
+    order = range(size)
+    for cnt in xrange(rounds * size):
+        order.append(order.pop(0))
+
+
+def order_cycle(size, rounds):
+    order = DeckOrder(xrange(size))
+    for cnt in xrange(rounds * size):
+        order.push_bottom(order.pop_top())
+
+
+def run(sizes=SIZES):
+    """
+    Time, per size, shuffling and drawing a hand of 5, shuffling and
+    drawing every card, and cycling cards from the top to the bottom
+    """
+    results = []
+    for size in sizes:
+        rounds = max(1, WORK // size)
+        cases = [
+                ("draw5", rounds * 5,
+                    lambda impl: impl(size, min(5, size), rounds)),
+                ("draw_all", rounds * size,
+                    lambda impl: impl(size, size, rounds)),
+                ]
+        for name, moves, call in cases:
+            for label, impl in [("list", list_shuffle_draw),
+                    ("order", order_shuffle_draw)]:
+                seconds, ignored = timed(call, impl)
+                results.append(_result("deck.%s.%s" % (name, label),
+                        size, moves, seconds))
+        for label, impl in [("list", list_cycle), ("order", order_cycle)]:
+            seconds, ignored = timed(impl, size, rounds)
+            results.append(_result("deck.cycle.%s" % label,
+                    size, rounds * size, seconds))
+    return results
+
+
+def _result(name, size, moves, seconds):
+    return {
+            "benchmark": name,
+            "size": size,
+            "seconds": seconds,
+            "ops_per_sec": moves / seconds if seconds else None,
+            }
@@ -0,0 +1,87 @@
+"""
+Deck and Session hot path benchmark: Deck.insert_cards, remove_cards,
+shuffle, card_list and get_card slices, DeckUser.draw_cards,
+Session.add_player, next_phase and turns of the simulated game of
+game.simulator, with the number of queries per operation, per deck size
+"""
+from django.core.cache import cache
+from game.benchmarks import counted
+from game.models.deck import Deck
+from game.models.session import DeckUser, Session
+from game.simulator import create_cards, create_profiles, play_turn, \
+        setup_game, PLAYERS
+import random
+
+
+SIZES = (10, 100, 1000, 10000)
+
+# Cap on the cards moved one by one per size, so large decks stay quick
+MOVES = 200
+
+# Rounds of the operations which do not depend on the deck size
+ROUNDS = 20
+
+
+def fresh(deck):
+    """
+    @return: deck loaded again, with no card order or card cached
+    """
+    return Deck.objects.no_cache().get(id=deck.id)
+
+
+def run(sizes=SIZES):
+    """
+    Time each operation per deck size, see the module documentation
+    """
+    results = []
+    for size in sizes:
+        cache.clear()
+        label = "bench-%d" % size
+        session = Session.objects.create(name=label, max_players=PLAYERS)
+        deck = session.add_deck("deck")
+        hand = session.add_deck("hand")
+        cards = create_cards(size, label)
+        moves = min(size, MOVES)
+
+        def measure(name, ops, func, *args, **kwargs):
+            seconds, queries, result = counted(func, *args, **kwargs)
+            results.append(_result("hotpath.%s" % name, size, ops, seconds,
+                    queries))
+            return result
+
+        measure("insert_cards", size, deck.insert_cards, cards)
+        measure("card_list", ROUNDS, lambda: [ fresh(deck).card_list
+            for cnt in xrange(ROUNDS) ])
+        middle = size // 2
+        measure("get_card", ROUNDS * 2, lambda: [
+            (fresh(deck).get_card(0, 5), fresh(deck).get_card(middle,
+                middle + 5)) for cnt in xrange(ROUNDS) ])
+        deck = fresh(deck)
+        measure("shuffle", ROUNDS, lambda: [ deck.shuffle(seed=cnt)
+            for cnt in xrange(ROUNDS) ])
+        measure("draw_cards", moves, lambda: [
+            DeckUser.draw_cards(deck, hand) for cnt in xrange(moves) ])
+        measure("remove_cards", moves, hand.remove_cards, moves)
+        measure("next_phase", ROUNDS, lambda: [ session.next_phase()
+            for cnt in xrange(ROUNDS) ])
+        tables = [ Session.objects.create(name=label, max_players=PLAYERS)
+            for cnt in xrange(ROUNDS) ]
+        profiles = create_profiles(ROUNDS * PLAYERS, label)
+        measure("add_player", len(profiles), lambda: [
+            tables[cnt // PLAYERS].add_player(profile)
+            for cnt, profile in enumerate(profiles) ])
+        game = setup_game(size, label + "-game")
+        rng = random.Random(0)
+        measure("game_turn", ROUNDS * PLAYERS, lambda: [
+            play_turn(game, rng) for cnt in xrange(ROUNDS * PLAYERS) ])
+    return results
+
+
+def _result(name, size, ops, seconds, queries):
+    return {
+            "benchmark": name,
+            "size": size,
+            "seconds": seconds,
+            "ops_per_sec": ops / seconds if seconds else None,
+            "queries_per_op": float(queries) / ops,
+            }
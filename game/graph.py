@@ -0,0 +1,152 @@
+"""
+Read-only view of a whole game, loaded eagerly
+
+Walking Session -> player_list -> deck_list -> card_list costs a query per
+hop, per player and per deck. load_session fetches the whole graph with a
+fixed number of queries however many players, decks and cards there are:
+
+    1. the session
+    2. its players with their UserProfile and User
+    3. every deck owned by the session or one of its players
+    4. every card of those decks, in deck order
+    5. only if some are not in the process cache yet, card definitions
+
+The result is made of immutable views which templates and JSON
+serializers walk without touching the database. Views are a snapshot:
+moves made after loading do not show up, load the session again instead.
+"""
+from collections import namedtuple
+from game.models.card import Card, CardDefinition
+from game.models.deck import Deck
+from game.models.session import Session
+
+
+class CardView(namedtuple("CardView", "id name image definition_id")):
+    """
+    A card, image is the path of the card image
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "image": self.image}
+
+
+class DeckView(namedtuple("DeckView", "id name show_prop cards")):
+    """
+    A deck with its cards top first
+    """
+    __slots__ = ()
+
+    @property
+    def length(self):
+        return len(self.cards)
+
+    def to_dict(self):
+        return {
+                "id": self.id,
+                "name": self.name,
+                "show_prop": self.show_prop,
+                "cards": [ card.to_dict() for card in self.cards ],
+                }
+
+
+class _DeckUserView(object):
+    """
+    Deck access shared by players and sessions
+    """
+    __slots__ = ()
+
+    @property
+    def deck_list(self):
+        """
+        @return: dict of deck name to DeckView, like DeckUser.deck_list
+        """
+        return dict([ (deck.name, deck) for deck in self.decks ])
+
+
+class PlayerView(_DeckUserView, namedtuple("PlayerView",
+        "id seat username user_id decks")):
+    """
+    A seated player, user_id is the id of the UserProfile
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return {
+                "id": self.id,
+                "seat": self.seat,
+                "username": self.username,
+                "decks": [ deck.to_dict() for deck in self.decks ],
+                }
+
+
+class SessionView(_DeckUserView, namedtuple("SessionView",
+        "id name status turn phase phase_list max_players players decks")):
+    """
+    A session, players are in seat order with None for empty seats and
+    decks are the decks owned by the session itself
+    """
+    __slots__ = ()
+
+    @property
+    def current_phase(self):
+        return self.phase_list[self.phase] if self.phase_list else None
+
+    @property
+    def current_player(self):
+        if not self.players:
+            return None
+        return self.players[self.turn % len(self.players)]
+
+    def to_dict(self):
+        return {
+                "id": self.id,
+                "name": self.name,
+                "status": self.status,
+                "turn": self.turn,
+                "phase": self.phase,
+                "phase_list": list(self.phase_list),
+                "max_players": self.max_players,
+                "players": [ player and player.to_dict()
+                    for player in self.players ],
+                "decks": [ deck.to_dict() for deck in self.decks ],
+                }
+
+
+def load_session(session_id):
+    """
+    Load a whole session graph, see the module documentation
+
+    @param session_id: id of the Session
+    @return: SessionView
+    @raise Session.DoesNotExist: if there is no such session
+    """
+    session = Session.objects.get(id=session_id)
+    players = session.players.select_related("user__user").in_bulk(
+            [ player_id for player_id in session._player_list if player_id ])
+    owners = [session.id] + players.keys()
+    decks = list(Deck.objects.no_cache().filter(
+            user__in=owners).order_by("id"))
+    cards = dict([ (deck.id, []) for deck in decks ])
+    rows = list(Card.objects.filter(deck__in=cards.keys()).order_by(
+            "position").values_list("deck", "id", "definition"))
+    definitions = CardDefinition.get_cached([ row[2] for row in rows ])
+    for deck_id, card_id, def_id in rows:
+        definition = definitions[def_id]
+        cards[deck_id].append(CardView(
+                card_id, definition.name, definition.image.name, def_id))
+    owned = dict([ (owner, []) for owner in owners ])
+    for deck in decks:
+        owned[deck.user_id].append(DeckView(
+                deck.id, deck.name, deck.show_prop, tuple(cards[deck.id])))
+    seats = []
+    for seat, player_id in enumerate(session._player_list):
+        player = players.get(player_id) if player_id else None
+        if player is None:
+            seats.append(None)
+            continue
+        seats.append(PlayerView(player.id, seat, player.user.user.username,
+                player.user_id, tuple(owned[player.id])))
+    return SessionView(session.id, session.name, session.status,
+            session.turn, session.phase, tuple(session.phase_list),
+            session.max_players, tuple(seats), tuple(owned[session.id]))
@@ -0,0 +1,210 @@
+"""
+Opt-in query and latency instrumentation of the game model methods
+
+Once enabled, with the GAME_INSTRUMENT setting or enable() at run time,
+every method and property listed in METHODS records per call the number
+of queries it ran, the time they took in the database and its wall time.
+Calls are aggregated per method into histograms, exported in the
+Prometheus text format by game.views.method_stats_view.
+
+While disabled nothing is wrapped, the methods and database cursors are
+the plain ones and cost nothing extra. Nested calls are counted
+inclusively, e.g. draw_cards includes the queries of transfer_cards.
+"""
+from django.conf import settings
+from django.db.backends import BaseDatabaseWrapper
+from game.models.deck import Deck
+from game.models.session import DeckUser, Session
+import functools
+import threading
+import time
+
+
+# Instrumented methods and properties per model class
+METHODS = {
+        DeckUser: ("add_deck", "draw_cards", "deck_list"),
+        Session: ("next_turn", "next_phase", "current_phase",
+            "current_player", "add_phase", "add_player", "remove_player",
+            "shuffle_players", "swap_players", "invalidate_cache",
+            "snapshot", "restore", "num_players", "player_list"),
+        Deck: ("create_from_catalog", "insert_card", "insert_cards",
+            "get_card", "remove_card", "remove_cards", "play_card",
+            "transfer_cards", "shuffle", "card_list", "length"),
+        }
+
+# Upper bounds of the histogram buckets
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _bucket(bounds, value):
+    """
+    @return: index of the first bucket holding value, len(bounds) if none
+    """
+    for index, bound in enumerate(bounds):
+        if value <= bound:
+            return index
+    return len(bounds)
+
+
+class MethodStats(object):
+    """
+    Thread safe per method histograms of queries, database time and wall
+    time
+    """
+
+    HISTOGRAMS = (
+            ("queries", QUERY_BUCKETS),
+            ("db_seconds", TIME_BUCKETS),
+            ("seconds", TIME_BUCKETS),
+            )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, name, queries, db_seconds, seconds):
+        values = (queries, db_seconds, seconds)
+        with self._lock:
+            method = self._methods.get(name)
+            if method is None:
+                method = self._methods[name] = dict([ (histogram, {
+                        "buckets": [0] * (len(bounds) + 1), "sum": 0})
+                        for histogram, bounds in self.HISTOGRAMS ])
+                method["calls"] = 0
+            method["calls"] += 1
+            for (histogram, bounds), value in zip(self.HISTOGRAMS, values):
+                method[histogram]["buckets"][_bucket(bounds, value)] += 1
+                method[histogram]["sum"] += value
+
+    def snapshot(self):
+        """
+        @return: dict of method name to dict with the number of calls and,
+            per histogram, the sum and the count of calls per bucket (the
+            last one past every bound)
+        """
+        with self._lock:
+            return dict([ (name, dict([ (key, value if key == "calls" else
+                    {"sum": value["sum"], "buckets": list(value["buckets"])})
+                    for key, value in method.items() ]))
+                    for name, method in self._methods.items() ])
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+
+stats = MethodStats()
+
+
+class _Counters(threading.local):
+    """
+    Queries run and database time spent by the current thread
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+_counters = _Counters()
+
+
+class _CountingCursor(object):
+    """
+    Cursor adding every statement to the thread's counters
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _timed(self, method, args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            _counters.queries += 1
+            _counters.db_seconds += time.time() - start
+
+    def execute(self, *args):
+        return self._timed(self.cursor.execute, args)
+
+    def executemany(self, *args):
+        return self._timed(self.cursor.executemany, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def _timed(name, func):
+    """
+    Wrap func to record each call under name
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        queries, db_seconds = _counters.queries, _counters.db_seconds
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.record(name, _counters.queries - queries,
+                    _counters.db_seconds - db_seconds, time.time() - start)
+    return wrapper
+
+
+def _wrap(name, attr):
+    """
+    @return: attr, a function, classmethod or property, recording its
+        calls under name
+    """
+    if isinstance(attr, property):
+        return property(_timed(name, attr.fget), attr.fset, attr.fdel,
+                attr.__doc__)
+    if isinstance(attr, classmethod):
+        return classmethod(_timed(name, attr.__func__))
+    return _timed(name, attr)
+
+
+# (owner, attribute name, original attribute) of everything wrapped
+_originals = []
+_enable_lock = threading.Lock()
+
+
+def enabled():
+    """
+    @return: True while the model methods are instrumented
+    """
+    return bool(_originals)
+
+
+def enable():
+    """
+    Wrap the methods in METHODS and the database cursors
+    """
+    with _enable_lock:
+        if _originals:
+            return
+        for model, names in METHODS.items():
+            for name in names:
+                attr = model.__dict__[name]
+                _originals.append((model, name, attr))
+                setattr(model, name, _wrap(
+                        "%s.%s" % (model.__name__, name), attr))
+        cursor = BaseDatabaseWrapper.cursor
+        _originals.append((BaseDatabaseWrapper, "cursor", cursor))
+        BaseDatabaseWrapper.cursor = (
+                lambda self: _CountingCursor(cursor(self)))
+
+
+def disable():
+    """
+    Restore the plain methods and cursors, the statistics are kept
+    """
+    with _enable_lock:
+        while _originals:
+            owner, name, attr = _originals.pop()
+            setattr(owner, name, attr)
+
+if getattr(settings, "GAME_INSTRUMENT", False):
+    enable()
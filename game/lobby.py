@@ -0,0 +1,45 @@
+"""
+Lobby listing of the sessions players can join
+
+Pages are cut by session id rather than by offset: a client passes the
+last id it was shown as before and the next page starts right after it in
+the lobby index, so every page costs the same however deep the lobby is.
+Only plain columns are read, nothing is unpickled.
+"""
+from django.conf import settings
+from game.models.session import Session
+
+
+# Sessions per lobby page
+PAGE_SIZE = getattr(settings, "GAME_LOBBY_PAGE_SIZE", 25)
+
+# The primary key column, "id" would join the parent deckuser table
+FIELDS = ("deckuser_ptr", "name", "max_players", "seats_taken", "password")
+
+
+def open_sessions(game=None, **kwargs):
+    """
+    One page of the joinable sessions, newest first
+
+    @param game: GameInfo to list the sessions of (optional)
+    @param before: only list sessions older than this session id (optional)
+    @param limit: sessions per page (default GAME_LOBBY_PAGE_SIZE setting)
+    @return: (list of session dicts, id to pass as before for the next
+        page or None on the last page)
+    """
+    limit = kwargs.get("limit", PAGE_SIZE)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    sessions = Session.objects.joinable(game)
+    if kwargs.get("before") is not None:
+        sessions = sessions.filter(deckuser_ptr__lt=kwargs["before"])
+    rows = list(sessions.values(*FIELDS)[:limit + 1])
+    page = [ {
+            "id": row["deckuser_ptr"],
+            "name": row["name"],
+            "max_players": row["max_players"],
+            "open_seats": row["max_players"] - row["seats_taken"],
+            "locked": bool(row["password"]),
+            } for row in rows[:limit] ]
+    next_before = page[-1]["id"] if len(rows) > limit else None
+    return page, next_before
@@ -0,0 +1,97 @@
+"""
+Management command to run the game benchmarks
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.importlib import import_module
+import datetime
+import json
+import subprocess
+
+
+BENCHMARKS = ("catalog", "deck", "hotpath")
+
+
+def current_commit():
+    """
+    @return: hash of the checked out git commit, None outside a checkout
+    """
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Run benchmark modules from game.benchmarks against a throwaway test
+    database, optionally saving the results as JSON or comparing them with
+    results saved earlier
+    """
+
+    args = "<benchmark benchmark ...>"
+    help = ("Run game benchmarks (default: %s) against a throwaway test "
+            "database" % ", ".join(BENCHMARKS))
+
+    option_list = BaseCommand.option_list + (
+            make_option("--sizes", action="store", dest="sizes",
+                help="Comma separated sizes to benchmark"),
+            make_option("--output", action="store", dest="output",
+                help="Save the results as JSON to this file"),
+            make_option("--compare", action="store", dest="compare",
+                help="JSON results of an earlier run to compare with"),
+            )
+
+    def handle(self, *args, **options):
+        modules = [ import_module("game.benchmarks.%s" % name)
+                for name in (args or BENCHMARKS) ]
+        kwargs = {}
+        if options.get("sizes"):
+            kwargs["sizes"] = [ int(size)
+                    for size in options["sizes"].split(",") ]
+        baseline = {}
+        if options.get("compare"):
+            with open(options["compare"]) as stream:
+                baseline = dict([ ((result["benchmark"], result["size"]),
+                    result) for result in json.load(stream)["results"] ])
+        results = []
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for module in modules:
+                for result in module.run(**kwargs):
+                    results.append(result)
+                    self.stdout.write(self.format(result, baseline.get(
+                            (result["benchmark"], result["size"]))))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        if options.get("output"):
+            with open(options["output"], "w") as stream:
+                json.dump({
+                        "commit": current_commit(),
+                        "date": datetime.datetime.utcnow().isoformat(),
+                        "results": results,
+                        }, stream, indent=2, sort_keys=True)
+
+    def format(self, result, before=None):
+        """
+        @param before: result of the same benchmark in the baseline run
+        @return: line reporting result, and its change since before
+        """
+        line = "%-24s %8d %10.3fs" % (
+                result["benchmark"], result["size"], result["seconds"])
+        if result.get("ops_per_sec") is not None:
+            line = line + " %12.1f ops/s" % result["ops_per_sec"]
+        if result.get("queries_per_op") is not None:
+            line = line + " %8.2f queries/op" % result["queries_per_op"]
+        if before and before.get("ops_per_sec") and result.get("ops_per_sec"):
+            line = line + " %+7.1f%%" % (
+                    100.0 * result["ops_per_sec"] / before["ops_per_sec"] - 100)
+        if before and before.get("queries_per_op") is not None and \
+                result.get("queries_per_op") is not None:
+            line = line + " %+.2f queries/op" % (
+                    result["queries_per_op"] - before["queries_per_op"])
+        return line + "\n"
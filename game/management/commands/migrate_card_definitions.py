@@ -0,0 +1,137 @@
+"""
+Management command to move card names and images out of every Card row
+into shared CardDefinition rows
+"""
+from optparse import make_option
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from game.management.schema import drop_columns
+from game.models.card import Card, CardCatalog, CardDefinition, bulk_update
+
+
+LEGACY_COLUMNS = ("name", "image")
+
+# Keep each DELETE well under SQLite's 999 parameter limit
+DELETE_CHUNK = 500
+
+
+class Command(NoArgsCommand):
+    """
+    Create a CardDefinition for every catalog card and every distinct
+    name/image pair in play, point each Card at its definition and drop
+    the old columns
+    """
+
+    help = ("Move Card.name and Card.image into shared CardDefinition "
+            "rows. Catalog cards become the catalog's definitions.")
+
+    option_list = NoArgsCommand.option_list + (
+            make_option("--database", action="store", dest="database",
+                default=DEFAULT_DB_ALIAS,
+                help="Database to migrate (default: \"default\")"),
+            )
+
+    def handle_noargs(self, **options):
+        using = options.get("database")
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        card_table = Card._meta.db_table
+
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            cursor = connection.cursor()
+            columns = self._columns(cursor, card_table, using)
+            if "name" not in columns:
+                transaction.commit(using=using)
+                self.stdout.write("Card definitions are already migrated\n")
+                return
+            self._create_schema(cursor, columns, using)
+
+            catalogs = CardCatalog.objects.using(using).in_bulk(
+                    CardCatalog.objects.using(using).values_list(
+                        "id", flat=True))
+            cursor.execute("SELECT %s, %s, %s, %s FROM %s" % (
+                    qn("id"), qn("deck_id"), qn("name"), qn("image"),
+                    qn(card_table)))
+            rows = cursor.fetchall()
+
+            # Catalog cards are the templates, turn them into definitions
+            by_card = {}
+            templates = []
+            for catalog in catalogs.values():
+                catalog._card_dict = {}
+            for card_id, deck_id, name, image in rows:
+                if deck_id in catalogs:
+                    definition = CardDefinition.objects.using(using).create(
+                            catalog_id=deck_id, name=name, image=image)
+                    by_card.setdefault((name, image), definition.pk)
+                    catalogs[deck_id]._card_dict[name] = definition.pk
+                    templates.append(card_id)
+
+            # Every other card shares a definition per name and image
+            updates = []
+            created = 0
+            for card_id, deck_id, name, image in rows:
+                if deck_id in catalogs:
+                    continue
+                if (name, image) not in by_card:
+                    by_card[(name, image)] = CardDefinition.objects.using(
+                            using).create(name=name, image=image).pk
+                    created += 1
+                updates.append((card_id, by_card[(name, image)]))
+            bulk_update(Card, updates, ("definition",), using=using)
+
+            for start in range(0, len(templates), DELETE_CHUNK):
+                chunk = templates[start:start + DELETE_CHUNK]
+                cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                        qn(card_table), qn("id"),
+                        ", ".join(["%s"] * len(chunk))), chunk)
+            for catalog in catalogs.values():
+                catalog.save(using=using)
+            drop_columns(cursor, card_table, LEGACY_COLUMNS, using)
+            transaction.commit(using=using)
+        except:
+            transaction.rollback(using=using)
+            raise
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+        # Cached Card instances were pickled with the old fields
+        cache.clear()
+        self.stdout.write("Created %d catalog and %d shared definitions "
+                "for %d cards\n" % (len(templates), created, len(updates)))
+
+    def _create_schema(self, cursor, columns, using):
+        """
+        Create the CardDefinition table and the Card.definition column
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        style = no_style()
+        if CardDefinition._meta.db_table not in \
+                connection.introspection.table_names():
+            statements, pending = connection.creation.sql_create_model(
+                    CardDefinition, style, set([CardCatalog]))
+            statements.extend(connection.creation.sql_indexes_for_model(
+                    CardDefinition, style))
+            for sql in statements:
+                cursor.execute(sql)
+        definition = Card._meta.get_field("definition")
+        if definition.column not in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % (
+                    qn(Card._meta.db_table), qn(definition.column),
+                    definition.db_type(connection=connection)))
+            for sql in connection.creation.sql_indexes_for_field(
+                    Card, definition, style):
+                cursor.execute(sql)
+
+    def _columns(self, cursor, table, using):
+        """
+        @return: list of column names in table
+        """
+        introspection = connections[using].introspection
+        return [ row[0] for row in
+                introspection.get_table_description(cursor, table) ]
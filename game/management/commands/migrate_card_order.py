@@ -0,0 +1,84 @@
+"""
+Management command to move deck order from the pickled Deck._card_list
+column into the Card.position column
+"""
+from optparse import make_option
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from picklefield.fields import dbsafe_decode
+from game.models.card import Card
+from game.management.schema import drop_columns
+from game.models.deck import Deck, write_positions
+
+
+LEGACY_COLUMN = "_card_list"
+
+
+class Command(NoArgsCommand):
+    """
+    Add Card.position, fill it from every deck's pickled card list and
+    drop the old column
+    """
+
+    help = ("Copy the order stored in the pickled Deck._card_list column "
+            "into Card.position, then drop the old column")
+
+    option_list = NoArgsCommand.option_list + (
+            make_option("--database", action="store", dest="database",
+                default=DEFAULT_DB_ALIAS,
+                help="Database to migrate (default: \"default\")"),
+            )
+
+    def handle_noargs(self, **options):
+        using = options.get("database")
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        card_table = Card._meta.db_table
+        deck_table = Deck._meta.db_table
+        position = Card._meta.get_field("position")
+
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            cursor = connection.cursor()
+            if position.column not in self._columns(cursor, card_table, using):
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % (
+                        qn(card_table), qn(position.column),
+                        position.db_type(connection=connection)))
+                for sql in connection.creation.sql_indexes_for_field(
+                        Card, position, no_style()):
+                    cursor.execute(sql)
+            if LEGACY_COLUMN not in self._columns(cursor, deck_table, using):
+                transaction.commit(using=using)
+                self.stdout.write("Deck order is already migrated\n")
+                return
+            cursor.execute("SELECT %s, %s FROM %s" % (
+                    qn(Deck._meta.pk.column), qn(LEGACY_COLUMN),
+                    qn(deck_table)))
+            rows = cursor.fetchall()
+            for deck_id, card_list in rows:
+                card_ids = dbsafe_decode(card_list) if card_list else []
+                write_positions(
+                        [ (card_id, cnt) for cnt, card_id in enumerate(card_ids) ],
+                        using=using)
+            drop_columns(cursor, deck_table, [LEGACY_COLUMN], using)
+            transaction.commit(using=using)
+        except:
+            transaction.rollback(using=using)
+            raise
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+        # Cached Card and Deck instances were pickled with the old fields
+        cache.clear()
+        self.stdout.write("Migrated the card order of %d decks\n" % len(rows))
+
+    def _columns(self, cursor, table, using):
+        """
+        @return: list of column names in table
+        """
+        introspection = connections[using].introspection
+        return [ row[0] for row in
+                introspection.get_table_description(cursor, table) ]
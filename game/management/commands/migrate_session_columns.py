@@ -0,0 +1,183 @@
+"""
+Management command to add the lobby, seat, revision and event number
+columns to a database created before Session, Deck and GameEvent had them
+"""
+from optparse import make_option
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from picklefield.fields import dbsafe_decode
+from game.models.deck import Deck
+from game.models.event import GameEvent
+from game.models.session import Session
+import os
+import re
+
+
+# Custom SQL syncdb runs for new databases, holding the lobby index
+SESSION_SQL = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))),
+        "models", "sql", "session.sql")
+
+# Columns to add per model, with the default existing rows get
+COLUMNS = (
+        (Session, "game", None),
+        (Session, "seats_taken", "0"),
+        (Session, "joinable", "FALSE"),
+        (Session, "version", "0"),
+        (Session, "event_seq", "0"),
+        (Deck, "revision", "0"),
+        (GameEvent, "seq", "0"),
+        )
+
+# Queries telling whether an index exists, per database vendor
+INDEX_QUERIES = {
+        "sqlite": "SELECT 1 FROM sqlite_master "
+            "WHERE type = 'index' AND name = %s",
+        "postgresql": "SELECT 1 FROM pg_indexes WHERE indexname = %s",
+        "mysql": "SELECT 1 FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND index_name = %s",
+        }
+
+
+class Command(NoArgsCommand):
+    """
+    Add Session.game, seats_taken, joinable, version and event_seq,
+    Deck.revision, GameEvent.seq and the lobby index where they are
+    missing, then fill the seat columns from every session's pickled
+    player list and number the logged events of every session. Running it
+    again only adds what is still missing.
+    """
+
+    help = ("Add the Session game, seats_taken, joinable, version and "
+            "event_seq columns, the Deck revision column, the GameEvent "
+            "seq column and the lobby index")
+
+    option_list = NoArgsCommand.option_list + (
+            make_option("--database", action="store", dest="database",
+                default=DEFAULT_DB_ALIAS,
+                help="Database to migrate (default: \"default\")"),
+            )
+
+    def handle_noargs(self, **options):
+        using = options.get("database")
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        style = no_style()
+
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            cursor = connection.cursor()
+            added = []
+            for model, name, default in COLUMNS:
+                field = model._meta.get_field(name)
+                table = model._meta.db_table
+                if field.column in self._columns(cursor, table, using):
+                    continue
+                if default is None:
+                    definition = "NULL"
+                else:
+                    definition = "NOT NULL DEFAULT %s" % default
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s %s" % (
+                        qn(table), qn(field.column),
+                        field.db_type(connection=connection), definition))
+                for sql in connection.creation.sql_indexes_for_field(
+                        model, field, style):
+                    cursor.execute(sql)
+                added.append("%s.%s" % (model._meta.object_name, name))
+            for name, sql in self._indexes():
+                if not self._index_exists(cursor, name, using):
+                    cursor.execute(sql)
+                    added.append(name)
+            if not added:
+                transaction.commit(using=using)
+                self.stdout.write("Session columns are already migrated\n")
+                return
+            filled = 0
+            if "Session.seats_taken" in added or "Session.joinable" in added:
+                filled = self._fill_seats(cursor, using)
+            if "GameEvent.seq" in added:
+                self._number_events(cursor, using)
+            transaction.commit(using=using)
+        except:
+            transaction.rollback(using=using)
+            raise
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+        # Cached Session and Deck instances were pickled without the columns
+        cache.clear()
+        self.stdout.write("Added %s and filled the seats of %d sessions\n" %
+                (", ".join(added), filled))
+
+    def _fill_seats(self, cursor, using):
+        """
+        Set seats_taken and joinable of every session from its pickled
+        player list, the way Session.save does
+
+        @return: number of sessions
+        """
+        qn = connections[using].ops.quote_name
+        cursor.execute("SELECT %s, %s, %s, %s FROM %s" % (
+                qn(Session._meta.pk.column), qn("_player_list"),
+                qn("status"), qn("max_players"),
+                qn(Session._meta.db_table)))
+        rows = cursor.fetchall()
+        for session_id, player_list, status, max_players in rows:
+            session = Session(status=status, max_players=max_players)
+            seats = dbsafe_decode(player_list) if player_list else []
+            seats_taken, joinable = session._seat_columns(seats)
+            cursor.execute("UPDATE %s SET %s = %%s, %s = %%s "
+                    "WHERE %s = %%s" % (qn(Session._meta.db_table),
+                    qn("seats_taken"), qn("joinable"),
+                    qn(Session._meta.pk.column)),
+                    [seats_taken, joinable, session_id])
+        return len(rows)
+
+    def _number_events(self, cursor, using):
+        """
+        Number the logged events of every session in id order and set
+        each session's event_seq to its last number
+        """
+        qn = connections[using].ops.quote_name
+        event_table = qn(GameEvent._meta.db_table)
+        cursor.execute("SELECT %s, %s FROM %s ORDER BY %s" % (
+                qn("id"), qn("session_id"), event_table, qn("id")))
+        seqs = {}
+        numbered = []
+        for event_id, session_id in cursor.fetchall():
+            seqs[session_id] = seqs.get(session_id, 0) + 1
+            numbered.append((seqs[session_id], event_id))
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                event_table, qn("seq"), qn("id")), numbered)
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                qn(Session._meta.db_table), qn("event_seq"),
+                qn(Session._meta.pk.column)),
+                [ (seq, session_id) for session_id, seq in seqs.items() ])
+
+    def _indexes(self):
+        """
+        @return: list of (name, statement) of the indexes in SESSION_SQL
+        """
+        with open(SESSION_SQL) as stream:
+            statements = [ line.strip().rstrip(";") for line in stream
+                    if line.strip() and not line.startswith("--") ]
+        return [ (re.match(r"CREATE INDEX (\w+)", sql).group(1), sql)
+                for sql in statements if sql.startswith("CREATE INDEX") ]
+
+    def _index_exists(self, cursor, name, using):
+        """
+        @return: True if the database has an index called name
+        """
+        cursor.execute(INDEX_QUERIES[connections[using].vendor], [name])
+        return cursor.fetchone() is not None
+
+    def _columns(self, cursor, table, using):
+        """
+        @return: list of column names in table
+        """
+        introspection = connections[using].introspection
+        return [ row[0] for row in
+                introspection.get_table_description(cursor, table) ]
@@ -0,0 +1,78 @@
+"""
+Management command to generate load with simulated games
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from game.simulator import setup_game, simulate, ACTIONS
+import json
+import os
+import tempfile
+
+
+class Command(BaseCommand):
+    """
+    Set games up in a throwaway test database and play their turns over a
+    pool of threads or processes, see game.simulator
+    """
+
+    help = ("Play simulated games over a worker pool and report throughput, "
+            "latency per action and contention")
+
+    option_list = BaseCommand.option_list + (
+            make_option("--games", action="store", type="int", dest="games",
+                default=100, help="Number of games (default 100)"),
+            make_option("--turns", action="store", type="int", dest="turns",
+                default=20, help="Turns per game (default 20)"),
+            make_option("--players", action="store", type="int",
+                dest="players", default=4, help="Players per game (default 4)"),
+            make_option("--deck-size", action="store", type="int",
+                dest="deck_size", default=52,
+                help="Cards in the pile of each game (default 52)"),
+            make_option("--workers", action="store", type="int",
+                dest="workers", default=8, help="Size of the pool (default 8)"),
+            make_option("--processes", action="store_true", dest="processes",
+                default=False, help="Use a process pool instead of threads"),
+            make_option("--seed", action="store", type="int", dest="seed",
+                default=0, help="Seed of the games (default 0)"),
+            make_option("--output", action="store", dest="output",
+                help="Save the report as JSON to this file"),
+            )
+
+    def handle(self, *args, **options):
+        settings_dict = connection.settings_dict
+        old_name = settings_dict["NAME"]
+        old_test_name = settings_dict.get("TEST_NAME")
+        if settings_dict["ENGINE"].endswith("sqlite3") and \
+                old_test_name in (None, "", ":memory:"):
+            # Workers each open a connection, which must see the same data
+            handle, settings_dict["TEST_NAME"] = tempfile.mkstemp(
+                    suffix=".db")
+            os.close(handle)
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            session_ids = [ setup_game(options["deck_size"], "sim-%d" % cnt,
+                players=options["players"], seed=options["seed"] + cnt).id
+                for cnt in xrange(options["games"]) ]
+            report = simulate(session_ids, options["turns"],
+                    workers=options["workers"],
+                    processes=options["processes"], seed=options["seed"])
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            settings_dict["TEST_NAME"] = old_test_name
+        self.stdout.write("%d turns in %.3fs: %.1f turns/s, %.1f actions/s\n"
+                % (report["turns"], report["seconds"],
+                    report["turns_per_sec"], report["actions_per_sec"]))
+        for action in ACTIONS:
+            stats = report["actions"][action]
+            if stats["calls"]:
+                self.stdout.write("%-12s %8d calls  p50 %8.2fms  p99 %8.2fms\n"
+                        % (action, stats["calls"], stats["p50"] * 1000,
+                            stats["p99"] * 1000))
+        self.stdout.write("retries %d, conflicts %d, locked %d, errors %d\n"
+                % (report["retries"], report["conflicts"], report["locked"],
+                    report["errors"]))
+        if options.get("output"):
+            with open(options["output"], "w") as stream:
+                json.dump(report, stream, indent=2, sort_keys=True)
@@ -0,0 +1,115 @@
+"""
+Schema changes shared by the migration commands
+"""
+from django.db import connections
+
+
+# First SQLite release able to run ALTER TABLE ... DROP COLUMN
+SQLITE_DROP_COLUMN = (3, 35, 0)
+
+
+def table_columns(cursor, table, using):
+    """
+    @return: list of column names in table
+    """
+    introspection = connections[using].introspection
+    return [ row[0] for row in
+            introspection.get_table_description(cursor, table) ]
+
+
+def can_drop_column(using):
+    """
+    @return: True if the database runs ALTER TABLE ... DROP COLUMN
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return True
+    from django.db.backends.sqlite3.base import Database
+    return Database.sqlite_version_info >= SQLITE_DROP_COLUMN
+
+
+def drop_columns(cursor, table, columns, using):
+    """
+    Drop columns from a table, with ALTER TABLE where the database can,
+    else by rebuilding the table without them, see rebuild_table
+
+    @param cursor: cursor of the transaction to run in
+    @param table: name of the table
+    @param columns: names of the columns to drop
+    @param using: alias of the database
+    """
+    if not can_drop_column(using):
+        rebuild_table(cursor, table, columns, using)
+        return
+    qn = connections[using].ops.quote_name
+    for column in columns:
+        cursor.execute("ALTER TABLE %s DROP COLUMN %s" % (
+                qn(table), qn(column)))
+
+
+def rebuild_table(cursor, table, columns, using):
+    """
+    Drop columns from an SQLite table the way SQLite documents it: create
+    a copy of the table without them, copy every row over, drop the table
+    and rename the copy. Column types, NOT NULL, defaults, primary and
+    foreign keys, unique constraints and indexes on the remaining columns
+    are kept.
+
+    @param cursor: cursor of the transaction to run in
+    @param table: name of the table
+    @param columns: names of the columns to drop
+    @param using: alias of the database
+    """
+    qn = connections[using].ops.quote_name
+    dropped = set(columns)
+    references = {}
+    cursor.execute("PRAGMA foreign_key_list(%s)" % qn(table))
+    for row in cursor.fetchall():
+        references[row[3]] = (row[2], row[4])
+    definitions = []
+    kept = []
+    cursor.execute("PRAGMA table_info(%s)" % qn(table))
+    for cid, name, db_type, notnull, default, pk in cursor.fetchall():
+        if name in dropped:
+            continue
+        kept.append(qn(name))
+        definition = "%s %s" % (qn(name), db_type)
+        if notnull:
+            definition += " NOT NULL"
+        if default is not None:
+            definition += " DEFAULT %s" % default
+        if pk:
+            definition += " PRIMARY KEY"
+        if name in references:
+            definition += " REFERENCES %s (%s)" % (
+                    qn(references[name][0]), qn(references[name][1]))
+        definitions.append(definition)
+    indexes = []
+    cursor.execute("PRAGMA index_list(%s)" % qn(table))
+    for row in cursor.fetchall():
+        name, origin = row[1], row[3]
+        if origin == "pk":
+            continue
+        cursor.execute("PRAGMA index_info(%s)" % qn(name))
+        indexed = [ info[2] for info in cursor.fetchall() ]
+        if dropped.intersection(indexed):
+            continue
+        if origin == "u":
+            definitions.append("UNIQUE (%s)" % ", ".join(
+                    [ qn(column) for column in indexed ]))
+        else:
+            indexes.append(name)
+    statements = []
+    for name in indexes:
+        cursor.execute("SELECT sql FROM sqlite_master "
+                "WHERE type = 'index' AND name = %s", [name])
+        statements.append(cursor.fetchone()[0])
+    copy = "new__%s" % table
+    cursor.execute("CREATE TABLE %s (%s)" % (
+            qn(copy), ", ".join(definitions)))
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+            qn(copy), ", ".join(kept), ", ".join(kept), qn(table)))
+    cursor.execute("DROP TABLE %s" % qn(table))
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(copy), qn(table)))
+    for sql in statements:
+        cursor.execute(sql)
@@ -4,3 +4,7 @@ import player
 import session
 import user
 import game_info
+import event
+
+# Wraps the model methods when the GAME_INSTRUMENT setting is on
+import game.instrument
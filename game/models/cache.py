@@ -0,0 +1,151 @@
+"""
+Per-model cache policies on top of cache-machine
+
+Each model using PolicyManager caches its querysets according to its
+policy, looked up by model name in GAME_CACHE_POLICIES (merged over
+DEFAULT_POLICIES):
+
+    NEVER    querysets are never cached and saves skip invalidation, for
+             rows that change on nearly every move
+    FOREVER  querysets never expire and are only dropped by invalidation,
+             for static data such as card definitions
+    seconds  querysets expire after the given number of seconds and are
+             invalidated as usual
+
+Models without a policy keep cache-machine's default behaviour. Hits,
+misses and invalidations are counted per model, see stats.
+"""
+from django.conf import settings
+import caching.base
+import threading
+
+
+NEVER = "never"
+FOREVER = "forever"
+
+# Memcached treats larger relative timeouts as timestamps
+FOREVER_TIMEOUT = 60 * 60 * 24 * 30
+
+DEFAULT_POLICIES = {
+        "Card": NEVER,
+        "CardDefinition": FOREVER,
+        "GameInfo": FOREVER,
+        "UserProfile": FOREVER,
+        }
+
+POLICIES = dict(DEFAULT_POLICIES)
+POLICIES.update(getattr(settings, "GAME_CACHE_POLICIES", {}))
+
+
+def _name(model):
+    """
+    @return: name of the model, deferred classes use their real model's
+    """
+    if model._deferred:
+        model = model._meta.proxy_for_model
+    return model._meta.object_name
+
+
+def get_policy(model):
+    """
+    @param model: model class
+    @return: NEVER, FOREVER, a timeout in seconds or None for the default
+    """
+    return POLICIES.get(_name(model))
+
+
+def get_timeout(model):
+    """
+    @param model: model class
+    @return: cache-machine timeout for the querysets of model
+    """
+    policy = get_policy(model)
+    if policy == NEVER:
+        return caching.base.NO_CACHE
+    if policy == FOREVER:
+        return FOREVER_TIMEOUT
+    return policy
+
+
+class CacheStats(object):
+    """
+    Thread safe hit, miss and invalidation counters per model
+    """
+
+    KINDS = ("hits", "misses", "invalidations")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, model, kind, count=1):
+        with self._lock:
+            counters = self._counters.setdefault(
+                    _name(model), dict.fromkeys(self.KINDS, 0))
+            counters[kind] += count
+
+    def snapshot(self):
+        """
+        @return: dict of model name to dict of counters
+        """
+        with self._lock:
+            return dict([ (name, dict(counters))
+                    for name, counters in self._counters.items() ])
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+
+stats = CacheStats()
+
+
+def invalidate_keys(model, keys):
+    """
+    Flush cached queries after rows of model changed without a save, e.g.
+    with a queryset update or bulk_create
+
+    @param model: model class whose rows changed
+    @param keys: cache keys to invalidate
+    """
+    if not keys or get_policy(model) == NEVER:
+        return
+    stats.record(model, "invalidations", len(keys))
+    caching.base.invalidator.invalidate_keys(keys)
+
+
+class PolicyQuerySet(caching.base.CachingQuerySet):
+    """
+    CachingQuerySet applying its model's policy and counting cache use
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PolicyQuerySet, self).__init__(*args, **kwargs)
+        self.timeout = get_timeout(self.model)
+
+    def iterator(self):
+        iterator = super(PolicyQuerySet, self).iterator()
+        if self.timeout == caching.base.NO_CACHE:
+            return iterator
+        return self._counted(iterator)
+
+    def _counted(self, iterator):
+        hit = False
+        for obj in iterator:
+            hit = getattr(obj, "from_cache", False)
+            yield obj
+        stats.record(self.model, "hits" if hit else "misses")
+
+
+class PolicyManager(caching.base.CachingManager):
+    """
+    CachingManager returning PolicyQuerySets
+    """
+
+    def get_query_set(self):
+        return PolicyQuerySet(self.model, using=self._db)
+
+    def invalidate(self, *objects):
+        if get_policy(self.model) == NEVER:
+            return
+        stats.record(self.model, "invalidations", len(objects))
+        super(PolicyManager, self).invalidate(*objects)
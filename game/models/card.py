@@ -1,12 +1,34 @@
 """
 Module containing the card model
 """
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction, connections
+from django.db.models import signals
+from django.utils.importlib import import_module
 from picklefield.fields import PickledObjectField
 import caching.base
+from game.models.cache import PolicyManager, invalidate_keys
+from game.models.polymorphic import PolymorphicMixin, PolymorphicManager
+import time
 
 
-class CardUser(caching.base.CachingMixin, models.Model):
+# Number of new cards inserted per statement when loading a catalog
+CATALOG_CHUNK = 500
+
+# Keep each CASE UPDATE well under SQLite's 999 parameter limit
+UPDATE_CHUNK = 300
+
+# Cache key of the version shared by every process cache of definitions
+DEFINITION_VERSION_KEY = "card_definition:version"
+
+# Seconds a process trusts its cached definitions before checking the
+# shared version again
+DEFINITION_CHECK_INTERVAL = getattr(
+        settings, "GAME_DEFINITION_CHECK_INTERVAL", 1)
+
+
+class CardUser(PolymorphicMixin, caching.base.CachingMixin, models.Model):
     """
     Class to get around the limitation that Card can't be ForeignKey'd
     to either Deck or CardLibrary
@@ -14,37 +36,11 @@ class CardUser(caching.base.CachingMixin, models.Model):
 
     classname = models.CharField(max_length=64, editable=False, null=True)
 
-    objects = caching.base.CachingManager()
+    objects = PolymorphicManager()
 
     def __init__(self, *args, **kwargs):
         super(CardUser, self).__init__(*args, **kwargs)
 
-    def save(self, *args, **kwargs):
-        """
-        Overwrite the save function to save the class name for referencing
-        purposes.
-        """
-        if not self.classname:
-            cur_class = self.__class__
-            class_str = cur_class.__name__
-            while cur_class.__name__ != "CardUser":
-                cur_class = cur_class.__base__().__class__
-                class_str = "%s.%s" % (cur_class.__name__, class_str)
-            self.classname = class_str
-        super(CardUser, self). save(*args, **kwargs)
-
-    def get_class(self):
-        """
-        Allow a user to query the main DeckUser table and be able to find
-        the associate subclass
-        """
-        if self.classname == self.__class__.__name__:
-            return self
-        ptr = self
-        for sub_class in self.classname.lower().split('.')[1:]:
-            ptr = ptr.__getattribute__(sub_class)
-        return ptr
-
     class Meta:
         """ Metadata class for CardUser """
         app_label = "game"
@@ -66,17 +62,77 @@ class CardCatalog(CardUser):
     _card_dict = PickledObjectField()
 
     def __init__(self, *args, **kwargs):
-        super(CardUser, self).__init__(*args, **kwargs)
-        self._card_dict = {}
+        super(CardCatalog, self).__init__(*args, **kwargs)
+        if not self._card_dict:
+            self._card_dict = {}
 
+    @transaction.commit_on_success
     def load_catalog(self, card_module):
         """
         Load cards from module into database
+
+        CARD_LIST may be any iterable (e.g. a generator) of dicts with a
+        "name" and an optional "image". New card definitions are inserted
+        with bulk_create in chunks of CATALOG_CHUNK, existing definitions
+        are only written when their image changed, and definitions no
+        longer listed are deleted unless a game still uses them, so
+        reloading a module is cheap.
+
+        @param card_module: module, or dotted path to a module, defining
+            CARD_LIST
+        @return: dict counting the created, updated and deleted definitions
         """
-        from card_module import CARD_LIST
-        
-        for card in CARD_LIST:
-            pass
+        if isinstance(card_module, basestring):
+            card_module = import_module(card_module)
+        existing = dict([ (name, (def_id, image))
+                for def_id, name, image in
+                self.definitions.values_list("id", "name", "image") ])
+        stats = {"created": 0, "updated": 0, "deleted": 0}
+        listed = set()
+        new_defs = []
+        changed = []
+        for card in card_module.CARD_LIST:
+            name = card["name"]
+            image = card.get("image", "")
+            if name in listed:
+                raise ValueError("Card %s is listed more than once" % name)
+            listed.add(name)
+            if name not in existing:
+                new_defs.append(
+                        CardDefinition(catalog=self, name=name, image=image))
+                if len(new_defs) >= CATALOG_CHUNK:
+                    CardDefinition.objects.bulk_create(new_defs)
+                    stats["created"] += len(new_defs)
+                    new_defs = []
+            elif existing[name][1] != image:
+                changed.append((existing[name][0], image))
+        if new_defs:
+            CardDefinition.objects.bulk_create(new_defs)
+            stats["created"] += len(new_defs)
+        bulk_update(CardDefinition, changed, ("image",), using=self._state.db)
+        removed = [ existing[name][0]
+                for name in existing if name not in listed ]
+        if removed:
+            # Cards in running games keep their definition
+            unused = self.definitions.filter(
+                    id__in=removed, instances__isnull=True)
+            stats["deleted"] = unused.count()
+            unused.delete()
+        stats["updated"] = len(changed)
+
+        if stats["created"] or removed or len(self._card_dict) != len(listed):
+            self._card_dict = dict(self.definitions.filter(
+                    name__in=listed).values_list("name", "id"))
+            self.save()
+        # Ids from a rolled back transaction may be handed out again
+        CardDefinition.forget([ row[0] for row in changed ] + removed +
+                self._card_dict.values())
+        # Bulk writes skip the signals cache-machine invalidates on
+        invalidate_keys(CardDefinition,
+                [ CardDefinition._cache_key(row[0], self._state.db)
+                    for row in changed ] +
+                [CardCatalog._cache_key(self.pk, self._state.db)])
+        return stats
 
     class Meta:
         """ Metadata class for CardCatalog """
@@ -84,16 +140,117 @@ class CardCatalog(CardUser):
         verbose_name = "Card Catalog"
 
 
-class Card(caching.base.CachingMixin, models.Model):
+class CardDefinition(caching.base.CachingMixin, models.Model):
     """
-    Django model to store a single card
+    Static data shared by every copy of a card, e.g. its name and image.
+    Definitions rarely change, so they are cached in process memory and
+    looked up with get_cached instead of being read for every card on
+    every request. A change in any process bumps a version in the shared
+    cache, and every other process drops its definitions once it sees
+    the new version, at most DEFINITION_CHECK_INTERVAL seconds later.
     """
 
-    deck = models.ForeignKey(CardUser, related_name="cards", null=True)
+    catalog = models.ForeignKey(
+            CardCatalog, related_name="definitions", null=True)
     name = models.CharField(max_length=32)
     image = models.ImageField(upload_to="card_images")
 
-    objects = caching.base.CachingManager()
+    objects = PolicyManager()
+
+    # Definition id to CardDefinition, shared by every request
+    _cache = {}
+    # Shared version _cache was filled at and when it was last checked
+    _cache_version = None
+    _checked = 0
+
+    def __unicode__(self):
+        return self.name
+
+    @classmethod
+    def get_cached(cls, def_ids):
+        """
+        Look definitions up in the process cache, loading every missing
+        one with a single query
+
+        @param def_ids: iterable of definition ids
+        @return: dict of definition id to CardDefinition
+        """
+        cls._check_version()
+        # Another thread may replace _cache while this one fills it
+        cached = cls._cache
+        def_ids = set(def_ids)
+        missing = [ def_id for def_id in def_ids if def_id not in cached ]
+        if missing:
+            cached.update(cls.objects.in_bulk(missing))
+        return dict([ (def_id, cached[def_id]) for def_id in def_ids ])
+
+    @classmethod
+    def _check_version(cls):
+        """
+        Drop the process cache if definitions changed in another process
+        since it was filled, reading the shared version at most every
+        DEFINITION_CHECK_INTERVAL seconds
+        """
+        now = time.time()
+        if now - cls._checked < DEFINITION_CHECK_INTERVAL:
+            return
+        cls._checked = now
+        version = cache.get(DEFINITION_VERSION_KEY)
+        if version is None:
+            # Start from the clock so an evicted version is never reused
+            cache.add(DEFINITION_VERSION_KEY, int(now))
+            version = cache.get(DEFINITION_VERSION_KEY)
+        if version != cls._cache_version:
+            cls._cache = {}
+            cls._cache_version = version
+
+    @classmethod
+    def forget(cls, def_ids):
+        """
+        Drop definitions from the process cache and retire the cached
+        definitions of every other process
+
+        @param def_ids: iterable of definition ids
+        """
+        for def_id in def_ids:
+            cls._cache.pop(def_id, None)
+        try:
+            version = cache.incr(DEFINITION_VERSION_KEY)
+        except ValueError:
+            cache.set(DEFINITION_VERSION_KEY, int(time.time()))
+            return
+        # Nothing else is stale here if this process was up to date
+        if version == (cls._cache_version or 0) + 1:
+            cls._cache_version = version
+
+    class Meta:
+        """ Metadata class for CardDefinition """
+        app_label = "game"
+        verbose_name = "Card Definition"
+
+
+def forget_definition(sender, instance, **kwargs):
+    """
+    Keep the process cache in step with saved or deleted definitions
+    """
+    CardDefinition.forget([instance.pk])
+
+signals.post_save.connect(forget_definition, sender=CardDefinition)
+signals.post_delete.connect(forget_definition, sender=CardDefinition)
+
+
+class Card(caching.base.CachingMixin, models.Model):
+    """
+    Django model to store a single card. A card only holds its game
+    state, everything static comes from its CardDefinition.
+    """
+
+    deck = models.ForeignKey(CardUser, related_name="cards", null=True)
+    # Order of the card inside a Deck, lower positions are closer to the top
+    position = models.IntegerField(null=True, db_index=True)
+    definition = models.ForeignKey(CardDefinition, related_name="instances")
+
+    objects = PolicyManager()
 
     def __init__(self, *args, **kwargs):
         super(Card, self).__init__(*args, **kwargs)
@@ -101,7 +258,61 @@ class Card(caching.base.CachingMixin, models.Model):
     def __unicode__(self):
         return self.name
 
+    def get_definition(self):
+        """
+        Return the card's definition from the process cache
+        """
+        return CardDefinition.get_cached([self.definition_id])[
+                self.definition_id]
+
+    @property
+    def name(self):
+        return self.get_definition().name
+
+    @property
+    def image(self):
+        return self.get_definition().image
+
     class Meta:
         """ Metadata class for Card """
         app_label = "game"
         verbose_name = "Card"
+
+
+def bulk_update(model, rows, fields, using="default", **common):
+    """
+    Write per-row column values with one CASE update per chunk of
+    UPDATE_CHUNK values, instead of one UPDATE per row
+
+    @param model: model class of the rows
+    @param rows: list of (pk, value, ...) tuples, one value per field
+    @param fields: names of the fields the values belong to
+    @param using: database alias to write to
+    @param common: values written to every row, e.g. deck=deck.pk
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    pk_col = qn(opts.pk.column)
+    chunk_size = UPDATE_CHUNK // len(fields)
+    cursor = connection.cursor()
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        assignments = []
+        params = []
+        for cnt, name in enumerate(fields):
+            assignments.append("%s = CASE %s %s END" % (
+                    qn(opts.get_field(name).column), pk_col,
+                    " ".join(["WHEN %s THEN %s"] * len(chunk))))
+            for row in chunk:
+                params.extend([row[0], row[cnt + 1]])
+        for name, value in common.items():
+            assignments.append("%s = %%s" % qn(opts.get_field(name).column))
+            params.append(value)
+        params.extend([ row[0] for row in chunk ])
+        cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+                qn(opts.db_table), ", ".join(assignments), pk_col,
+                ", ".join(["%s"] * len(chunk))), params)
+    transaction.commit_unless_managed(using=using)
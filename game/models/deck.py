@@ -2,39 +2,147 @@
 Deck module
 """
 from game.models.session import DeckUser
-from game.models.card import CardUser
+from game.models.card import CardUser, Card, CardDefinition, bulk_update
+from game.models.event import GameEvent, logging_transaction
+from django.conf import settings
 from django.db import models
-from picklefield.fields import PickledObjectField
+from django.db.models import F, Q
 import random
-import caching.base
+from game.models.cache import PolicyManager, invalidate_keys
 
 
+# Attempts at a move before giving up on a contended deck
+MOVE_RETRIES = getattr(settings, "GAME_MOVE_RETRIES", 20)
+
 SHOW_CHOICES = (
         ("none", "Show None"),
         ("top", "Show Top"),
         ("all", "Show All"),
         )
 
+def write_positions(positions, deck=None, using="default"):
+    """
+    Write card positions, see bulk_update
+
+    @param positions: list of (card id, position) pairs
+    @param deck: if given, also move the cards into this deck
+    @param using: database alias to write to
+    """
+    common = {}
+    if deck is not None:
+        common["deck"] = deck.pk
+    bulk_update(Card, positions, ("position",), using=using, **common)
+
+
+def shuffle_order(order, seed):
+    """
+    Shuffle card ids in place with a Fisher-Yates shuffle that settles the
+    cards from the top down, one draw of the generator per card, so a deck
+    can also be shuffled lazily as it is drawn, see controller.order
+
+    @param order: list of card ids, top first
+    @param seed: seed of the shuffle
+    """
+    rng = random.Random(seed)
+    size = len(order)
+    for index in xrange(size - 1):
+        other = index + int(rng.random() * (size - index))
+        order[index], order[other] = order[other], order[index]
+
+
+def bump_revisions(deck_ids, using="default"):
+    """
+    Mark decks whose order was written without Deck._atomic, so moves
+    prepared from their old order are retried
+
+    @param deck_ids: ids of the changed decks
+    @param using: database alias the decks live in
+    """
+    deck_ids = list(deck_ids)
+    if not deck_ids:
+        return
+    Deck.objects.using(using).filter(id__in=deck_ids).update(
+            revision=F("revision") + 1)
+    invalidate_keys(Deck, [ Deck._cache_key(pk, using) for pk in deck_ids ])
+
+
+def claim_revisions(revisions, using="default"):
+    """
+    Bump the revision of decks written without Deck._atomic with a single
+    update, but only if none of them changed since its revision was read.
+    Call it in the transaction writing the decks, which has to be rolled
+    back on a conflict.
+
+    @param revisions: dict of deck id to the revision it was read at
+    @param using: database alias the decks live in
+    @raise DeckConflict: if any of the decks changed since
+    """
+    if not revisions:
+        return
+    unchanged = Q()
+    for deck_id, revision in revisions.items():
+        unchanged = unchanged | Q(id=deck_id, revision=revision)
+    if Deck.objects.using(using).filter(unchanged).update(
+            revision=F("revision") + 1) != len(revisions):
+        raise DeckConflict("Decks %s changed since they were read" %
+                ", ".join([ str(deck_id) for deck_id in sorted(revisions) ]))
+    invalidate_keys(Deck, [ Deck._cache_key(pk, using) for pk in revisions ])
+
+
+class _Unclaimed(Exception):
+    """
+    Rolls back the transaction of a move whose decks could not all be
+    claimed, see Deck._atomic
+    """
+
+
+class DeckConflict(ValueError):
+    """
+    Raised when the decks of a move kept changing under it
+    """
+
 
 class Deck(CardUser):
     """
     Deck class
     
-    Index 0 represents the top of the deck
+    Index 0 represents the top of the deck. The order is stored in the
+    position column of each Card, lower positions being closer to the top,
+    so adding or removing a card at either end only writes that card's row.
+
+    Every move runs through _atomic, which bumps the revision column of the
+    decks it touches only if they are unchanged since their order was
+    read. Two players moving cards of a shared deck at once therefore never
+    overwrite each other's positions or take the same card, the loser reads
+    the deck again and retries.
     """
 
     user = models.ForeignKey(DeckUser, related_name="decks")
     name = models.CharField(max_length=16)
-    _card_list = PickledObjectField()
     show_prop = models.CharField(
             max_length=16, choices=SHOW_CHOICES, null=True)
+    revision = models.PositiveIntegerField(default=0, editable=False)
 
-    objects = caching.base.CachingManager()
+    objects = PolicyManager()
 
     def __init__(self, *args, **kwargs):
         super(Deck, self).__init__(*args, **kwargs)
-        if not self._card_list:
-            self._card_list = []
+        self._reset_order()
+
+    def __reduce__(self):
+        """
+        Keep the card order and cache out of pickled decks, cache-machine
+        stores whole model instances and neither is tied to the deck row
+        """
+        unpickle, args, data = super(Deck, self).__reduce__()
+        data = dict(data)
+        for attr in ("_order", "_positions", "_card_cache"):
+            data.pop(attr, None)
+        return (unpickle, args, data)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_order()
     
     def __unicode__(self):
         join_str = ', '
@@ -43,6 +151,248 @@ class Deck(CardUser):
                 )
         return repr_str
 
+    @classmethod
+    def create_from_catalog(cls, user, name, catalog, counts=None, **kwargs):
+        """
+        Create a deck holding fresh copies of catalog cards. Every card is
+        inserted with one bulk_create, already in shuffled order, so the
+        number of queries does not depend on the size of the deck.
+
+        @param user: DeckUser owning the deck
+        @param name: name of the deck
+        @param catalog: CardCatalog to copy cards from
+        @param counts: dict of card name to number of copies
+            (default one copy of every card in the catalog)
+        @param shuffle: shuffle the new deck (default True)
+        @param rng: random number generator used to shuffle
+            (default the random module)
+        @return: the new Deck
+        """
+        if counts is None:
+            counts = dict([ (card_name, 1) for card_name in catalog._card_dict ])
+        unknown = [ card_name for card_name in counts
+                if card_name not in catalog._card_dict ]
+        if unknown:
+            raise ValueError("Cards not in catalog %s: %s" %
+                    (catalog.name, ", ".join(sorted(unknown))))
+        using = user._state.db
+        with logging_transaction(using=using):
+            deck = cls.objects.using(using).create(user=user, name=name)
+            cards = []
+            for card_name, copies in counts.items():
+                def_id = catalog._card_dict[card_name]
+                cards.extend([ Card(deck=deck, definition_id=def_id)
+                    for cnt in range(copies) ])
+            if kwargs.get("shuffle", True):
+                kwargs.get("rng", random).shuffle(cards)
+            for position, card in enumerate(cards):
+                card.position = position
+            Card.objects.using(deck._state.db).bulk_create(cards)
+            # bulk_create does not hand back ids, read them back for the log
+            deck._order = None
+            deck._log("fill", deck.pk, list(deck._card_list))
+        return deck
+
+    def _reset_order(self):
+        """
+        Forget the loaded card order, a new deck is known to be empty
+        """
+        self._order = None if self.pk else []
+        self._positions = {}
+        self._card_cache = {}
+
+    def _set_order(self, cards):
+        """
+        Load the card order from cards already sorted by position
+
+        @param cards: Card objects of this deck, top first
+        """
+        self._order = [ card.id for card in cards ]
+        self._positions = dict(
+                [ (card.id, card.position) for card in cards ])
+        self._card_cache.update([ (card.id, card) for card in cards ])
+        CardDefinition.get_cached([ card.definition_id for card in cards ])
+
+    @property
+    def _card_list(self):
+        """
+        Card ids in deck order, loaded from the database on first use
+        """
+        if self._order is None:
+            rows = list(self.cards.order_by("position").values_list(
+                    "id", "position"))
+            self._order = [ card_id for card_id, position in rows ]
+            self._positions = dict(rows)
+        return self._order
+
+    @property
+    def game_session_id(self):
+        """
+        Id of the Session whose event log records moves on this deck
+        """
+        if not hasattr(self, "_game_session_id"):
+            self._game_session_id = self.user.get_class().game_session_id
+        return self._game_session_id
+
+    def _log(self, action, *args):
+        """
+        Append a move to the event log of the deck's session, called by
+        the change of _atomic so the move and its event commit together
+        """
+        GameEvent.log(self.game_session_id, action, *args,
+                using=self._state.db)
+
+    def _invalidate_cards(self, card_ids):
+        """
+        Flush cached queries for cards changed with a queryset update,
+        which does not send the post_save signal cache-machine listens on
+        """
+        keys = [ Card._cache_key(card_id, self._state.db)
+                for card_id in card_ids ]
+        keys.append(CardUser._cache_key(self.pk, self._state.db))
+        invalidate_keys(Card, keys)
+
+    def _reload(self):
+        """
+        Read the revision again and forget the card order. The order is
+        always loaded after its revision, so it is never older than the
+        revision it is checked against.
+        """
+        self.revision = Deck.objects.no_cache().using(self._state.db).filter(
+                pk=self.pk).values_list("revision", flat=True)[0]
+        self._reset_order()
+
+    def _claim(self):
+        """
+        Bump the revision if the deck is unchanged since it was read
+
+        @return: True if the deck was claimed
+        """
+        if not Deck.objects.using(self._state.db).filter(
+                pk=self.pk, revision=self.revision).update(
+                revision=self.revision + 1):
+            return False
+        self.revision = self.revision + 1
+        invalidate_keys(Deck, [Deck._cache_key(self.pk, self._state.db)])
+        return True
+
+    def _atomic(self, change, *others):
+        """
+        Apply a move under an optimistic lock on the revision of every deck
+        it touches. The decks are claimed and change writes the cards and
+        logs the move in one transaction, a deck that changed since it was
+        read is read again and change retried, at most MOVE_RETRIES times.
+
+        @param change: function applying the move to the loaded orders,
+            writing and logging it, it is called with no arguments
+        @param others: other Decks the move touches
+        @return: what change returned
+        @raise DeckConflict: if every attempt lost against another move
+        """
+        decks = [self] + [ deck for deck in others if deck.pk != self.pk ]
+        # Claim in id order so moves over the same decks cannot deadlock
+        decks.sort(key=lambda deck: deck.pk)
+        for attempt in range(MOVE_RETRIES):
+            if attempt:
+                for deck in decks:
+                    deck._reload()
+            for deck in decks:
+                deck._card_list
+            revisions = [ deck.revision for deck in decks ]
+            try:
+                with logging_transaction(using=self._state.db):
+                    if not all(deck._claim() for deck in decks):
+                        # Undo the claims made before the deck that changed
+                        raise _Unclaimed()
+                    return change()
+            except _Unclaimed:
+                self._unclaim(decks, revisions)
+                continue
+            except:
+                self._unclaim(decks, revisions)
+                for deck in decks:
+                    deck._reset_order()
+                raise
+        raise DeckConflict("Decks %s kept changing, try again" %
+                ", ".join([ str(deck.pk) for deck in decks ]))
+
+    def _unclaim(self, decks, revisions):
+        """
+        Give decks back the revisions they had before a rolled back claim,
+        a revision left bumped could match a later move by another player
+        and pass the claim with an order older than that move
+
+        @param decks: Decks claimed
+        @param revisions: revision of each deck before the claim
+        """
+        for deck, revision in zip(decks, revisions):
+            deck.revision = revision
+
+    def _insert(self, input_card, index):
+        """
+        Write a card into the claimed deck at index
+        """
+        order = self._card_list
+        if not order:
+            position = 0
+        elif index == 0:
+            position = self._positions[order[0]] - 1
+        elif index >= len(order):
+            position = self._positions[order[-1]] + 1
+        else:
+            # Open a gap above the card at index by lifting every card
+            # above it one position towards the top
+            position = self._positions[order[index]] - 1
+            self.cards.filter(position__lte=position).update(
+                    position=F("position") - 1)
+            for card_id in order[:index]:
+                self._positions[card_id] -= 1
+            self._invalidate_cards(order[:index])
+        input_card.deck = self
+        input_card.position = position
+        input_card.save()
+        order.insert(index, input_card.id)
+        self._positions[input_card.id] = position
+        self._card_cache[input_card.id] = input_card
+
+    def _remove(self, index):
+        """
+        Take the card at index out of the claimed deck
+
+        @return: the Card, not yet saved
+        """
+        card_id = self._card_list.pop(index)
+        del self._positions[card_id]
+        card = self._card_cache.pop(card_id, None)
+        if card is None:
+            card = self.cards.get(id=card_id)
+        card.deck = None
+        card.position = None
+        return card
+
+    def _insert_index(self, **kwargs):
+        """
+        @return: index insert_card puts a card at, see its parameters
+        """
+        if kwargs.get("index"):
+            index = kwargs.get("index")
+            if index < 0:
+                index = max(len(self._card_list) + index, 0)
+            return index
+        if not kwargs.get("top", True):
+            return len(self._card_list)
+        return 0
+
+    def _remove_index(self, **kwargs):
+        """
+        @return: index remove_card takes a card from, see its parameters
+        """
+        if kwargs.get("index"):
+            return kwargs.get("index")
+        if not kwargs.get("top", True):
+            return -1
+        return 0
+
     def insert_card(self, input_card, **kwargs):
         """
         Add card to the deck
@@ -51,15 +401,12 @@ class Deck(CardUser):
             False: insert to bottom of deck (default True)
         @param index: Remove card at index location, overrides top parameter
         """
-        self.cards.add(input_card)
-        top = kwargs.get("top", True)
-        if kwargs.get("index"):
-            index = kwargs.get("index")
-        elif not top:
-            index = len(self._card_list)
-        else:
-            index = 0
-        self._card_list.insert(index, input_card.id)
+        def insert():
+            index = self._insert_index(**kwargs)
+            self._insert(input_card, index)
+            self._log("insert_card", self.pk, input_card.id, index)
+
+        self._atomic(insert)
         if kwargs.get("save"):
             self.save()
 
@@ -91,17 +438,31 @@ class Deck(CardUser):
         index = args[0]
         if len(args) == 2:
             end = args[1]
-            return [ self.cards.get(id=index)
-                    for index in self._card_list[index:end]
-                    ]
+            return self._resolve_cards(self._card_list[index:end])
         elif len(args) == 3:
             end = args[1]
             step = args[2]
-            return [ self.cards.get(id=index)
-                    for index in self._card_list[index:end:step]
-                    ]
+            return self._resolve_cards(self._card_list[index:end:step])
         else:
-            return self.cards.get(id=self._card_list[index])
+            return self._resolve_cards([self._card_list[index]])[0]
+
+    def _resolve_cards(self, card_ids):
+        """
+        Turn a list of card ids into Card objects using a single query.
+        Cards already loaded by this deck are reused instead of fetched,
+        and their definitions are loaded into the process cache up front.
+
+        @param card_ids: list of card ids
+        @return: A list of Card objects in the same order as card_ids
+        """
+        missing = [ card_id for card_id in card_ids
+                if card_id not in self._card_cache ]
+        if missing:
+            cards = self.cards.in_bulk(missing)
+            self._card_cache.update(cards)
+            CardDefinition.get_cached(
+                    [ card.definition_id for card in cards.values() ])
+        return [ self._card_cache[card_id] for card_id in card_ids ]
 
     def search_card(self, input_card, **kwargs):
         """
@@ -119,16 +480,15 @@ class Deck(CardUser):
         @param index: Remove card at index location, overrides top parameter
         @return: A card from the deck
         """
-        top = kwargs.get("top", True)
-        if kwargs.get("index"):
-            index = kwargs.get("index")
-        elif not top:
-            index = -1
-        else:
-            index = 0
-        card_id = self._card_list.pop(index)
-        card = self.cards.get(id=card_id)
-        self.cards.remove(card)
+        index = self._remove_index(**kwargs)
+
+        def remove():
+            card = self._remove(index)
+            card.save()
+            self._log("remove_card", self.pk, index, card.id)
+            return card
+
+        card = self._atomic(remove)
         if kwargs.get("save"):
             self.save()
         return card
@@ -141,12 +501,110 @@ class Deck(CardUser):
         """
         return [ self.remove_card(**kwargs) for cnt in range(num_cards) ]
 
+    def play_card(self, to_deck, **kwargs):
+        """
+        Move one card to another deck as a single move, the card is never
+        out of both decks
+
+        @param to_deck: Deck receiving the card
+        @param index: index of the card to move (default 0)
+        @param top: True: put the card on top of to_deck,
+            False: put it at the bottom (default True)
+        @return: the Card moved
+        """
+        index = kwargs.get("index", 0)
+
+        def play():
+            card = self._remove(index)
+            to_index = 0
+            if not kwargs.get("top", True):
+                to_index = len(to_deck._card_list)
+            to_deck._insert(card, to_index)
+            self._log("remove_card", self.pk, index, card.id)
+            self._log("insert_card", to_deck.pk, card.id, to_index)
+            return card
+
+        return self._atomic(play, to_deck)
+
+    def transfer_cards(self, to_deck, num_cards, **kwargs):
+        """
+        Move cards from the top of this deck to the top of another deck.
+        The resulting order is the same as calling remove_card and
+        insert_card once per card, but the cards are reassigned and
+        positioned with a single update.
+
+        @param to_deck: Deck receiving the cards
+        @param num_cards: number of cards to move
+        @raise ValueError: if num_cards is negative
+        """
+        if num_cards < 0:
+            raise ValueError("Cannot move %d cards" % num_cards)
+
+        def transfer():
+            if num_cards > self.length:
+                raise IndexError(
+                        "Cannot move %d cards from a deck of %d" %
+                        (num_cards, self.length))
+            card_ids = self._card_list[:num_cards]
+            if not card_ids:
+                return
+            del self._card_list[:num_cards]
+            if to_deck._card_list:
+                top = to_deck._positions[to_deck._card_list[0]]
+            else:
+                top = len(card_ids)
+            # The last card moved ends up on top of to_deck
+            positions = [ (card_id, top - cnt - 1)
+                    for cnt, card_id in enumerate(card_ids) ]
+            write_positions(positions, deck=to_deck, using=self._state.db)
+            self._invalidate_cards(card_ids)
+            to_deck._invalidate_cards(card_ids)
+            to_deck._card_list[0:0] = reversed(card_ids)
+            for card_id, position in positions:
+                del self._positions[card_id]
+                to_deck._positions[card_id] = position
+                card = self._card_cache.pop(card_id, None)
+                if card is not None:
+                    card.deck = to_deck
+                    card.position = position
+                    to_deck._card_cache[card_id] = card
+            self._log("transfer", self.pk, to_deck.pk, len(card_ids),
+                    card_ids)
+
+        self._atomic(transfer, to_deck)
+
     def shuffle(self, **kwargs):
         """
         Shuffle deck order
+
+        @param seed: seed of the shuffle, logged so it can be replayed
+            (default drawn from rng)
+        @param rng: random number generator used to draw the seed
+            (default the random module)
+        """
+        seed = kwargs.get("seed")
+        if seed is None:
+            seed = kwargs.get("rng", random).getrandbits(32)
+        def shuffle():
+            shuffle_order(self._card_list, seed)
+            self._write_order()
+            self._log("shuffle", self.pk, seed, True)
+
+        self._atomic(shuffle)
+
+    def _write_order(self):
+        """
+        Renumber and store the position of every card in the deck
         """
-        random.shuffle(self._card_list)
-        self.save()
+        positions = [ (card_id, position)
+                for position, card_id in enumerate(self._card_list) ]
+        write_positions(positions, using=self._state.db)
+        self._positions = dict(positions)
+        for card_id, position in positions:
+            card = self._card_cache.get(card_id)
+            if card is not None:
+                card.position = position
+        self._invalidate_cards(self._card_list)
 
     @property
     def card_list(self):
@@ -155,7 +613,11 @@ class Deck(CardUser):
 
         @return: A list of card objects in deck order
         """
-        return [ self.cards.get(id=card_id) for card_id in self._card_list ]
+        if self._order is None:
+            cards = list(self.cards.order_by("position"))
+            self._set_order(cards)
+            return cards
+        return self._resolve_cards(self._card_list)
 
     @property
     def length(self):
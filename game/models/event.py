@@ -0,0 +1,191 @@
+"""
+Module for the game event log
+
+Every move made on a Session or one of its decks is appended to the log
+as a GameEvent, so any point of a game can be rebuilt by replaying the
+events on top of the closest GameCheckpoint, see game.replay.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models import F
+from django.dispatch import Signal
+from picklefield.fields import PickledObjectField
+from game.models.session import Session
+import threading
+
+
+# Number of events between checkpoints
+CHECKPOINT_INTERVAL = getattr(settings, "GAME_CHECKPOINT_INTERVAL", 100)
+
+# Sent once new events are committed, with the list of GameEvents
+events_logged = Signal(providing_args=["session_id", "events"])
+
+
+class _Logging(threading.local):
+    """
+    Depth and database of the logging transactions open in the current
+    thread, the (session id, events) they logged, announced once they
+    commit, and the last event number they gave each session
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.using = None
+        self.pending = []
+        self.seqs = {}
+
+_logging = _Logging()
+
+
+@contextmanager
+def logging_transaction(using=DEFAULT_DB_ALIAS):
+    """
+    Run a move and the insert of its events in one transaction, so the
+    log never holds a move that was rolled back or misses one that was
+    written. A block nested in another logging transaction joins it and
+    leaves the commit to the outermost one. events_logged is only sent
+    for the events once the outermost transaction committed, and never
+    if it was rolled back.
+
+    @param using: alias of the database
+    """
+    if _logging.depth:
+        _logging.depth += 1
+        try:
+            yield
+        finally:
+            _logging.depth -= 1
+        return
+    _logging.depth = 1
+    _logging.using = using or DEFAULT_DB_ALIAS
+    try:
+        with transaction.commit_on_success(using=using):
+            yield
+        pending = _logging.pending
+    finally:
+        _logging.depth = 0
+        _logging.using = None
+        _logging.pending = []
+        _logging.seqs = {}
+    for session_id, events in pending:
+        events_logged.send(
+                sender=GameEvent, session_id=session_id, events=events)
+
+
+def _announce(session_id, events):
+    """
+    Send events_logged for new events, or leave it to the logging
+    transaction they were written in
+    """
+    if _logging.depth:
+        _logging.pending.append((session_id, events))
+    else:
+        events_logged.send(
+                sender=GameEvent, session_id=session_id, events=events)
+
+
+def _claim_seqs(session_id, count, using):
+    """
+    Take the next count event numbers of a session by bumping its
+    event_seq. The update locks the session row until the transaction
+    ends, so the events of a session commit in the order of their
+    numbers, which ids drawn from a shared sequence do not guarantee.
+
+    @return: first number taken
+    """
+    sessions = Session.objects.using(using).filter(pk=session_id)
+    sessions.update(event_seq=F("event_seq") + count)
+    key = (using, session_id)
+    # The row stays locked, so the number only moves with our updates
+    locked = _logging.depth and _logging.using == using
+    last = _logging.seqs.get(key) if locked else None
+    if last is None:
+        last = sessions.values_list("event_seq", flat=True)[0]
+    else:
+        last = last + count
+    if locked:
+        _logging.seqs[key] = last
+    return last - count + 1
+
+
+class GameEvent(models.Model):
+    """
+    A single move, events are only ever appended and are ordered by id.
+    seq numbers the events of each session in commit order, clients
+    catch up by it, see controller.delta. The log is written far more
+    often than it is read, so it is kept out of cache-machine.
+    """
+
+    session = models.ForeignKey(Session, related_name="events")
+    seq = models.PositiveIntegerField(default=0)
+    action = models.CharField(max_length=16)
+    args = PickledObjectField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "%s%r" % (self.action, tuple(self.args))
+
+    @classmethod
+    def log(cls, session_id, action, *args, **kwargs):
+        """
+        Append a move to the log with a single insert, call it inside the
+        transaction writing the move, see logging_transaction
+
+        @param session_id: id of the Session the move belongs to,
+            nothing is logged if it is None
+        @param action: name of the move, see game.replay.GameState
+        @param args: arguments needed to replay the move
+        @param using: alias of the database (default: "default")
+        @return: the new GameEvent
+        """
+        if session_id is None:
+            return None
+        using = kwargs.get("using", DEFAULT_DB_ALIAS)
+        event = cls.objects.using(using).create(session_id=session_id,
+                seq=_claim_seqs(session_id, 1, using), action=action,
+                args=list(args))
+        _announce(session_id, [event])
+        return event
+
+    @classmethod
+    def log_many(cls, session_id, events, **kwargs):
+        """
+        Append a batch of moves with a single bulk_create
+
+        @param session_id: id of the Session the moves belong to
+        @param events: list of unsaved GameEvents
+        @param using: alias of the database (default: "default")
+        """
+        if not events:
+            return
+        using = kwargs.get("using", DEFAULT_DB_ALIAS)
+        first = _claim_seqs(session_id, len(events), using)
+        for cnt, event in enumerate(events):
+            event.seq = first + cnt
+        cls.objects.using(using).bulk_create(events)
+        _announce(session_id, events)
+
+    class Meta:
+        """ Metadata class for GameEvent """
+        app_label = "game"
+        verbose_name = "Game event"
+        ordering = ("id",)
+
+
+class GameCheckpoint(models.Model):
+    """
+    Full game state as of an event, replay starts from the latest
+    checkpoint instead of the first event
+    """
+
+    session = models.ForeignKey(Session, related_name="checkpoints")
+    # Id of the last event folded into state, 0 if none
+    event_id = models.PositiveIntegerField(default=0, db_index=True)
+    state = PickledObjectField()
+
+    class Meta:
+        """ Metadata class for GameCheckpoint """
+        app_label = "game"
+        verbose_name = "Game checkpoint"
+        ordering = ("event_id",)
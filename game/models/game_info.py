@@ -1,9 +1,17 @@
 """
 Module containing the game info model
 """
+from django.core.cache import cache
 from django.db import models
+from django.db.models import signals
 from picklefield.fields import PickledObjectField
 import caching.base
+from game.models.cache import PolicyManager
+import time
+
+
+# Cache key of the version shared by every fragment rendered from GameInfo
+VERSION_KEY = "game_info:version"
 
 
 class GameInfo(caching.base.CachingMixin, models.Model):
@@ -15,10 +23,39 @@ class GameInfo(caching.base.CachingMixin, models.Model):
     ref = models.CharField(max_length=32, unique=True)
     desc = models.CharField(max_length=1024)
 
-    objects = caching.base.CachingManager()
+    objects = PolicyManager()
+
+    @classmethod
+    def cache_version(cls):
+        """
+        Version of the installed games, part of the key of every cached
+        fragment rendered from them. It changes whenever a GameInfo is
+        saved or deleted, so stale fragments are simply never read again.
+
+        @return: integer version
+        """
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            # Start from the clock so an evicted version is never reused
+            version = int(time.time())
+            cache.add(VERSION_KEY, version)
+        return version
 
     class Meta:
         """ Metadata class for GameInfo """
         app_label = "game"
         verbose_name = "Game information"
         verbose_name_plural = "Game information"
+
+
+def bump_cache_version(sender, **kwargs):
+    """
+    Retire every fragment rendered from the old games list
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, int(time.time()))
+
+signals.post_save.connect(bump_cache_version, sender=GameInfo)
+signals.post_delete.connect(bump_cache_version, sender=GameInfo)
@@ -21,7 +21,12 @@ class Player(DeckUser):
 
     def __init__(self, *args, **kwargs):
         super(Player, self).__init__(*args, **kwargs)
-        player_key = uuid.uuid4().hex
+        if not self.player_key:
+            self.player_key = uuid.uuid4().hex
+
+    @property
+    def game_session_id(self):
+        return self.session_id
 
     class Meta:
         """ Metadata class for Player """
@@ -0,0 +1,121 @@
+"""
+Polymorphic lookups for tables that are ForeignKey'd in place of their
+subclasses, e.g. DeckUser and CardUser
+"""
+from django.db.models.signals import class_prepared
+from game.models.cache import PolicyManager, PolicyQuerySet
+
+
+# Class path (e.g. "DeckUser.Session") to model class and back, filled in
+# as each model class is prepared
+_classes = {}
+_paths = {}
+
+
+def class_path(cls):
+    """
+    Build the dotted class path stored in the classname column by
+    following the multi-table inheritance chain up to the root model
+
+    @param cls: model class
+    @return: class path string, e.g. "CardUser.Deck"
+    """
+    path = _paths.get(cls)
+    if path is None:
+        names = [cls.__name__]
+        parent = cls
+        while parent._meta.parents:
+            parent = parent._meta.parents.keys()[0]
+            names.insert(0, parent.__name__)
+        path = ".".join(names)
+    return path
+
+
+def register_class(sender, **kwargs):
+    """
+    Record the class path of every polymorphic model as it is prepared
+    """
+    if not issubclass(sender, PolymorphicMixin):
+        return
+    if sender._deferred or sender._meta.proxy:
+        return
+    path = class_path(sender)
+    _classes[path] = sender
+    _paths[sender] = path
+
+class_prepared.connect(register_class)
+
+
+def resolve_classes(objects):
+    """
+    Swap each object for an instance of its concrete subclass, loading
+    every subclass with one query
+
+    @param objects: iterable of polymorphic model instances
+    @return: list of concrete instances in the same order
+    """
+    objects = list(objects)
+    by_class = {}
+    for obj in objects:
+        model = _classes.get(obj.classname)
+        if model is not None and model is not obj.__class__:
+            by_class.setdefault(model, []).append(obj.pk)
+    resolved = {}
+    for model, pks in by_class.items():
+        # Read each subclass from the database the objects came from
+        db = objects[0]._state.db
+        for pk, obj in model._default_manager.using(db).in_bulk(
+                pks).items():
+            resolved[pk] = obj
+    return [ resolved.get(obj.pk, obj) for obj in objects ]
+
+
+class PolymorphicQuerySet(PolicyQuerySet):
+    """
+    QuerySet able to turn its rows into their concrete subclasses
+    """
+
+    def resolve_classes(self):
+        """
+        @return: list of concrete instances in queryset order
+        """
+        return resolve_classes(self)
+
+
+class PolymorphicManager(PolicyManager):
+    """
+    Caching manager returning PolymorphicQuerySets
+    """
+
+    def get_query_set(self):
+        return PolymorphicQuerySet(self.model, using=self._db)
+
+    def resolve_classes(self):
+        return self.get_query_set().resolve_classes()
+
+
+class PolymorphicMixin(object):
+    """
+    Store the class path of a model in its classname column so rows read
+    from the root table can be mapped back to their subclass
+    """
+
+    def save(self, *args, **kwargs):
+        """
+        Overwrite the save function to save the class name for referencing
+        purposes.
+        """
+        if not self.classname:
+            self.classname = class_path(self.__class__)
+        super(PolymorphicMixin, self).save(*args, **kwargs)
+
+    def get_class(self):
+        """
+        Allow a user to query the root table and be able to find the
+        associated subclass with a single query
+        """
+        model = _classes.get(self.classname)
+        if model is None or isinstance(self, model):
+            return self
+        return model._default_manager.db_manager(self._state.db).get(
+                pk=self.pk)
@@ -1,13 +1,33 @@
 """
 Module for game models
 """
+from django.conf import settings
 from django.db import models
 from picklefield.fields import PickledObjectField
+from cStringIO import StringIO
 import caching.base
+from game.models.game_info import GameInfo
+from game.models.polymorphic import PolymorphicMixin, PolymorphicManager
 import random
 
 
-class DeckUser(caching.base.CachingMixin, models.Model):
+# Attempts at changing the seats of a contended session before giving up
+SEAT_RETRIES = getattr(settings, "GAME_SEAT_RETRIES", 20)
+
+# Session columns only written by _change_seats once the session exists
+SEAT_FIELDS = ("_player_list", "seats_taken", "joinable", "version")
+
+# Session columns only written by GameEvent.log once the session exists
+LOG_FIELDS = ("event_seq",)
+
+
+class SeatConflict(ValueError):
+    """
+    Raised when the seats of a session kept changing under a seat change
+    """
+
+
+class DeckUser(PolymorphicMixin, caching.base.CachingMixin, models.Model):
     """
     Class to get around the limitation that Deck can't be ForeignKey'd
     to either Session or Player
@@ -15,61 +35,40 @@ class DeckUser(caching.base.CachingMixin, models.Model):
 
     classname = models.CharField(max_length=64, editable=False, null=True)
 
-    objects = caching.base.CachingManager()
+    objects = PolymorphicManager()
 
     def __init__(self, *args, **kwargs):
         super(DeckUser, self).__init__(*args, **kwargs)
 
-    def add_deck(self, name):
+    def add_deck(self, name, **kwargs):
         """
         Add new deck to DeckUser
 
         @param name: name of deck to be added
+        @param catalog: CardCatalog to fill the deck from (optional),
+            see Deck.create_from_catalog for the other parameters
         @return: deck that was created
         """
         import game.models.deck as deck
 
+        if kwargs.get("catalog"):
+            return deck.Deck.create_from_catalog(self, name, **kwargs)
         deck = deck.Deck.objects.create(user=self, name=name)
         return deck
-
-    def save(self, *args, **kwargs):
-        """
-        Overwrite the save function to save the class name for referencing
-        purposes.
-        """
-        if not self.classname:
-            cur_class = self.__class__
-            class_str = cur_class.__name__
-            while cur_class.__name__ != "DeckUser":
-                cur_class = cur_class.__base__().__class__
-                class_str = "%s.%s" % (cur_class.__name__, class_str)
-            self.classname = class_str
-        super(DeckUser, self). save(*args, **kwargs)
-
-    def get_class(self):
-        """
-        Allow a user to query the main DeckUser table and be able to find
-        the associate subclass
-        """
-        if self.classname == self.__class__.__name__:
-            return self
-        ptr = self
-        for sub_class in self.classname.lower().split('.')[1:]:
-            ptr = ptr.__getattribute__(sub_class)
-        return ptr
     
     @classmethod
     def draw_cards(cls, from_deck, to_deck, **kwargs):
         """
         Streamline common operation of drawing cards
+
+        @param num_cards: number of cards to draw (default 1)
+        @param all: draw every card in from_deck
         """
         if kwargs.get("all"):
             num_cards = from_deck.length
         else:
             num_cards = kwargs.get("num_cards", 1)
-        for num in range(num_cards):
-            card = from_deck.remove_card()
-            to_deck.insert_card(card)
+        from_deck.transfer_cards(to_deck, num_cards)
 
     @property
     def deck_list(self):
@@ -80,17 +79,63 @@ class DeckUser(caching.base.CachingMixin, models.Model):
         """
         return { deck.name : deck for deck in self.decks.all() }
 
+    @property
+    def game_session_id(self):
+        """
+        Id of the Session whose event log records moves on this
+        DeckUser's decks, None if there is none
+        """
+        return None
+
     class Meta:
         """ Metadata class for DeckUser """
         app_label = "game"
         verbose_name = "Deck User"
 
 
+class SessionManager(models.Manager):
+    """
+    Manager answering lobby queries from the denormalized seat columns
+    """
+
+    def joinable(self, game=None):
+        """
+        @param game: GameInfo to restrict the sessions to (optional)
+        @return: queryset of sessions waiting for players with a free seat,
+            newest first
+        """
+        sessions = self.filter(joinable=True)
+        if game is not None:
+            sessions = sessions.filter(game=game)
+        return sessions.order_by("-deckuser_ptr")
+
+
 class Session(DeckUser):
     """
     Django model to store game state
+
+    seats_taken and joinable mirror the pickled player list and the status
+    so the lobby is read from an index (see sql/session.sql) instead of by
+    unpickling every session. Both are set on every save.
+
+    Joining, leaving and reseating players go through _change_seats, which
+    only writes the seats if the version column is unchanged since they
+    were read, so concurrent joins never overwrite each other. Each session
+    is locked on its own and no database lock is held between the read and
+    the write.
+
+    save() of an existing session is conditional on the version too and
+    bumps it, but leaves the seats alone unless they were changed with
+    save=False: a session loaded before a join can still advance the
+    phase without unseating the new player.
+
+    Moves are queued until the write that applies them and logged in the
+    same transaction, a move made with save=False is logged by the next
+    save.
     """
 
+    game = models.ForeignKey(GameInfo, null=True, blank=True,
+            related_name="sessions")
     name = models.CharField(max_length=64, blank=True)
     password = models.CharField(max_length=64, blank=True)
     turn = models.PositiveSmallIntegerField(default=0)
@@ -99,6 +144,13 @@ class Session(DeckUser):
     status = models.CharField(max_length=16, default="waiting")
     _player_list = PickledObjectField()
     phase_list = PickledObjectField()
+    seats_taken = models.PositiveSmallIntegerField(default=0, editable=False)
+    joinable = models.BooleanField(default=False, editable=False)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Number of the last event logged, see GameEvent.seq
+    event_seq = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = SessionManager()
 
     def __init__(self, *args, **kwargs):
         super(Session, self).__init__(*args, **kwargs)
@@ -106,6 +158,174 @@ class Session(DeckUser):
             self._player_list = []
         if not self.phase_list:
             self.phase_list = []
+        # True once the seats were changed in memory only, see save
+        self._seats_changed = False
+        # (action, args) of the moves not written yet, see _log
+        self._moves = []
+
+    def __reduce__(self):
+        """
+        Keep the resolved seats and the unwritten moves out of pickled
+        sessions, they are only valid for the instance that made them
+        """
+        unpickle, args, data = super(Session, self).__reduce__()
+        data = dict(data)
+        data.pop("_seated", None)
+        data["_moves"] = []
+        return (unpickle, args, data)
+
+    def _seat_columns(self, seats):
+        """
+        @return: (seats_taken, joinable) for a player list
+        """
+        seats_taken = len([ player_id for player_id in seats if player_id ])
+        return seats_taken, (self.status == "waiting" and
+                seats_taken < self.max_players)
+
+    def save(self, *args, **kwargs):
+        """
+        Insert a new session, or write every field of an existing one with
+        a single update conditional on the version. The seats are only
+        written if they were changed with save=False, otherwise a version
+        that moved is read again along with the seats and the update
+        retried, at most SEAT_RETRIES times. The queued moves are logged
+        in the same transaction.
+
+        @raise SeatConflict: if the seats were changed in memory and the
+            session changed since it was read, or if every attempt lost
+            against another write
+        """
+        import game.models.event as event
+        using = kwargs.get("using") or self._state.db
+        with event.logging_transaction(using=using):
+            self._save(*args, **kwargs)
+            self._write_moves(self._moves)
+            self._moves = []
+
+    def _save(self, *args, **kwargs):
+        """
+        Write the session row, see save
+        """
+        using = kwargs.get("using") or self._state.db
+        if self.pk is None or kwargs.get("force_insert"):
+            self._insert(*args, **kwargs)
+            return
+        fields = dict([ (field.name, getattr(self, field.attname))
+                for field in self._meta.local_fields
+                if not field.primary_key and field.name not in SEAT_FIELDS
+                and field.name not in LOG_FIELDS ])
+        seats_changed = getattr(self, "_seats_changed", False)
+        for attempt in range(SEAT_RETRIES):
+            seats_taken, joinable = self._seat_columns(self._player_list)
+            values = dict(fields, seats_taken=seats_taken, joinable=joinable,
+                    version=self.version + 1)
+            if seats_changed:
+                values["_player_list"] = self._player_list
+            if Session.objects.using(using).filter(
+                    pk=self.pk, version=self.version).update(**values):
+                self.seats_taken, self.joinable = seats_taken, joinable
+                self.version = self.version + 1
+                self._seats_changed = False
+                return
+            fresh = list(Session.objects.using(using).filter(pk=self.pk)[:1])
+            if not fresh:
+                self._insert(*args, **kwargs)
+                return
+            if seats_changed:
+                raise SeatConflict("Seats of session %d changed since they "
+                        "were read" % self.pk)
+            self._player_list = fresh[0]._player_list
+            self.version = fresh[0].version
+        raise SeatConflict(
+                "Session %d kept changing, try again" % self.pk)
+
+    def _insert(self, *args, **kwargs):
+        """
+        Save a session that has no row yet, seats included, along with a
+        checkpoint of its initial state for replay to start from
+        """
+        import game.replay as replay
+        self.seats_taken, self.joinable = self._seat_columns(self._player_list)
+        super(Session, self).save(*args, **kwargs)
+        self._seats_changed = False
+        replay.checkpoint(self, replay.GameState.initial(self))
+
+    def _reload_seats(self):
+        """
+        Read the seats and what they depend on back from the database
+        """
+        fresh = Session.objects.using(self._state.db).get(pk=self.pk)
+        for field in ("_player_list", "max_players", "status", "version"):
+            setattr(self, field, getattr(fresh, field))
+
+    def _change_seats(self, change, **kwargs):
+        """
+        Change the player list under an optimistic lock: the new seats are
+        written only if the version still matches, otherwise they are read
+        again and change is retried, at most SEAT_RETRIES times
+
+        @param change: function changing the player list it is given in
+            place and logging the move, it may raise ValueError to refuse
+            the change
+        @param save: write the change (default: True), the change is only
+            made in memory otherwise and written by the next save
+        @return: what change returned
+        @raise SeatConflict: if every attempt lost against another change
+        """
+        import game.models.event as event
+        if self.pk is None or not kwargs.get("save", True):
+            result = change(self._player_list)
+            self._seats_changed = True
+            if kwargs.get("save", True):
+                self.save()
+            return result
+        queued = len(self._moves)
+        for attempt in range(SEAT_RETRIES):
+            if attempt:
+                self._reload_seats()
+            # Only the move of the attempt that is written gets logged
+            del self._moves[queued:]
+            seats = list(self._player_list)
+            result = change(seats)
+            seats_taken, joinable = self._seat_columns(seats)
+            with event.logging_transaction(using=self._state.db):
+                if not Session.objects.using(self._state.db).filter(
+                        pk=self.pk, version=self.version).update(
+                        _player_list=seats, seats_taken=seats_taken,
+                        joinable=joinable, version=self.version + 1):
+                    continue
+                self._write_moves(self._moves[queued:])
+            del self._moves[queued:]
+            self._player_list = seats
+            self.seats_taken, self.joinable = seats_taken, joinable
+            self.version = self.version + 1
+            return result
+        del self._moves[queued:]
+        raise SeatConflict(
+                "Seats of session %d kept changing, try again" % self.pk)
+
+    @property
+    def game_session_id(self):
+        return self.pk
+
+    def _log(self, action, *args):
+        """
+        Queue a move for the event log, it is logged by the write that
+        applies it, see save and _change_seats
+        """
+        self._moves.append((action, args))
+
+    def _write_moves(self, moves):
+        """
+        Insert moves into the event log with a single bulk_create, inside
+        the transaction of the write they belong to
+
+        @param moves: list of (action, args)
+        """
+        import game.models.event as event
+        event.GameEvent.log_many(self.pk, [ event.GameEvent(
+                session_id=self.pk, action=action, args=list(args))
+                for action, args in moves ], using=self._state.db)
 
     def next_turn(self, **kwargs):
         """
@@ -114,6 +334,7 @@ class Session(DeckUser):
         @param save: Save model after advancing turn (default: True)
         """
         self.turn = self.turn + 1
+        self._log("next_turn")
         if kwargs.get("save", True):
             self.save()
 
@@ -126,7 +347,8 @@ class Session(DeckUser):
         self.phase = self.phase + 1
         if self.phase >= len(self.phase_list):
             self.phase = 0
-            self.next_turn(save=False)
+            self.turn = self.turn + 1
+        self._log("next_phase")
         if kwargs.get("save", True):
             self.save()
 
@@ -138,10 +360,12 @@ class Session(DeckUser):
 
     def current_player(self):
         """
-        Return the current player
+        Return the current player, resolved together with every other seat,
+        see player_list
+
+        @return: Player, None if the seat is empty
         """
-        player_id = self._player_list[self.turn % len(self._player_list)]
-        return self.players.get(id=player_id)
+        return self.player_list[self.turn % len(self._player_list)]
 
     def add_phase(self, phase_name, **kwargs):
         """
@@ -151,18 +375,21 @@ class Session(DeckUser):
         @param save: Save model after adding new player (default: True)
         """
         self.phase_list.append(phase_name)
+        self._log("add_phase", phase_name)
         if kwargs.get("save", True):
             self.save()
 
     def add_player(self, input_user, **kwargs):
         """
-        Add a new player to the game session
+        Add a new player to the game session, safe against concurrent
+        joins, see _change_seats
 
         @param input_user: UserProfile of the user who wants to be added to
             game session
         @param index: Index (seat number) for the player to be added
         @param save: Save model after adding new player (default: True)
         @return: Player object linked to UserProfile and Session.
+        @raise SeatConflict: if the seats kept changing under the join
         """
         import game.models.player as player
         if self.num_players >= self.max_players:
@@ -170,17 +397,26 @@ class Session(DeckUser):
         new_player = player.Player.objects.create(
                 user=input_user, session=self
                 )
-        if "index" in kwargs:
-            index = kwargs.get("index")
-            if self._player_list[index]:
-                raise ValueError(
-                        "Cannot add player, player already exists at seat %d" %
-                        index)
-        else:
-            index = len(self._player_list)
-        self._player_list.insert(index, new_player.id)
-        if kwargs.get("save", True):
-            self.save()
+
+        def seat(seats):
+            if len([ item for item in seats if item ]) >= self.max_players:
+                raise ValueError("Cannot add more than max players")
+            if "index" in kwargs:
+                index = kwargs.get("index")
+                if seats[index]:
+                    raise ValueError(
+                            "Cannot add player, player already exists at seat %d" %
+                            index)
+            else:
+                index = len(seats)
+            seats.insert(index, new_player.id)
+            self._log("add_player", new_player.id, index)
+
+        try:
+            self._change_seats(seat, **kwargs)
+        except ValueError:
+            new_player.delete()
+            raise
         return new_player
 
     def remove_player(self, **kwargs):
@@ -191,26 +427,38 @@ class Session(DeckUser):
         @param save: Save model after removing new player (default: True)
         @return: Player object removed
         """
-        if "index" in kwargs:
-            index = kwargs.get("index")
-            if not self._player_list[index]:
+        index = kwargs.get("index", -1)
+
+        def vacate(seats):
+            if "index" in kwargs and not seats[index]:
                 raise ValueError(
                         "Cannot remove player, player does not exists at seat %d" %
                         index)
-        else:
-            index = -1
-        rem_player = self.players.get(id=self._player_list[index])
-        self._player_list[index] = None
-        if kwargs.get("save", True):
-            self.save()
-        return rem_player
+            player_id = seats[index]
+            seats[index] = None
+            self._log("remove_player", index)
+            return player_id
+
+        return self.players.get(id=self._change_seats(vacate, **kwargs))
 
     def shuffle_players(self, **kwargs):
         """
         Shuffle player order
+
+        @param seed: seed of the shuffle, logged so it can be replayed
+            (default drawn from rng)
+        @param rng: random number generator used to draw the seed
+            (default the random module)
         """
-        random.shuffle(self._player_list)
-        self.save()
+        seed = kwargs.get("seed")
+        if seed is None:
+            seed = kwargs.get("rng", random).getrandbits(32)
+        def shuffle(seats):
+            # A new generator per attempt so a retry shuffles like the log
+            random.Random(seed).shuffle(seats)
+            self._log("shuffle_players", seed)
+
+        self._change_seats(shuffle)
 
     def swap_players(self, player_a, player_b, **kwargs):
         """
@@ -219,9 +467,66 @@ class Session(DeckUser):
         @param player_a: index of player to swap
         @param player_b: index of player to swap
         """
-        self._player_list[player_a], self._player_list[player_b] = (
-                self._player_list[player_b], self._player_list[player_a])
-        self.save()
+        def swap(seats):
+            seats[player_a], seats[player_b] = seats[player_b], seats[player_a]
+            self._log("swap_players", player_a, player_b)
+
+        self._change_seats(swap)
+
+    def invalidate_cache(self):
+        """
+        Flush the cached queries of this session's players, decks and
+        cards only, leaving every other game and the static data cached
+        """
+        import game.models.cache as cache
+        import game.models.card as card
+        import game.models.deck as deck
+        db = self._state.db
+        owners = [self.id] + list(self.players.values_list("id", flat=True))
+        deck_ids = list(deck.Deck.objects.filter(
+                user__in=owners).values_list("id", flat=True))
+        card_ids = list(card.Card.objects.filter(
+                deck__in=deck_ids).values_list("id", flat=True))
+        cache.invalidate_keys(DeckUser,
+                [ DeckUser._cache_key(pk, db) for pk in owners ])
+        cache.invalidate_keys(deck.Deck,
+                [ deck.Deck._cache_key(pk, db) for pk in deck_ids ] +
+                [ card.CardUser._cache_key(pk, db) for pk in deck_ids ])
+        cache.invalidate_keys(card.Card,
+                [ card.Card._cache_key(pk, db) for pk in card_ids ])
+
+    def snapshot(self, stream=None):
+        """
+        Serialize the whole game state into a compact binary snapshot,
+        see game.snapshot for the format
+
+        @param stream: file-like object to write to (optional)
+        @return: the snapshot as a string if no stream was given
+        """
+        import game.snapshot as snapshot
+        if stream is not None:
+            snapshot.dump(self, stream)
+            return
+        stream = StringIO()
+        snapshot.dump(self, stream)
+        return stream.getvalue()
+
+    @classmethod
+    def restore(cls, data, **kwargs):
+        """
+        Recreate a game from a snapshot as a new session
+
+        @param data: snapshot string or file-like object to read from
+        @param using: database alias to restore into (default "default")
+        @param keep_keys: keep the player keys of the snapshot, only to
+            move a session to another database (default False)
+        @return: the new Session
+        """
+        import game.snapshot as snapshot
+        if isinstance(data, basestring):
+            data = StringIO(data)
+        return snapshot.load(data, using=kwargs.get("using", "default"),
+                keep_keys=kwargs.get("keep_keys", False))
 
     @property
     def num_players(self):
@@ -239,17 +544,23 @@ class Session(DeckUser):
     @property
     def player_list(self):
         """
-        Present a full list of players in order
-
-        @return: A list of Player objects in order
-        """
-        p_list = []
-        for item in self._player_list:
-            if item:
-                p_list.append(self.players.get(id=item))
-            else:
-                p_list.append(None)
-        return p_list
+        Present a full list of players in order. Every seated Player is
+        loaded with its UserProfile and User in one query, which is kept
+        until the seating changes.
+
+        @return: A list of Player objects in order, None for empty seats
+        """
+        seating = tuple(self._player_list)
+        cached = getattr(self, "_seated", None)
+        if cached is None or cached[0] != seating:
+            players = self.players.select_related("user__user").in_bulk(
+                    [ player_id for player_id in seating if player_id ])
+            for player in players.values():
+                player.session = self
+            cached = (seating, [ players.get(player_id) if player_id else None
+                    for player_id in seating ])
+            self._seated = cached
+        return list(cached[1])
 
     class Meta:
         """ Metadata class for Player """
@@ -0,0 +1,2 @@
+-- Lobby listing, see SessionManager.joinable
+CREATE INDEX game_session_lobby ON game_session (game_id, joinable, deckuser_ptr_id);
@@ -4,6 +4,7 @@ Module for user models
 from django.contrib.auth.models import User
 from django.db import models
 import caching.base
+from game.models.cache import PolicyManager
 
 
 class UserProfile(caching.base.CachingMixin, models.Model):
@@ -13,7 +14,7 @@ class UserProfile(caching.base.CachingMixin, models.Model):
 
     user = models.OneToOneField(User, related_name="profile")
 
-    objects = caching.base.CachingManager()
+    objects = PolicyManager()
 
     def __init__(self, *args, **kwargs):
         super(UserProfile, self).__init__(*args, **kwargs)
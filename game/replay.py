@@ -0,0 +1,258 @@
+"""
+Rebuild a game from its event log
+
+GameState holds the turn, phase, seating and the card order of every deck
+as plain python values and knows how to apply each logged move. Replaying
+a session starts from its latest checkpoint at or before the requested
+event, at worst the one written when the session was created, and
+applies the events after it in id order. Shuffles are logged
+with the seed they used, so replaying one gives back the same order.
+"""
+from game.models.card import Card, UPDATE_CHUNK
+from game.models.deck import Deck, bump_revisions, shuffle_order
+from game.models.deck import write_positions
+from game.models.event import GameCheckpoint, CHECKPOINT_INTERVAL, \
+        logging_transaction
+import random
+
+
+class GameState(object):
+    """
+    Replayable state of a session
+    """
+
+    def __init__(self, state=None):
+        """
+        @param state: dict saved by a checkpoint (default an empty game)
+        """
+        state = state or {}
+        self.turn = state.get("turn", 0)
+        self.phase = state.get("phase", 0)
+        self.phase_list = list(state.get("phase_list", []))
+        self.player_list = list(state.get("player_list", []))
+        self.orders = dict([ (deck_id, list(order))
+                for deck_id, order in state.get("orders", {}).items() ])
+        self.event_id = state.get("event_id", 0)
+
+    @classmethod
+    def initial(cls, session):
+        """
+        Read the state of a session as it is created, before it has any
+        deck or logged move
+
+        @param session: new Session
+        @return: GameState
+        """
+        state = cls()
+        state.turn = session.turn
+        state.phase = session.phase
+        state.phase_list = list(session.phase_list)
+        state.player_list = list(session._player_list)
+        return state
+
+    @classmethod
+    def from_session(cls, session):
+        """
+        Read the current state of a session from the database it was
+        loaded from
+
+        @param session: Session to read
+        @return: GameState
+        """
+        using = session._state.db
+        state = cls()
+        state.turn = session.turn
+        state.phase = session.phase
+        state.phase_list = list(session.phase_list)
+        state.player_list = list(session._player_list)
+        owners = [session.id] + list(
+                session.players.values_list("id", flat=True))
+        state.orders = dict([ (deck_id, []) for deck_id in
+                Deck.objects.using(using).filter(user__in=owners).values_list(
+                    "id", flat=True) ])
+        rows = Card.objects.using(using).filter(
+                deck__in=state.orders.keys()).order_by(
+                "position").values_list("deck", "id")
+        for deck_id, card_id in rows:
+            state.orders[deck_id].append(card_id)
+        last = session.events.order_by("-id").values_list("id", flat=True)[:1]
+        state.event_id = last[0] if last else 0
+        return state
+
+    def to_dict(self):
+        """
+        @return: dict to store in a checkpoint
+        """
+        return {
+                "turn": self.turn,
+                "phase": self.phase,
+                "phase_list": list(self.phase_list),
+                "player_list": list(self.player_list),
+                "orders": dict([ (deck_id, list(order))
+                    for deck_id, order in self.orders.items() ]),
+                "event_id": self.event_id,
+                }
+
+    def apply(self, event):
+        """
+        Apply a logged move
+
+        @param event: GameEvent
+        """
+        handler = getattr(self, "_" + event.action, None)
+        if handler is None:
+            raise ValueError("Unknown game event %s" % event.action)
+        handler(*event.args)
+        self.event_id = event.id
+
+    def _order(self, deck_id):
+        return self.orders.setdefault(deck_id, [])
+
+    def _next_turn(self):
+        self.turn = self.turn + 1
+
+    def _next_phase(self):
+        self.phase = self.phase + 1
+        if self.phase >= len(self.phase_list):
+            self.phase = 0
+            self.turn = self.turn + 1
+
+    def _add_phase(self, phase_name):
+        self.phase_list.append(phase_name)
+
+    def _add_player(self, player_id, index):
+        self.player_list.insert(index, player_id)
+
+    def _remove_player(self, index):
+        self.player_list[index] = None
+
+    def _shuffle_players(self, seed):
+        random.Random(seed).shuffle(self.player_list)
+
+    def _swap_players(self, player_a, player_b):
+        self.player_list[player_a], self.player_list[player_b] = (
+                self.player_list[player_b], self.player_list[player_a])
+
+    def _fill(self, deck_id, card_ids):
+        self.orders[deck_id] = list(card_ids)
+
+    def _insert_card(self, deck_id, card_id, index):
+        self._order(deck_id).insert(index, card_id)
+
+    def _remove_card(self, deck_id, index, card_id=None):
+        # Removals logged before card ids were only knew the index
+        if card_id is None:
+            self._order(deck_id).pop(index)
+        else:
+            self._order(deck_id).remove(card_id)
+
+    def _transfer(self, from_id, to_id, num_cards, card_ids=None):
+        from_order = self._order(from_id)
+        if card_ids is None:
+            drawn = from_order[:num_cards]
+            del from_order[:num_cards]
+        else:
+            drawn = list(card_ids)
+            taken = set(drawn)
+            from_order[:] = [ card_id for card_id in from_order
+                    if card_id not in taken ]
+        drawn.reverse()
+        self._order(to_id)[0:0] = drawn
+
+    def _shuffle(self, deck_id, seed, top_first=False):
+        # Shuffles logged before shuffle_order used random.shuffle
+        if top_first:
+            shuffle_order(self._order(deck_id), seed)
+        else:
+            random.Random(seed).shuffle(self._order(deck_id))
+
+
+def checkpoint(session, state=None):
+    """
+    Store a checkpoint of a session in the database it was loaded from
+
+    @param session: Session to checkpoint
+    @param state: GameState to store (default the current database state)
+    @return: the new GameCheckpoint
+    """
+    if state is None:
+        state = GameState.from_session(session)
+    return GameCheckpoint.objects.using(session._state.db).create(
+            session=session, event_id=state.event_id, state=state.to_dict())
+
+
+def replay(session, until=None, **kwargs):
+    """
+    Rebuild the state of a session as of an event
+
+    @param session: Session to replay
+    @param until: id of the last event to apply (default every event)
+    @param save_checkpoint: store a checkpoint if more than
+        CHECKPOINT_INTERVAL events had to be replayed (default True)
+    @return: GameState
+    """
+    # A restored session has its initial and restored checkpoints at 0
+    checkpoints = session.checkpoints.order_by("-event_id", "-id")
+    events = session.events.order_by("id")
+    if until is not None:
+        checkpoints = checkpoints.filter(event_id__lte=until)
+        events = events.filter(id__lte=until)
+    checkpoints = list(checkpoints[:1])
+    state = GameState(checkpoints[0].state if checkpoints else None)
+    cnt = 0
+    for event in events.filter(id__gt=state.event_id):
+        state.apply(event)
+        cnt = cnt + 1
+    if cnt > CHECKPOINT_INTERVAL and kwargs.get("save_checkpoint", True):
+        checkpoint(session, state)
+    return state
+
+
+def recover(session, until=None):
+    """
+    Write the replayed state of a session back to the database, e.g. to
+    undo moves or repair a session after a failed write
+
+    @param session: Session to recover
+    @param until: id of the last event to keep (default every event)
+    @return: GameState written
+    """
+    with logging_transaction(using=session._state.db):
+        state = replay(session, until)
+        session.turn = state.turn
+        session.phase = state.phase
+        session.phase_list = list(state.phase_list)
+        session.save()
+
+        def reseat(seats):
+            seats[:] = state.player_list
+        session._change_seats(reseat)
+        using = session._state.db
+        decks = Deck.objects.using(using).in_bulk(state.orders.keys())
+        kept = set()
+        for deck_id, order in state.orders.items():
+            deck = decks.get(deck_id)
+            if deck is None:
+                continue
+            write_positions([ (card_id, position)
+                    for position, card_id in enumerate(order) ],
+                    deck=deck, using=deck._state.db)
+            kept.update(order)
+        # Cards removed since the replayed point are taken out of their deck
+        stray = {}
+        for deck_id, card_id in Card.objects.using(using).filter(
+                deck__in=decks.keys()).values_list("deck", "id"):
+            if card_id not in kept:
+                stray.setdefault(deck_id, []).append(card_id)
+        for deck in decks.values():
+            removed = stray.get(deck.id, [])
+            for start in range(0, len(removed), UPDATE_CHUNK):
+                Card.objects.using(using).filter(
+                        id__in=removed[start:start + UPDATE_CHUNK]).update(
+                        deck=None, position=None)
+            deck._invalidate_cards(state.orders[deck.id] + removed)
+            deck._reset_order()
+        bump_revisions(decks.keys(), using=using)
+        # Later replays start from the recovered state
+        checkpoint(session)
+        return state
@@ -0,0 +1,260 @@
+"""
+Headless game simulator for load generation
+
+Sets games up and plays randomized turns through the model API, the way
+clients would without browsers: each turn reloads its session, the
+current player draws from the pile, which is shuffled back from the
+discard pile when empty, plays a card and the session moves on to the
+next phase twice. Run it with: manage.py simulate
+
+Turns of all the games are interleaved over a pool of threads or
+processes. Every action is timed and failures are sorted into conflicts
+(a move which lost every retry, see Deck._atomic), database lock
+timeouts and other errors. Retries of contended moves are counted too.
+"""
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, transaction
+from game.models.card import Card, CardDefinition
+from game.models.deck import Deck, DeckConflict
+from game.models.session import DeckUser, SeatConflict, Session
+from game.models.user import UserProfile
+import functools
+import random
+import threading
+import time
+
+
+PLAYERS = 4
+HAND = 5
+PHASES = ("Draw", "Play")
+ACTIONS = ("draw_cards", "shuffle", "play_card", "next_phase")
+
+
+def create_cards(size, label):
+    """
+    Create size loose cards sharing one definition
+
+    @return: list of Card
+    """
+    definition = CardDefinition.objects.create(name="%s %d" % (label, size))
+    Card.objects.bulk_create([ Card(definition=definition)
+        for cnt in xrange(size) ])
+    return list(Card.objects.filter(definition=definition).order_by("id"))
+
+
+def create_profiles(count, label):
+    """
+    @return: list of count new UserProfile
+    """
+    return [ UserProfile.objects.create(user=User.objects.create(
+            username="%s-%d" % (label, cnt))) for cnt in xrange(count) ]
+
+
+def setup_game(size, label, **kwargs):
+    """
+    Seat players in a new session and deal them HAND cards each from a
+    shuffled pile of size cards
+
+    @param players: number of players (default PLAYERS)
+    @param seed: seed of the pile shuffle (default 0)
+    @return: the Session, with the "pile" and "discard" decks and a "hand"
+        deck per player
+    """
+    players = kwargs.get("players", PLAYERS)
+    session = Session.objects.create(name=label, max_players=players)
+    for phase in PHASES:
+        session.add_phase(phase)
+    pile = session.add_deck("pile")
+    session.add_deck("discard")
+    pile.insert_cards(create_cards(size, label))
+    pile.shuffle(seed=kwargs.get("seed", 0))
+    for profile in create_profiles(players, label):
+        hand = session.add_player(profile).add_deck("hand")
+        DeckUser.draw_cards(pile, hand, num_cards=min(HAND, pile.length))
+    return session
+
+
+def _untimed(action, func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def play_turn(session, rng, step=_untimed):
+    """
+    Play a turn of session, see the module documentation
+
+    @param rng: random.Random deciding which card is played
+    @param step: function called as step(action, func, *args, **kwargs)
+        to run each action, e.g. to time it (default just calls func)
+    """
+    decks = session.deck_list
+    pile, discard = decks["pile"], decks["discard"]
+    hand = session.current_player().deck_list["hand"]
+    if not pile.length and discard.length:
+        step("draw_cards", DeckUser.draw_cards, discard, pile, all=True)
+        step("shuffle", pile.shuffle, rng=rng)
+    if pile.length:
+        step("draw_cards", DeckUser.draw_cards, pile, hand)
+    step("next_phase", session.next_phase)
+    if hand.length:
+        step("play_card", hand.play_card, discard,
+                index=rng.randrange(hand.length))
+    step("next_phase", session.next_phase)
+
+
+class _Retries(threading.local):
+    """
+    Moves and seat changes retried by the current thread
+    """
+
+    def __init__(self):
+        self.count = 0
+
+_retries = _Retries()
+
+
+def count_retries():
+    """
+    Count every retry of Deck._atomic and Session._change_seats, which
+    reload the changed rows before each retry, in the current process
+
+    @return: function undoing the patch
+    """
+    originals = [(Deck, "_reload", Deck.__dict__["_reload"]),
+            (Session, "_reload_seats", Session.__dict__["_reload_seats"])]
+
+    def counting(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _retries.count += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    for owner, name, func in originals:
+        setattr(owner, name, counting(func))
+
+    def restore():
+        for owner, name, func in originals:
+            setattr(owner, name, func)
+    return restore
+
+
+def percentile(values, fraction):
+    """
+    @param values: sorted list of numbers
+    @param fraction: 0.5 for the median, 0.99 for the 99th percentile
+    @return: nearest-rank percentile of values, None if empty
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_turn(task):
+    """
+    Play one turn, the unit of work of the pool
+
+    @param task: (session id, seed of the turn)
+    @return: dict with the (action, seconds) of every action which
+        succeeded, the retries, and the kind of failure ("conflict",
+        "locked" or "error") if the turn was cut short, else None
+    """
+    session_id, seed = task
+    retries = _retries.count
+    timings = []
+
+    def step(action, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        timings.append((action, time.time() - start))
+        return result
+
+    failure = None
+    try:
+        play_turn(Session.objects.get(id=session_id), random.Random(seed),
+                step)
+    except (DeckConflict, SeatConflict):
+        failure = "conflict"
+    except DatabaseError, error:
+        failure = "locked" if "locked" in str(error) else "error"
+    except Exception:
+        # e.g. a card played from a hand another turn just emptied
+        failure = "error"
+    if failure:
+        transaction.rollback_unless_managed()
+    return {
+            "timings": timings,
+            "retries": _retries.count - retries,
+            "failure": failure,
+            }
+
+
+def _process_init():
+    """
+    Give each pool process a database connection of its own
+    """
+    connection.close()
+    count_retries()
+
+
+def simulate(session_ids, turns, **kwargs):
+    """
+    Play turns turns of every session over a worker pool
+
+    @param session_ids: ids of sessions set up with setup_game
+    @param turns: number of turns per session
+    @param workers: size of the pool (default 8)
+    @param processes: use processes rather than threads (default False)
+    @param seed: seed of the turns (default 0)
+    @return: report dict with the wall time, the turns and actions per
+        second, per action the calls and p50/p99 latency in seconds, and
+        the retries, conflicts, locked and failed turns
+    """
+    workers = kwargs.get("workers", 8)
+    rng = random.Random(kwargs.get("seed", 0))
+    # Round robin over the games so every game has turns in flight
+    tasks = [ (session_id, rng.getrandbits(32))
+        for turn in xrange(turns) for session_id in session_ids ]
+    if kwargs.get("processes"):
+        from multiprocessing import Pool
+        connection.close()
+        pool = Pool(workers, _process_init)
+        restore = lambda: None
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        restore = count_retries()
+    start = time.time()
+    try:
+        results = pool.map(run_turn, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        restore()
+    seconds = time.time() - start
+    latencies = dict([ (action, []) for action in ACTIONS ])
+    failures = {"conflict": 0, "locked": 0, "error": 0}
+    for result in results:
+        for action, elapsed in result["timings"]:
+            latencies[action].append(elapsed)
+        if result["failure"]:
+            failures[result["failure"]] += 1
+    actions = {}
+    for action, values in latencies.items():
+        values.sort()
+        actions[action] = {
+                "calls": len(values),
+                "p50": percentile(values, 0.5),
+                "p99": percentile(values, 0.99),
+                }
+    total = sum([ len(values) for values in latencies.values() ])
+    return {
+            "seconds": seconds,
+            "turns": len(tasks),
+            "turns_per_sec": len(tasks) / seconds if seconds else None,
+            "actions_per_sec": total / seconds if seconds else None,
+            "actions": actions,
+            "retries": sum([ result["retries"] for result in results ]),
+            "conflicts": failures["conflict"],
+            "locked": failures["locked"],
+            "errors": failures["error"],
+            }
@@ -0,0 +1,210 @@
+"""
+Compact binary snapshots of a whole Session
+
+A snapshot holds the session fields, its players and seating, and every
+deck owned by the session or its players with the definition of each card
+in deck order. It is written with struct, little-endian, as:
+
+    header   "MCSS", version (H)
+    session  name, password, status (str), game id (I, 0 for none),
+             turn (I), phase (H), max_players (H),
+             phase_list (H count + str each),
+             seats (H count + i each, player index or -1 for an empty seat)
+    players  H count, then user id (I) and player_key (str) each
+    decks    H count, then owner (h, player index or -1 for the session),
+             name (str), show_prop (str, empty for None) and the card
+             definition ids (I count + I each, top first)
+
+where str is an H byte length followed by utf-8. Snapshots are read and
+written through file-like objects, so they can be streamed to disk.
+Version 1 snapshots, written before sessions had a game, have no game id
+and are restored without one. Restored players get new keys, so a key of
+the original session never works on the copy, unless the session is being
+moved to another database with keep_keys.
+"""
+from django.db import DEFAULT_DB_ALIAS
+from game.models.card import Card
+from game.models.deck import Deck
+from game.models.event import logging_transaction
+from game.models.player import Player
+from game.models.session import Session
+from game.replay import checkpoint
+import struct
+
+
+MAGIC = "MCSS"
+VERSION = 2
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when a stream is not a snapshot this version can read
+    """
+
+
+class _Writer(object):
+    """
+    Pack values onto a file-like object
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def pack(self, fmt, *values):
+        self.stream.write(struct.pack("<" + fmt, *values))
+
+    def string(self, value):
+        data = (value or u"").encode("utf-8")
+        self.pack("H", len(data))
+        self.stream.write(data)
+
+    def array(self, fmt, values):
+        self.pack("I", len(values))
+        self.pack("%d%s" % (len(values), fmt), *values)
+
+
+class _Reader(object):
+    """
+    Unpack values from a file-like object
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise SnapshotError("Snapshot is truncated")
+        return data
+
+    def unpack(self, fmt):
+        fmt = "<" + fmt
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def string(self):
+        size, = self.unpack("H")
+        return self.read(size).decode("utf-8")
+
+    def array(self, fmt):
+        size, = self.unpack("I")
+        return list(self.unpack("%d%s" % (size, fmt)))
+
+
+def dump(session, stream):
+    """
+    Write a snapshot of session to stream
+
+    @param session: Session to snapshot
+    @param stream: file-like object opened for binary writing
+    """
+    players = list(session.players.order_by("id"))
+    index = dict([ (player.id, cnt) for cnt, player in enumerate(players) ])
+    owners = dict(index)
+    owners[session.id] = -1
+    decks = list(Deck.objects.filter(user__in=owners.keys()).order_by("id"))
+    orders = dict([ (deck.id, []) for deck in decks ])
+    for deck_id, def_id in Card.objects.filter(
+            deck__in=orders.keys()).order_by(
+            "position").values_list("deck", "definition"):
+        orders[deck_id].append(def_id)
+
+    out = _Writer(stream)
+    stream.write(MAGIC)
+    out.pack("H", VERSION)
+    out.string(session.name)
+    out.string(session.password)
+    out.string(session.status)
+    out.pack("I", session.game_id or 0)
+    out.pack("IHH", session.turn, session.phase, session.max_players)
+    out.pack("H", len(session.phase_list))
+    for phase in session.phase_list:
+        out.string(phase)
+    seats = [ index[player_id] if player_id else -1
+            for player_id in session._player_list ]
+    out.pack("H", len(seats))
+    out.pack("%di" % len(seats), *seats)
+    out.pack("H", len(players))
+    for player in players:
+        out.pack("I", player.user_id)
+        out.string(player.player_key)
+    out.pack("H", len(decks))
+    for deck in decks:
+        out.pack("h", owners[deck.user_id])
+        out.string(deck.name)
+        out.string(deck.show_prop)
+        out.array("I", orders[deck.id])
+
+
+def _create(state, using, keep_keys):
+    """
+    Create the session, players, decks and cards described by state, in
+    one transaction on the using database, with new player keys unless
+    keep_keys
+    """
+    with logging_transaction(using=using):
+        session = Session(**state["session"])
+        session.save(using=using)
+        players = [ Player.objects.using(using).create(session=session,
+                user_id=user_id, player_key=player_key if keep_keys else "")
+            for user_id, player_key in state["players"] ]
+        seats = [ players[seat].id if seat >= 0 else None
+                for seat in state["seats"] ]
+
+        def seat(current):
+            current[:] = seats
+        session._change_seats(seat)
+        cards = []
+        for owner, name, show_prop, def_ids in state["decks"]:
+            deck = Deck.objects.using(using).create(
+                    user=players[owner] if owner >= 0 else session,
+                    name=name, show_prop=show_prop or None)
+            cards.extend([ Card(deck=deck, definition_id=def_id,
+                    position=position)
+                for position, def_id in enumerate(def_ids) ])
+        Card.objects.using(using).bulk_create(cards)
+        # The new session has no event log to replay, start it from here
+        checkpoint(session)
+        return session
+
+
+def load(stream, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Read a snapshot from stream and recreate it as a new Session. The
+    cards of every deck are inserted with a single bulk_create.
+
+    @param stream: file-like object opened for binary reading
+    @param using: database alias to restore into
+    @param keep_keys: keep the player keys of the snapshot, only to move
+        a session to another database (default False)
+    @return: the new Session
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not a session snapshot")
+    reader = _Reader(stream)
+    version, = reader.unpack("H")
+    if version not in (1, VERSION):
+        raise SnapshotError("Unsupported snapshot version %d" % version)
+    state = {"session": {}}
+    for field in ("name", "password", "status"):
+        state["session"][field] = reader.string()
+    if version >= 2:
+        game_id, = reader.unpack("I")
+        state["session"]["game_id"] = game_id or None
+    turn, phase, max_players = reader.unpack("IHH")
+    state["session"].update(turn=turn, phase=phase, max_players=max_players)
+    size, = reader.unpack("H")
+    state["session"]["phase_list"] = [ reader.string() for cnt in range(size) ]
+    size, = reader.unpack("H")
+    state["seats"] = list(reader.unpack("%di" % size))
+    size, = reader.unpack("H")
+    state["players"] = []
+    for cnt in range(size):
+        user_id, = reader.unpack("I")
+        state["players"].append((user_id, reader.string()))
+    size, = reader.unpack("H")
+    state["decks"] = []
+    for cnt in range(size):
+        owner, = reader.unpack("h")
+        state["decks"].append(
+                (owner, reader.string(), reader.string(), reader.array("I")))
+    return _create(state, using, kwargs.get("keep_keys", False))
@@ -4,3 +4,16 @@ Unit testing for the app
 from game.tests.deck import *
 from game.tests.card import *
 from game.tests.session import *
+from game.tests.engine import *
+from game.tests.event import *
+from game.tests.push import *
+from game.tests.actions import *
+from game.tests.delta import *
+from game.tests.cache import *
+from game.tests.views import *
+from game.tests.lobby import *
+from game.tests.order import *
+from game.tests.schema import *
+from game.tests.graph import *
+from game.tests.instrument import *
+from game.tests.simulator import *
@@ -0,0 +1,169 @@
+"""
+JSON action API unit testing
+"""
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+from game.models.deck import Deck
+from game.models.session import Session
+from game.models.user import UserProfile
+from game.tests.card import create_card
+from game.views import session_actions
+import json
+
+
+class SessionActionsTestCase(TestCase):
+    """
+    Test applying batches of actions through the view
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=2)
+        for phase in ["Draw", "Play"]:
+            self.session.add_phase(phase)
+        self.players = []
+        self.hands = []
+        for name in ["Nagato Yuki", "Asahina Mikuru"]:
+            test_user = User.objects.create(username=name)
+            player = self.session.add_player(
+                    UserProfile.objects.create(user=test_user))
+            self.players.append(player)
+            self.hands.append(player.add_deck("hand"))
+        self.pile = self.session.add_deck("pile")
+        self.pile.insert_cards([ create_card("SOS %d" % cnt)
+            for cnt in range(10) ])
+        self.discard = self.session.add_deck("discard")
+        self.discard.show_prop = "top"
+        self.discard.save()
+        self.factory = RequestFactory()
+
+    def post(self, player, actions):
+        request = self.factory.post("/", json.dumps({
+                "player_key": player.player_key, "actions": actions}),
+                content_type="application/json")
+        response = session_actions(request, str(self.session.id))
+        return response.status_code, json.loads(response.content)
+
+    def names(self, deck):
+        return [ card.name for card in Deck.objects.get(id=deck.id).card_list ]
+
+    def test_batch(self):
+        """
+        Check a whole turn is applied and answered with its delta
+        """
+        top = self.names(self.pile)[:3]
+        status, delta = self.post(self.players[0], [
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id, "count": 3},
+                {"action": "play", "from": self.hands[0].id,
+                    "to": self.discard.id},
+                {"action": "end_phase"},
+                ])
+        self.assertEqual(status, 200)
+        self.assertEqual(delta["phase"], 1)
+        self.assertEqual(sorted(delta["decks"].keys()), sorted(
+                [ str(deck.id) for deck in
+                    (self.pile, self.hands[0], self.discard) ]))
+        self.assertEqual(delta["decks"][str(self.pile.id)],
+                {"name": "pile", "length": 7})
+        self.assertEqual(delta["revision"],
+                self.session.events.order_by("-id")[0].id)
+        self.assertEqual(
+                [ card["name"] for card in
+                    delta["decks"][str(self.hands[0].id)]["cards"] ],
+                top[1::-1])
+        self.assertEqual(delta["decks"][str(self.discard.id)]["cards"][0]
+                ["name"], top[2])
+        self.assertEqual(self.names(self.hands[0]), top[1::-1])
+        self.assertEqual(self.names(self.discard), top[2:])
+        self.assertEqual(Session.objects.get(id=self.session.id).phase, 1)
+
+    def test_visibility(self):
+        """
+        Check other players' hands only show their size
+        """
+        status, delta = self.post(self.players[1], [
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id, "count": 2},
+                ])
+        self.assertEqual(status, 200)
+        self.assertEqual(delta["decks"][str(self.hands[0].id)],
+                {"name": "hand", "length": 2})
+
+    def test_atomic(self):
+        """
+        Check a failing action leaves the whole batch unapplied
+        """
+        before = self.names(self.pile)
+        status, data = self.post(self.players[0], [
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id, "count": 3},
+                {"action": "shuffle", "deck": self.hands[1].id},
+                ])
+        self.assertEqual(status, 400)
+        self.assertTrue("another player" in data["error"])
+        self.assertEqual(self.names(self.pile), before)
+        self.assertEqual(self.names(self.hands[0]), [])
+        status, delta = self.post(self.players[0], [
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id},
+                ])
+        self.assertEqual(delta["decks"][str(self.pile.id)]["length"], 9)
+
+    def test_errors(self):
+        """
+        Check bad keys, actions and turns are rejected
+        """
+        request = self.factory.post("/", json.dumps({
+                "player_key": "nobody", "actions": []}),
+                content_type="application/json")
+        self.assertEqual(
+                session_actions(request, str(self.session.id)).status_code,
+                403)
+        for actions in ([{"action": "fly"}],
+                [{"action": "end_phase"}],
+                [{"action": "draw", "from": self.pile.id,
+                    "to": self.hands[1].id, "count": 11}],
+                "draw"):
+            status, data = self.post(self.players[1], actions)
+            self.assertEqual(status, 400)
+            self.assertTrue(data["error"])
+
+    def test_bad_count(self):
+        """
+        Check draws of anything but a non-negative whole count are
+        rejected without moving a card
+        """
+        before = self.names(self.pile)
+        for count in (-2, "2", 1.5, True, None):
+            status, data = self.post(self.players[0], [
+                    {"action": "draw", "from": self.pile.id,
+                        "to": self.hands[0].id, "count": count},
+                    ])
+            self.assertEqual(status, 400)
+            self.assertTrue("count" in data["error"])
+        self.assertEqual(self.names(self.pile), before)
+        self.assertEqual(self.names(self.hands[0]), [])
+
+    def test_fresh_engine(self):
+        """
+        Check every request sees the decks and cards as they are now
+        """
+        status, delta = self.post(self.players[0], [
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id},
+                ])
+        self.assertEqual(status, 200)
+        market = self.session.add_deck("market")
+        market.insert_card(create_card("Koizumi Itsuki"))
+        Deck.objects.get(id=self.pile.id).play_card(self.hands[1])
+        status, delta = self.post(self.players[0], [
+                {"action": "draw", "from": market.id,
+                    "to": self.hands[0].id},
+                {"action": "draw", "from": self.pile.id,
+                    "to": self.hands[0].id},
+                ])
+        self.assertEqual(status, 200)
+        self.assertEqual(delta["decks"][str(self.pile.id)]["length"], 7)
+        self.assertEqual(len(self.names(self.hands[0])), 3)
+        self.assertEqual(len(self.names(self.hands[1])), 1)
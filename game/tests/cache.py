@@ -0,0 +1,95 @@
+"""
+Cache policy unit testing
+"""
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from game.models.cache import get_timeout, stats, FOREVER_TIMEOUT
+from game.models.card import Card
+from game.models.deck import Deck
+from game.models.game_info import GameInfo
+from game.models.session import Session
+from game.tests.card import create_card
+from game.views import cache_stats_view
+import caching.base
+
+
+class CachePolicyTestCase(TestCase):
+    """
+    Test per-model cache policies and counters
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.game = GameInfo.objects.create(
+                name="Carta de Amor", ref="CartaDeAmor", desc="Love letters")
+        stats.reset()
+
+    def test_timeouts(self):
+        """
+        Check the default policies
+        """
+        self.assertEqual(get_timeout(Card), caching.base.NO_CACHE)
+        self.assertEqual(get_timeout(GameInfo), FOREVER_TIMEOUT)
+        self.assertEqual(get_timeout(Deck), None)
+
+    def test_never(self):
+        """
+        Check uncached models always query and skip invalidation
+        """
+        card = create_card("Princess")
+        for cnt in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(Card.objects.get(id=card.id), card)
+        card.save()
+        self.assertFalse("Card" in stats.snapshot())
+
+    def test_forever(self):
+        """
+        Check static data stays cached until it is saved
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(list(GameInfo.objects.all()), [self.game])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(GameInfo.objects.all()), [self.game])
+        self.game.desc = "Love letters and princesses"
+        self.game.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(GameInfo.objects.get().desc, self.game.desc)
+        self.assertEqual(stats.snapshot()["GameInfo"],
+                {"hits": 1, "misses": 2, "invalidations": 1})
+
+    def test_session_scope(self):
+        """
+        Check invalidating a session leaves other games cached
+        """
+        sessions = []
+        for cnt in range(2):
+            session = Session.objects.create(max_players=1)
+            session.add_deck("pile").insert_card(create_card("Guard"))
+            sessions.append(session)
+        for session in sessions:
+            list(Deck.objects.filter(user=session))
+        list(GameInfo.objects.all())
+        sessions[0].invalidate_cache()
+        with self.assertNumQueries(1):
+            list(Deck.objects.filter(user=sessions[0]))
+        with self.assertNumQueries(0):
+            list(Deck.objects.filter(user=sessions[1]))
+            list(GameInfo.objects.all())
+
+    def test_stats_view(self):
+        """
+        Check the counters can be scraped from internal addresses only
+        """
+        list(GameInfo.objects.all())
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1")
+        request.user = AnonymousUser()
+        self.assertEqual(cache_stats_view(request).status_code, 403)
+        with override_settings(INTERNAL_IPS=("10.0.0.1",)):
+            response = cache_stats_view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+                'game_cache_misses{model="GameInfo"} 1\n' in response.content)
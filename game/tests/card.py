@@ -1,10 +1,25 @@
 """
 Card models unit testing
 """
-from game.models.card import CardUser, CardCatalog, Card
+from game.management import schema
+from game.models.card import CardUser, CardCatalog, CardDefinition, Card, \
+        DEFINITION_VERSION_KEY
 from game.models.deck import Deck
 from game.models.session import Session
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from StringIO import StringIO
+import types
+
+
+def create_card(name, **kwargs):
+    """
+    Create a card along with a definition of its own
+    """
+    definition = CardDefinition.objects.create(name=name)
+    return Card.objects.create(definition=definition, **kwargs)
 
 
 class CardTestCase(TestCase):
@@ -13,7 +28,7 @@ class CardTestCase(TestCase):
     """
 
     def setUp(self):
-        self.card = Card.objects.create(name="Shiina Minatsu")
+        self.card = create_card("Shiina Minatsu")
 
     def test_repr(self):
         """
@@ -22,11 +37,101 @@ class CardTestCase(TestCase):
         self.assertEqual(self.card.__unicode__(), "Shiina Minatsu")
 
 
+
+class CardDefinitionTestCase(TestCase):
+    """
+    Tests the process cache of CardDefinition
+    """
+
+    def setUp(self):
+        self.definition = CardDefinition.objects.create(name="Shiina Mafuyu")
+        CardDefinition.get_cached([self.definition.id])
+
+    def test_other_process(self):
+        """
+        Check a change bumping the shared version from another process
+        drops the process cache
+        """
+        # Save as another process would, then put back this process' cache
+        stale = (dict(CardDefinition._cache), CardDefinition._cache_version)
+        self.definition.name = "Shiina Minatsu"
+        self.definition.save()
+        CardDefinition._cache, CardDefinition._cache_version = stale
+        self.assertNotEqual(cache.get(DEFINITION_VERSION_KEY), stale[1])
+        with self.assertNumQueries(0):
+            definitions = CardDefinition.get_cached([self.definition.id])
+        self.assertEqual(definitions[self.definition.id].name, "Shiina Mafuyu")
+        CardDefinition._checked = 0
+        with self.assertNumQueries(1):
+            definitions = CardDefinition.get_cached([self.definition.id])
+        self.assertEqual(definitions[self.definition.id].name, "Shiina Minatsu")
+
+    def test_own_change(self):
+        """
+        Check saving a definition keeps the rest of the process cache
+        """
+        other = CardDefinition.objects.create(name="Akaba Chizuru")
+        CardDefinition.get_cached([other.id])
+        self.definition.name = "Shiina Minatsu"
+        self.definition.save()
+        CardDefinition._checked = 0
+        with self.assertNumQueries(1):
+            definitions = CardDefinition.get_cached(
+                    [self.definition.id, other.id])
+        self.assertEqual(definitions[self.definition.id].name, "Shiina Minatsu")
+
+
+def card_module(card_list):
+    """
+    Build a stand-in for a game module's card list
+    """
+    module = types.ModuleType("card_module")
+    module.CARD_LIST = card_list
+    return module
+
+
 class CardCatalogTestCase(TestCase):
     """
-    Tests associated 
+    Tests associated CardCatalog features
     """
 
+    def setUp(self):
+        self.catalog = CardCatalog.objects.create(name="Seitokai no Ichizon")
+        self.card_list = [
+                {"name": "Sakurano Kurimu", "image": "card_images/kurimu.png"},
+                {"name": "Akaba Chizuru", "image": "card_images/chizuru.png"},
+                {"name": "Shiina Minatsu", "image": "card_images/minatsu.png"},
+            ]
+
+    def test_load(self):
+        """
+        Check loading a card list
+        """
+        stats = self.catalog.load_catalog(card_module(iter(self.card_list)))
+        self.assertEqual(stats, {"created": 3, "updated": 0, "deleted": 0})
+        catalog = CardCatalog.objects.get(id=self.catalog.id)
+        self.assertEqual(
+                sorted(catalog._card_dict.keys()),
+                sorted([ card["name"] for card in self.card_list ]))
+        for name, card_id in catalog._card_dict.items():
+            self.assertEqual(catalog.definitions.get(id=card_id).name, name)
+
+    def test_reload(self):
+        """
+        Check reloading only writes cards that changed
+        """
+        self.catalog.load_catalog(card_module(self.card_list))
+        stats = self.catalog.load_catalog(card_module(self.card_list))
+        self.assertEqual(stats, {"created": 0, "updated": 0, "deleted": 0})
+        self.card_list[0] = dict(self.card_list[0], image="card_images/new.png")
+        del self.card_list[2]
+        stats = self.catalog.load_catalog(card_module(self.card_list))
+        self.assertEqual(stats, {"created": 0, "updated": 1, "deleted": 1})
+        self.assertEqual(
+                self.catalog.definitions.get(name="Sakurano Kurimu").image,
+                "card_images/new.png")
+        self.assertEqual(len(self.catalog._card_dict), 2)
+
 
 class CardUserTestCase(TestCase):
     """
@@ -61,13 +166,95 @@ class CardUserTestCase(TestCase):
         Check if deck state is same after trace
         """
         self.card_list = [
-                Card.objects.create(name="Sakurano Kurimu"),
-                Card.objects.create(name="Akaba Chizuru"),
-                Card.objects.create(name="Shiina Minatsu"),
-                Card.objects.create(name="Shiina Mafuyu"),
+                create_card("Sakurano Kurimu"),
+                create_card("Akaba Chizuru"),
+                create_card("Shiina Minatsu"),
+                create_card("Shiina Mafuyu"),
             ]
         self.deck.insert_cards(self.card_list)
         self.deck.save()
         self.assertEqual(
                 CardUser.objects.get(id=self.deck.id).get_class().card_list,
                 self.deck.card_list)
+
+
+class CardDefinitionMigrationTestCase(TransactionTestCase):
+    """
+    Test moving card names and images into CardDefinition
+    """
+
+    def setUp(self):
+        cursor = connection.cursor()
+        cursor.execute("ALTER TABLE game_card ADD COLUMN name varchar(64)")
+        cursor.execute("ALTER TABLE game_card ADD COLUMN image varchar(100)")
+        self.session = Session.objects.create(max_players=1)
+        self.deck = Deck.objects.create(name="Sugisaki Ken's harem", user=self.session)
+        self.catalog = CardCatalog.objects.create(name="Seitokai no Ichizon")
+        placeholder = CardDefinition.objects.create(name="")
+        legacy = [
+                ("Sakurano Kurimu", "card_images/kurimu.png", self.deck),
+                ("Sakurano Kurimu", "card_images/kurimu.png", self.deck),
+                ("Akaba Chizuru", "card_images/chizuru.png", self.deck),
+                ("Shiina Minatsu", "card_images/minatsu.png", self.catalog),
+            ]
+        self.card_list = []
+        for name, image, deck in legacy:
+            card = Card.objects.create(definition=placeholder, deck=deck)
+            cursor.execute(
+                    "UPDATE game_card SET name = %s, image = %s WHERE id = %s",
+                    [name, image, card.id])
+            self.card_list.append(card)
+
+    def tearDown(self):
+        # The migration commits, leave no rows behind for later test cases
+        call_command("flush", verbosity=0, interactive=False)
+        cache.clear()
+        CardDefinition._cache = {}
+
+    def test_migrate(self):
+        """
+        Check cards share definitions, catalog cards become the catalog's
+        definitions and the old columns are dropped
+        """
+        output = StringIO()
+        call_command("migrate_card_definitions", stdout=output)
+        self.assertIn("Created 1 catalog and 2 shared definitions for 3 cards",
+                output.getvalue())
+        cards = [ Card.objects.get(id=card.id) for card in self.card_list[:3] ]
+        self.assertEqual([ card.name for card in cards ],
+                ["Sakurano Kurimu", "Sakurano Kurimu", "Akaba Chizuru"])
+        self.assertEqual(cards[0].definition_id, cards[1].definition_id)
+        self.assertEqual(cards[2].definition.image, "card_images/chizuru.png")
+        self.assertFalse(Card.objects.filter(id=self.card_list[3].id).exists())
+        catalog = CardCatalog.objects.get(id=self.catalog.id)
+        self.assertEqual(catalog.definitions.get(
+                id=catalog._card_dict["Shiina Minatsu"]).image,
+                "card_images/minatsu.png")
+        columns = [ row[0] for row in connection.introspection.
+                get_table_description(connection.cursor(), "game_card") ]
+        self.assertNotIn("name", columns)
+        self.assertNotIn("image", columns)
+
+        output = StringIO()
+        call_command("migrate_card_definitions", stdout=output)
+        self.assertIn("already migrated", output.getvalue())
+
+    def test_migrate_rebuild(self):
+        """
+        Check the migration on SQLite releases without DROP COLUMN, where
+        game_card is rebuilt without the old columns
+        """
+        can_drop_column = schema.can_drop_column
+        schema.can_drop_column = lambda using: False
+        try:
+            call_command("migrate_card_definitions", stdout=StringIO())
+        finally:
+            schema.can_drop_column = can_drop_column
+        columns = [ row[0] for row in connection.introspection.
+                get_table_description(connection.cursor(), "game_card") ]
+        self.assertNotIn("name", columns)
+        self.assertNotIn("image", columns)
+        self.assertEqual(Card.objects.get(id=self.card_list[2].id).name,
+                "Akaba Chizuru")
+        card = create_card("Shiina Mafuyu", deck=self.deck)
+        self.assertEqual(Card.objects.get(id=card.id).name, "Shiina Mafuyu")
@@ -0,0 +1,122 @@
+"""
+Helpers for tests racing many threads against the same rows
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+import threading
+
+
+class _LockedCursor(object):
+    """
+    Cursor running one statement at a time. Rows are fetched while the
+    statement still holds the lock, a commit from another thread would
+    reset the cursor before they are read otherwise.
+    """
+
+    def __init__(self, cursor, lock):
+        self.cursor = cursor
+        self.lock = lock
+        self.rows = []
+
+    def execute(self, *args):
+        with self.lock:
+            result = self.cursor.execute(*args)
+            self.rows = self.cursor.fetchall() if self.description else []
+            return result
+
+    def executemany(self, *args):
+        with self.lock:
+            return self.cursor.executemany(*args)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=100):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SharedConnectionMixin(object):
+    """
+    Let worker threads share the test connection, so they also work with
+    an in-memory sqlite database. Statements, commits and transaction
+    blocks run one at a time, as atomically as on a database server, while
+    the reads and writes of different threads interleave freely.
+    """
+
+    WORKERS = 24
+
+    def share_connection(self):
+        self.conn = connections[DEFAULT_DB_ALIAS]
+        self.conn.allow_thread_sharing = True
+        lock = threading.RLock()
+        cursor, commit = self.conn.cursor, self.conn._commit
+        enter = self.conn.enter_transaction_management
+        leave = self.conn.leave_transaction_management
+        self.conn.cursor = lambda: _LockedCursor(cursor(), lock)
+
+        def locked_commit():
+            with lock:
+                return commit()
+
+        def locked_enter(*args, **kwargs):
+            lock.acquire()
+            enter(*args, **kwargs)
+
+        def locked_leave(*args, **kwargs):
+            try:
+                leave(*args, **kwargs)
+            finally:
+                lock.release()
+
+        self.conn._commit = locked_commit
+        self.conn.enter_transaction_management = locked_enter
+        self.conn.leave_transaction_management = locked_leave
+
+    def unshare_connection(self):
+        self.conn.allow_thread_sharing = False
+        for name in ("cursor", "_commit", "enter_transaction_management",
+                "leave_transaction_management"):
+            delattr(self.conn, name)
+
+    def hammer(self, prepare, work):
+        """
+        Run work once per worker, all starting together
+
+        @param prepare: function called by each worker before the start,
+            its result is passed to work
+        @param work: function called with what prepare returned and the
+            number of the worker
+        @return: list of what the workers returned or the ValueError they
+            raised
+        """
+        start = threading.Event()
+        results = []
+        lock = threading.Lock()
+
+        def worker(cnt):
+            connections[DEFAULT_DB_ALIAS] = self.conn
+            state = prepare()
+            start.wait()
+            try:
+                result = work(state, cnt)
+            except ValueError, error:
+                result = error
+            with lock:
+                results.append(result)
+
+        threads = [ threading.Thread(target=worker, args=(cnt,))
+                for cnt in range(self.WORKERS) ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), self.WORKERS)
+        return results
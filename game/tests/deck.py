@@ -1,10 +1,20 @@
 """
 Deck unit testing
 """
-from game.models.deck import Deck
+from game.models.deck import Deck, DeckConflict
+from game.models.event import events_logged
 from game.models.session import Session
-from game.models.card import Card
-from django.test import TestCase
+from game.models.card import Card, CardCatalog, CardDefinition
+from game.tests.card import create_card
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from game.tests.concurrency import SharedConnectionMixin
+from picklefield.fields import dbsafe_encode
+from StringIO import StringIO
+import random
+import types
 
 
 class DeckTestCase(TestCase):
@@ -16,10 +26,10 @@ class DeckTestCase(TestCase):
         self.session = Session.objects.create(max_players=1)
         self.deck = Deck.objects.create(name="Sugisaki Ken's harem", user=self.session)
         self.card_list = [
-                Card.objects.create(name="Sakurano Kurimu"),
-                Card.objects.create(name="Akaba Chizuru"),
-                Card.objects.create(name="Shiina Minatsu"),
-                Card.objects.create(name="Shiina Mafuyu"),
+                create_card("Sakurano Kurimu"),
+                create_card("Akaba Chizuru"),
+                create_card("Shiina Minatsu"),
+                create_card("Shiina Mafuyu"),
             ]
         self.full_deck_str = \
             "Sugisaki Ken's harem: Shiina Mafuyu, Shiina Minatsu, Akaba Chizuru, Sakurano Kurimu"
@@ -150,3 +160,309 @@ class DeckTestCase(TestCase):
                 ]
         self.assertEqual(self.deck.get_card(0, 4, 2), check_list)
 
+    def test_card_list_queries(self):
+        """
+        Check the card list is resolved with a single query
+        """
+        self.deck.insert_cards(self.card_list)
+        self.deck.save()
+        deck = Deck.objects.get(id=self.deck.id)
+        # One query for the cards and one for their definitions
+        with self.assertNumQueries(2):
+            self.assertEqual(deck.card_list, self.card_list[::-1])
+        with self.assertNumQueries(0):
+            self.assertEqual(deck.get_card(1, 3), self.card_list[2:0:-1])
+        # Definitions stay cached for the process
+        with self.assertNumQueries(0):
+            CardDefinition.get_cached(
+                    [ card.definition_id for card in self.card_list ])
+
+    def test_order_persist(self):
+        """
+        Check the deck order is stored without saving the deck
+        """
+        for card in self.card_list:
+            self.deck.insert_card(card)
+        self.deck.insert_card(self.deck.remove_card(top=False), index=2)
+        self.deck.insert_card(self.deck.remove_card(), top=False)
+        deck = Deck.objects.get(id=self.deck.id)
+        self.assertEqual(deck.card_list, self.deck.card_list)
+        self.deck.shuffle()
+        deck = Deck.objects.get(id=self.deck.id)
+        self.assertEqual(deck.card_list, self.deck.card_list)
+
+    def test_stale_order(self):
+        """
+        Check a move prepared from an outdated order is retried on the
+        current one
+        """
+        self.deck.insert_cards(self.card_list)
+        stale = Deck.objects.get(id=self.deck.id)
+        stale.length
+        first = self.deck.remove_card()
+        second = stale.remove_card()
+        self.assertNotEqual(first, second)
+        self.assertEqual(stale.revision, self.deck.revision + 1)
+        self.assertEqual(Deck.objects.get(id=self.deck.id).length, 2)
+
+    def test_play_card(self):
+        """
+        Check a card is moved between decks as one move
+        """
+        self.deck.insert_cards(self.card_list)
+        other = Deck.objects.create(name="Student council", user=self.session)
+        card = self.deck.play_card(other, index=1)
+        self.assertEqual(card, self.card_list[2])
+        other.play_card(self.deck, top=False)
+        self.assertEqual([ card.name for card in Deck.objects.get(
+                id=self.deck.id).card_list ], ["Shiina Mafuyu",
+                "Akaba Chizuru", "Sakurano Kurimu", "Shiina Minatsu"])
+        self.assertEqual(Deck.objects.get(id=other.id).length, 0)
+
+
+class DeckClaimTestCase(TransactionTestCase):
+    """
+    Test moves over several decks claim all of them or none
+    """
+
+    def test_partial_claim(self):
+        """
+        Check a deck claimed before one that changed is not left with a
+        bumped revision
+        """
+        session = Session.objects.create(max_players=1)
+        first = session.add_deck("first")
+        second = session.add_deck("second")
+        first.insert_cards([ create_card("Nakatsu Shizuru %d" % cnt)
+            for cnt in range(3) ])
+        mover = Deck.objects.get(id=first.id)
+        target = Deck.objects.get(id=second.id)
+        mover.length, target.length
+        second.insert_card(create_card("Mizuno Yukiko"))
+        revisions = dict(Deck.objects.values_list("id", "revision"))
+        mover.play_card(target)
+        self.assertEqual(dict(Deck.objects.values_list("id", "revision")), {
+                first.id: revisions[first.id] + 1,
+                second.id: revisions[second.id] + 1})
+        self.assertEqual(Deck.objects.get(id=second.id).length, 2)
+
+    def test_failed_log(self):
+        """
+        Check a move is rolled back when its event cannot be logged
+        """
+        session = Session.objects.create(max_players=1)
+        first = session.add_deck("first")
+        second = session.add_deck("second")
+        first.insert_card(create_card("Ichinose Yuuki"))
+        events = session.events.count()
+
+        def fail(*args, **kwargs):
+            raise DatabaseError("log is full")
+        first._log = fail
+        self.assertRaises(DatabaseError, first.play_card, second)
+        self.assertEqual(Deck.objects.get(id=first.id).length, 1)
+        self.assertEqual(Deck.objects.get(id=second.id).length, 0)
+        self.assertEqual(session.events.count(), events)
+
+    def test_failed_move(self):
+        """
+        Check a move that failed after claiming keeps the revision its
+        order was read at, so a move by another player is noticed
+        """
+        session = Session.objects.create(max_players=2)
+        market = session.add_deck("market")
+        hand = session.add_deck("hand")
+        market.insert_cards([ create_card("Kimura Shiho"),
+            create_card("Hokari Ui") ])
+        mover = Deck.objects.get(id=market.id)
+        self.assertRaises(IndexError, mover.play_card, hand, index=5)
+        mover.length
+        first = market.play_card(hand)
+        second = mover.play_card(hand)
+        self.assertNotEqual(first, second)
+        self.assertEqual(Deck.objects.get(id=hand.id).length, 2)
+
+
+class DeckStressTestCase(SharedConnectionMixin, TransactionTestCase):
+    """
+    Test many players moving cards around shared decks at once
+    """
+
+    WORKERS = 12
+    MOVES = 15
+    CARDS = 40
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=self.WORKERS)
+        self.market = self.session.add_deck("market")
+        self.discard = self.session.add_deck("discard")
+        self.hands = [ self.session.add_deck("hand %d" % cnt)
+                for cnt in range(self.WORKERS) ]
+        self.market.insert_cards([ create_card("Card %d" % cnt)
+                for cnt in range(self.CARDS) ])
+        self.share_connection()
+
+    def tearDown(self):
+        self.unshare_connection()
+
+    def prepare(self):
+        """
+        @return: (market, discard, hands) with their orders loaded
+        """
+        decks = [ Deck.objects.get(id=deck.id)
+                for deck in [self.market, self.discard] + self.hands ]
+        for deck in decks:
+            deck.length
+        return decks[0], decks[1], decks[2:]
+
+    def work(self, decks, cnt):
+        """
+        Make random moves between the shared decks and the worker's hand
+
+        @return: (worker number, number of cards played to the hand)
+        """
+        market, discard, hands = decks
+        rng = random.Random(cnt)
+        played = 0
+        for move in range(self.MOVES):
+            choice = rng.randrange(4)
+            try:
+                if choice == 0:
+                    market.play_card(hands[cnt])
+                    played = played + 1
+                elif choice == 1:
+                    market.play_card(discard, top=False)
+                elif choice == 2:
+                    discard.transfer_cards(market, 1)
+                else:
+                    market.shuffle(seed=rng.getrandbits(32))
+            except (IndexError, DeckConflict):
+                pass
+        return cnt, played
+
+    def test_card_count(self):
+        """
+        Check no card is lost, duplicated or taken twice
+        """
+        results = self.hammer(self.prepare, self.work)
+        decks = [self.market, self.discard] + self.hands
+        self.assertEqual(Card.objects.filter(
+                deck__in=decks).count(), self.CARDS)
+        for deck in decks:
+            positions = list(Card.objects.filter(
+                    deck=deck).values_list("position", flat=True))
+            self.assertEqual(len(positions), len(set(positions)))
+        for cnt, played in results:
+            self.assertEqual(
+                    Deck.objects.get(id=self.hands[cnt].id).length, played)
+
+
+class DeckCatalogTestCase(TestCase):
+    """
+    Test creating decks from a card catalog
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=1)
+        self.catalog = CardCatalog.objects.create(name="Seitokai no Ichizon")
+        module = types.ModuleType("card_module")
+        module.CARD_LIST = [
+                {"name": "Sakurano Kurimu"},
+                {"name": "Akaba Chizuru"},
+                {"name": "Shiina Minatsu"},
+            ]
+        self.catalog.load_catalog(module)
+
+    def create_deck(self, counts):
+        """
+        @return: (number of queries, deck)
+        """
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            deck = self.session.add_deck(
+                    "draw", catalog=self.catalog, counts=counts)
+            return len(connection.queries) - start, deck
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_create(self):
+        """
+        Check the deck holds the requested copies in stored order
+        """
+        counts = {"Sakurano Kurimu": 3, "Shiina Minatsu": 2}
+        cnt, deck = self.create_deck(counts)
+        names = [ card.name for card in deck.card_list ]
+        self.assertEqual(sorted(names), sorted(
+                ["Sakurano Kurimu"] * 3 + ["Shiina Minatsu"] * 2))
+        self.assertEqual(
+                Deck.objects.get(id=deck.id).card_list, deck.card_list)
+        self.assertRaises(ValueError,
+                self.session.add_deck, "bad", catalog=self.catalog,
+                counts={"Sugisaki Ken": 1})
+
+    def test_create_queries(self):
+        """
+        Check the query count does not grow with the deck
+        """
+        small_cnt, small = self.create_deck({"Akaba Chizuru": 1})
+        large_cnt, large = self.create_deck(
+                {"Sakurano Kurimu": 20, "Akaba Chizuru": 20})
+        self.assertEqual(small_cnt, large_cnt)
+        self.assertEqual(large.length, 40)
+
+    def test_fill_after_commit(self):
+        """
+        Check the fill is only announced once the new deck committed
+        """
+        steps = []
+
+        def announced(sender, events, **kwargs):
+            steps.extend([ event.action for event in events ])
+
+        # TestCase turns commits into no-ops, record them instead
+        commit = transaction.commit
+        transaction.commit = lambda *args, **kwargs: steps.append("commit")
+        events_logged.connect(announced)
+        try:
+            self.create_deck({"Akaba Chizuru": 2})
+        finally:
+            events_logged.disconnect(announced)
+            transaction.commit = commit
+        self.assertEqual(steps, ["commit", "fill"])
+
+
+class DeckMigrationTestCase(TransactionTestCase):
+    """
+    Test moving pickled deck order into Card.position
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=1)
+        self.deck = Deck.objects.create(name="Sugisaki Ken's harem", user=self.session)
+        self.card_list = [
+                create_card("Sakurano Kurimu", deck=self.deck),
+                create_card("Akaba Chizuru", deck=self.deck),
+                create_card("Shiina Minatsu", deck=self.deck),
+            ]
+        cursor = connection.cursor()
+        cursor.execute("ALTER TABLE game_deck ADD COLUMN _card_list text")
+        cursor.execute(
+                "UPDATE game_deck SET _card_list = %s WHERE carduser_ptr_id = %s",
+                [dbsafe_encode([ card.id for card in self.card_list[::-1] ]),
+                    self.deck.id])
+
+    def tearDown(self):
+        # Adding the column commits, leave no rows behind for later tests
+        call_command("flush", verbosity=0, interactive=False)
+        cache.clear()
+
+    def test_migrate(self):
+        """
+        Check the pickled order survives the migration
+        """
+        output = StringIO()
+        call_command("migrate_card_order", stdout=output)
+        self.assertIn("1 decks", output.getvalue())
+        deck = Deck.objects.get(id=self.deck.id)
+        self.assertEqual(deck.card_list, self.card_list[::-1])
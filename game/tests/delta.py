@@ -0,0 +1,141 @@
+"""
+State delta unit testing
+"""
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+from controller.delta import changes_since, revision
+from game.models.session import DeckUser, Session
+from game.models.user import UserProfile
+from game.tests.card import create_card
+from game.views import session_state
+
+
+class StateDeltaTestCase(TestCase):
+    """
+    Test computing changes since a revision
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=2)
+        self.session.add_phase("Play")
+        self.players = []
+        self.hands = []
+        for name in ["Fujibayashi Kyou", "Sakagami Tomoyo"]:
+            test_user = User.objects.create(username=name)
+            player = self.session.add_player(
+                    UserProfile.objects.create(user=test_user))
+            self.players.append(player)
+            self.hands.append(player.add_deck("hand"))
+        self.pile = self.session.add_deck("pile")
+        self.pile.insert_cards([ create_card("Dango %d" % cnt)
+            for cnt in range(6) ])
+
+    def delta(self, player, since):
+        """
+        @return: (number of queries, delta)
+        """
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            delta = changes_since(
+                    Session.objects.get(id=self.session.id), player, since)
+            return len(connection.queries) - start, delta
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_full(self):
+        """
+        Check revision 0 sends the whole visible state
+        """
+        cnt, delta = self.delta(self.players[0], 0)
+        self.assertEqual(delta["revision"], revision(self.session))
+        self.assertEqual(delta["session"]["phase_list"], ["Play"])
+        self.assertEqual(
+                [ player["name"] for player in delta["players"] ],
+                ["Fujibayashi Kyou", "Sakagami Tomoyo"])
+        self.assertEqual(sorted(delta["decks"].keys()), sorted(
+                [ deck.id for deck in [self.pile] + self.hands ]))
+        self.assertEqual(delta["decks"][self.pile.id],
+                {"name": "pile", "length": 6})
+
+    def test_changes(self):
+        """
+        Check only the decks and fields a move touched are sent
+        """
+        since = revision(self.session)
+        cnt, delta = self.delta(self.players[0], since)
+        self.assertEqual(delta, {"revision": since})
+        DeckUser.draw_cards(self.pile, self.hands[0], num_cards=2)
+        for player, cards in [(self.players[0], 2), (self.players[1], None)]:
+            cnt, delta = self.delta(player, since)
+            self.assertTrue(delta["revision"] > since)
+            self.assertFalse("session" in delta or "players" in delta)
+            self.assertEqual(sorted(delta["decks"].keys()),
+                    sorted([self.pile.id, self.hands[0].id]))
+            self.assertEqual(delta["decks"][self.pile.id]["length"], 4)
+            hand = delta["decks"][self.hands[0].id]
+            self.assertEqual(len(hand.get("cards", [])), cards or 0)
+        since = delta["revision"]
+        self.session.swap_players(0, 1)
+        cnt, delta = self.delta(self.players[0], since)
+        self.assertEqual(
+                [ player["id"] for player in delta["players"] ],
+                [self.players[1].id, self.players[0].id])
+        self.assertFalse("decks" in delta)
+
+    def test_session_revisions(self):
+        """
+        Check revisions count the moves of their own session only and a
+        revision the session never reached gets the whole state
+        """
+        since = revision(self.session)
+        self.assertEqual(since, self.session.events.count())
+        other = Session.objects.create(max_players=1)
+        other.add_phase("Play")
+        other.next_phase()
+        self.assertEqual(revision(self.session), since)
+        self.session.next_phase()
+        self.assertEqual(revision(self.session), since + 1)
+        cnt, delta = self.delta(self.players[0], since + 1000)
+        self.assertEqual(delta["revision"], since + 1)
+        self.assertEqual(sorted(delta["decks"].keys()), sorted(
+                [ deck.id for deck in [self.pile] + self.hands ]))
+
+    def test_scaling(self):
+        """
+        Check the reads do not grow with the untouched part of the game
+        """
+        since = revision(self.session)
+        self.pile.shuffle()
+        small_cnt, small = self.delta(self.players[0], since)
+        for cnt in range(10):
+            deck = self.session.add_deck("extra %d" % cnt)
+            deck.insert_cards([ create_card("Extra %d" % card)
+                for card in range(10) ])
+        since = revision(self.session)
+        self.pile.shuffle()
+        large_cnt, large = self.delta(self.players[0], since)
+        self.assertEqual(small_cnt, large_cnt)
+        self.assertEqual(large["decks"].keys(), [self.pile.id])
+
+    def test_etag(self):
+        """
+        Check a client holding the current revision gets a 304 without
+        the delta being read
+        """
+        player = self.players[0]
+        factory = RequestFactory()
+        request = factory.get("/", {"player_key": player.player_key})
+        etag = session_state(request, str(self.session.id))["ETag"]
+        request = factory.get("/", {"player_key": player.player_key},
+                HTTP_IF_NONE_MATCH=etag)
+        with self.assertNumQueries(3):
+            response = session_state(request, str(self.session.id))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.hands[0].insert_card(self.pile.remove_card())
+        response = session_state(request, str(self.session.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
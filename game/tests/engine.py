@@ -0,0 +1,195 @@
+"""
+Game engine unit testing
+"""
+from django.contrib.auth.models import User
+from django.test import TestCase
+from controller.engine import GameEngine
+from game.tests.card import create_card
+from game.models.deck import Deck, DeckConflict
+from game.models.session import DeckUser, SeatConflict, Session
+from game.models.user import UserProfile
+import random
+
+
+class GameEngineTestCase(TestCase):
+    """
+    Test the in-memory engine against the direct model methods
+    """
+
+    def setUp(self):
+        self.user_list = []
+        for name in ["Tsukimura Kaname", "Kumin Tsuyuri", "Tomoe Hotaru"]:
+            test_user = User.objects.create(username=name)
+            self.user_list.append(UserProfile.objects.create(user=test_user))
+
+    def create_game(self):
+        """
+        Build a session with a draw pile and a hand for each player
+        """
+        session = Session.objects.create(max_players=len(self.user_list))
+        for phase in ["Draw", "Play", "Discard"]:
+            session.add_phase(phase)
+        for user in self.user_list:
+            session.add_player(user).add_deck("hand")
+        pile = session.add_deck("pile")
+        for cnt in range(20):
+            pile.insert_card(create_card("Maid %d" % cnt))
+        return session
+
+    def game_state(self, session):
+        """
+        Read everything the engine may touch back from the database
+        """
+        session = Session.objects.get(id=session.id)
+        decks = {}
+        for player in session.player_list:
+            deck = Deck.objects.get(user=player)
+            decks[player.user.user.username] = [
+                    card.name for card in deck.card_list ]
+        pile = Deck.objects.get(user=session)
+        decks["pile"] = [ card.name for card in pile.card_list ]
+        return {
+                "turn": session.turn,
+                "phase": session.phase,
+                "players": [ player.user.user.username
+                    for player in session.player_list ],
+                "decks": decks,
+                }
+
+    def test_matches_orm(self):
+        """
+        Check the engine ends in the same state as the model methods
+        """
+        orm_session = self.create_game()
+        eng_session = self.create_game()
+
+        random.seed(4)
+        pile = orm_session.deck_list["pile"]
+        pile.shuffle()
+        for player in orm_session.player_list:
+            DeckUser.draw_cards(pile, player.deck_list["hand"], num_cards=3)
+        orm_session.swap_players(0, 2)
+        for cnt in range(4):
+            orm_session.next_phase()
+
+        random.seed(4)
+        engine = GameEngine(eng_session, rng=random)
+        pile = eng_session.deck_list["pile"]
+        engine.shuffle(pile)
+        for player in eng_session.player_list:
+            engine.draw_cards(pile, player.deck_list["hand"], num_cards=3)
+        engine.swap_players(0, 2)
+        for cnt in range(4):
+            engine.next_phase()
+        engine.flush()
+
+        self.assertEqual(
+                self.game_state(eng_session), self.game_state(orm_session))
+
+    def test_write_behind(self):
+        """
+        Check moves are only written at turn boundaries
+        """
+        session = self.create_game()
+        engine = GameEngine(session)
+        before = self.game_state(session)
+        pile = session.deck_list["pile"]
+        engine.draw_cards(pile, session.player_list[0].deck_list["hand"])
+        engine.next_phase()
+        self.assertTrue(engine.dirty)
+        self.assertEqual(self.game_state(session), before)
+        engine.next_phase()
+        engine.next_phase()
+        self.assertFalse(engine.dirty)
+        after = self.game_state(session)
+        self.assertEqual(after["turn"], 1)
+        self.assertEqual(len(after["decks"]["pile"]), 19)
+
+    def test_flush_interval(self):
+        """
+        Check a zero interval writes every move straight through
+        """
+        session = self.create_game()
+        engine = GameEngine(session, flush_interval=0)
+        engine.next_phase()
+        self.assertFalse(engine.dirty)
+        self.assertEqual(self.game_state(session)["phase"], 1)
+
+    def test_rollback(self):
+        """
+        Check a failed batch leaves no trace in memory or the database
+        """
+        session = self.create_game()
+        engine = GameEngine(session)
+        before = self.game_state(session)
+        pile = session.deck_list["pile"]
+        try:
+            with engine:
+                engine.draw_cards(pile, session.player_list[0].deck_list["hand"])
+                engine.draw_cards(pile, session.player_list[1].deck_list["hand"],
+                        num_cards=100)
+        except IndexError:
+            pass
+        self.assertFalse(engine.dirty)
+        self.assertEqual(len(engine.card_ids(pile)), 20)
+        self.assertEqual(self.game_state(session), before)
+
+    def test_nested_rollback(self):
+        """
+        Check a nested batch is discarded with the batch around it
+        """
+        session = self.create_game()
+        engine = GameEngine(session)
+        before = self.game_state(session)
+        try:
+            with engine:
+                with engine:
+                    engine.next_phase()
+                raise IndexError()
+        except IndexError:
+            pass
+        self.assertFalse(engine.dirty)
+        self.assertEqual(engine.phase, 0)
+        self.assertEqual(self.game_state(session), before)
+
+    def test_late_join(self):
+        """
+        Check a flush does not unseat a player who joined after the engine
+        loaded the session
+        """
+        session = Session.objects.create(max_players=2)
+        session.add_phase("Play")
+        first = session.add_player(self.user_list[0])
+        engine = GameEngine(session)
+        joined = Session.objects.get(id=session.id).add_player(
+                self.user_list[1])
+        self.assertRaises(SeatConflict, engine.next_phase)
+        seats = [first.id, joined.id]
+        self.assertEqual(Session.objects.get(id=session.id)._player_list,
+                seats)
+        self.assertEqual(engine.player_list, seats)
+        engine.next_phase()
+        session = Session.objects.get(id=session.id)
+        self.assertEqual(session._player_list, seats)
+        self.assertEqual(session.turn, 1)
+
+    def test_moved_card(self):
+        """
+        Check the engine does not draw a card again after it was played
+        into a hand behind its back
+        """
+        session = self.create_game()
+        engine = GameEngine(session)
+        pile = session.deck_list["pile"]
+        hands = [ player.deck_list["hand"] for player in session.player_list ]
+        card = Deck.objects.get(id=pile.id).play_card(hands[0])
+        with self.assertRaises(DeckConflict):
+            with engine:
+                engine.draw_cards(pile, hands[1])
+        self.assertEqual(Deck.objects.get(id=hands[0].id).card_list, [card])
+        self.assertEqual(Deck.objects.get(id=hands[1].id).length, 0)
+        self.assertNotIn(card.id, engine.card_ids(pile))
+        engine.draw_cards(pile, hands[1])
+        engine.flush()
+        self.assertEqual(Deck.objects.get(id=hands[1].id).length, 1)
+        self.assertEqual(Deck.objects.get(id=pile.id).length, 18)
@@ -0,0 +1,179 @@
+"""
+Event log and replay unit testing
+"""
+from django.contrib.auth.models import User
+from django.test import TestCase
+from controller.engine import GameEngine
+from game.models.event import GameEvent
+from game.models.session import DeckUser, Session
+from game.models.user import UserProfile
+from game.replay import GameState, checkpoint, recover, replay
+from game.tests.card import create_card
+
+
+class GameEventTestCase(TestCase):
+    """
+    Test logging moves and replaying them
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=3)
+        for phase in ["Draw", "Play"]:
+            self.session.add_phase(phase)
+        for name in ["Hirasawa Yui", "Akiyama Mio", "Tainaka Ritsu"]:
+            test_user = User.objects.create(username=name)
+            player = self.session.add_player(
+                    UserProfile.objects.create(user=test_user))
+            player.add_deck("hand")
+        self.pile = self.session.add_deck("pile")
+        self.pile.insert_cards([ create_card("Tea %d" % cnt)
+            for cnt in range(12) ])
+
+    def play(self, session):
+        """
+        Make a few moves of every kind
+        """
+        pile = session.deck_list["pile"]
+        pile.shuffle()
+        for player in session.player_list:
+            DeckUser.draw_cards(pile, player.deck_list["hand"], num_cards=2)
+            session.next_phase()
+        hand = session.player_list[0].deck_list["hand"]
+        pile.insert_card(hand.remove_card(), top=False)
+        pile.insert_card(hand.remove_card(), index=3)
+        session.swap_players(0, 2)
+        session.shuffle_players()
+        session.remove_player(index=1)
+
+    def current(self, session):
+        """
+        Read the database state of a session, ignoring empty decks
+        """
+        state = GameState.from_session(Session.objects.get(id=session.id))
+        return self.comparable(state)
+
+    def comparable(self, state):
+        state = state.to_dict()
+        del state["event_id"]
+        state["orders"] = dict([ (deck_id, order)
+                for deck_id, order in state["orders"].items() if order ])
+        return state
+
+    def last_event_id(self):
+        return self.session.events.order_by("-id")[0].id
+
+    def test_log_queries(self):
+        """
+        Check a move is logged by the write applying it, with a single
+        insert
+        """
+        last_id = self.last_event_id()
+        with self.assertNumQueries(0):
+            self.session.next_phase(save=False)
+        self.assertEqual(self.last_event_id(), last_id)
+        # The session update, the event number update and read, and the
+        # event insert
+        with self.assertNumQueries(4):
+            self.session.save()
+        event = self.session.events.order_by("-id")[0]
+        self.assertEqual(event.action, "next_phase")
+
+    def test_card_ids(self):
+        """
+        Check removals and transfers name the cards they moved
+        """
+        hand = self.session.player_list[0].deck_list["hand"]
+        drawn = [ card.id for card in self.pile.get_card(0, 2) ]
+        DeckUser.draw_cards(self.pile, hand, num_cards=2)
+        event = self.session.events.order_by("-id")[0]
+        self.assertEqual(event.action, "transfer")
+        self.assertEqual(event.args[3], drawn)
+        card = hand.remove_card()
+        event = self.session.events.order_by("-id")[0]
+        self.assertEqual(event.action, "remove_card")
+        self.assertEqual(event.args[2], card.id)
+        self.assertEqual(
+                self.comparable(replay(self.session)),
+                self.current(self.session))
+
+    def test_replay(self):
+        """
+        Check replaying the log rebuilds the current and earlier states
+        """
+        middle = self.current(self.session)
+        middle_id = self.last_event_id()
+        self.play(self.session)
+        self.assertEqual(
+                self.comparable(replay(self.session)),
+                self.current(self.session))
+        self.assertEqual(
+                self.comparable(replay(self.session, middle_id)), middle)
+
+    def test_checkpoint(self):
+        """
+        Check replay starts from the latest checkpoint
+        """
+        self.play(self.session)
+        checkpoint(self.session)
+        self.session.next_phase()
+        self.session.deck_list["pile"].shuffle()
+        self.session.events.filter(id__lte=self.session.checkpoints.order_by(
+                "-event_id")[0].event_id).delete()
+        with self.assertNumQueries(2):
+            state = replay(self.session)
+        self.assertEqual(self.comparable(state), self.current(self.session))
+
+    def test_initial_state(self):
+        """
+        Check replay starts from the phases and turn a session was
+        created with
+        """
+        session = Session.objects.create(max_players=2, turn=4,
+                phase_list=["Draw", "Play"])
+        for cnt in range(3):
+            session.next_phase()
+        self.assertEqual((session.turn, session.phase), (5, 1))
+        self.assertEqual(self.comparable(replay(session)),
+                self.current(session))
+
+    def test_recover(self):
+        """
+        Check a session can be rolled back to an earlier event
+        """
+        middle = self.current(self.session)
+        middle_id = self.last_event_id()
+        self.play(self.session)
+        recover(Session.objects.get(id=self.session.id), middle_id)
+        self.assertEqual(self.current(self.session), middle)
+        self.assertEqual(self.comparable(replay(self.session)), middle)
+
+    def test_seeded_shuffle(self):
+        """
+        Check shuffles with the same seed give the same order
+        """
+        other = self.session.add_deck("other")
+        other.insert_cards([ create_card("Cake %d" % cnt)
+            for cnt in range(12) ])
+        self.pile.shuffle(seed=7)
+        other.shuffle(seed=7)
+        self.assertEqual(
+                [ card.name.split()[-1] for card in self.pile.card_list ],
+                [ card.name.split()[-1] for card in other.card_list ])
+
+    def test_engine(self):
+        """
+        Check moves made through the engine are logged in one batch
+        """
+        engine = GameEngine(self.session, flush_on_turn=False)
+        before = GameEvent.objects.count()
+        engine.shuffle(self.pile)
+        for player in self.session.player_list:
+            engine.draw_cards(self.pile, player.deck_list["hand"])
+            engine.next_phase()
+        engine.swap_players(0, 1)
+        self.assertEqual(GameEvent.objects.count(), before)
+        engine.flush()
+        self.assertEqual(GameEvent.objects.count(), before + 8)
+        self.assertEqual(
+                self.comparable(replay(self.session)),
+                self.current(self.session))
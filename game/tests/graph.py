@@ -0,0 +1,76 @@
+"""
+Session graph loader unit testing
+"""
+from django.contrib.auth.models import User
+from django.test import TestCase
+from game.graph import load_session
+from game.models.session import Session
+from game.models.user import UserProfile
+from game.tests.card import create_card
+import json
+
+
+class SessionGraphTestCase(TestCase):
+    """
+    Test loading a whole session at once
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(name="Tea party", max_players=4)
+        for phase in ["Draw", "Play"]:
+            self.session.add_phase(phase)
+        self.pile = self.session.add_deck("pile")
+        self.pile.insert_cards([ create_card("Scone %d" % cnt)
+            for cnt in range(5) ])
+
+    def seat(self, names):
+        for name in names:
+            player = self.session.add_player(UserProfile.objects.create(
+                    user=User.objects.create(username=name)))
+            hand = player.add_deck("hand")
+            hand.insert_cards([ create_card("%s %d" % (name, cnt))
+                for cnt in range(3) ])
+            player.add_deck("table")
+
+    def test_graph(self):
+        """
+        Check the views match the models
+        """
+        self.seat(["Hirasawa Yui", "Akiyama Mio", "Tainaka Ritsu"])
+        self.session.remove_player(index=1)
+        graph = load_session(self.session.id)
+        self.assertEqual(graph.name, "Tea party")
+        self.assertEqual(graph.current_phase, "Draw")
+        self.assertEqual([ card.name for card in graph.deck_list["pile"].cards ],
+                [ card.name for card in self.pile.card_list ])
+        self.assertEqual(graph.players[1], None)
+        self.assertEqual(graph.current_player.username, "Hirasawa Yui")
+        ritsu = graph.players[2]
+        self.assertEqual((ritsu.seat, ritsu.username), (2, "Tainaka Ritsu"))
+        hand = self.session.player_list[2].deck_list["hand"]
+        self.assertEqual(ritsu.deck_list["hand"].length, 3)
+        self.assertEqual([ card.id for card in ritsu.deck_list["hand"].cards ],
+                [ card.id for card in hand.card_list ])
+        self.assertEqual(ritsu.deck_list["table"].cards, ())
+        self.assertRaises(AttributeError, setattr, graph, "turn", 3)
+        data = json.loads(json.dumps(graph.to_dict()))
+        self.assertEqual(data["players"][2]["decks"][0]["cards"][0]["name"],
+                hand.card_list[0].name)
+
+    def test_queries(self):
+        """
+        Check the number of queries does not grow with the game
+        """
+        self.seat(["Hirasawa Yui"])
+        load_session(self.session.id)
+        with self.assertNumQueries(4):
+            graph = load_session(self.session.id)
+        self.seat(["Akiyama Mio", "Tainaka Ritsu", "Kotobuki Tsumugi"])
+        load_session(self.session.id)
+        with self.assertNumQueries(4):
+            graph = load_session(self.session.id)
+        with self.assertNumQueries(0):
+            json.dumps(graph.to_dict())
+            for player in graph.players:
+                for deck in player.decks:
+                    [ card.image for card in deck.cards ]
@@ -0,0 +1,87 @@
+"""
+Model method instrumentation unit testing
+"""
+from django.contrib.auth.models import AnonymousUser
+from django.db.backends import BaseDatabaseWrapper
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from game import instrument
+from game.models.deck import Deck
+from game.models.session import DeckUser, Session
+from game.tests.card import create_card
+from game.views import method_stats_view
+
+
+class InstrumentTestCase(TestCase):
+    """
+    Test per method query and time histograms
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(name="Tea party", max_players=4)
+        self.pile = self.session.add_deck("pile")
+        self.hand = self.session.add_deck("hand")
+        self.pile.insert_cards([ create_card("Scone %d" % cnt)
+            for cnt in range(5) ])
+        instrument.stats.reset()
+
+    def tearDown(self):
+        instrument.disable()
+
+    def test_disabled(self):
+        """
+        Check nothing is wrapped or recorded unless enabled
+        """
+        insert_card = Deck.__dict__["insert_card"]
+        cursor = BaseDatabaseWrapper.cursor
+        instrument.enable()
+        self.assertTrue(instrument.enabled())
+        self.assertNotEqual(Deck.__dict__["insert_card"], insert_card)
+        instrument.disable()
+        self.assertFalse(instrument.enabled())
+        self.assertEqual(Deck.__dict__["insert_card"], insert_card)
+        self.assertEqual(BaseDatabaseWrapper.cursor, cursor)
+        self.pile.card_list
+        self.assertEqual(instrument.stats.snapshot(), {})
+
+    def test_record(self):
+        """
+        Check calls record their queries, nested calls included
+        """
+        pile = Deck.objects.no_cache().get(id=self.pile.id)
+        instrument.enable()
+        self.assertEqual(len(pile.card_list), 5)
+        self.assertEqual(len(pile.card_list), 5)
+        DeckUser.draw_cards(pile, self.hand, num_cards=2)
+        methods = instrument.stats.snapshot()
+        card_list = methods["Deck.card_list"]
+        self.assertEqual(card_list["calls"], 2)
+        self.assertTrue(card_list["queries"]["sum"] > 0)
+        self.assertEqual(sum(card_list["seconds"]["buckets"]), 2)
+        draw = methods["DeckUser.draw_cards"]
+        transfer = methods["Deck.transfer_cards"]
+        self.assertEqual(draw["calls"], 1)
+        self.assertTrue(
+                draw["queries"]["sum"] >= transfer["queries"]["sum"] > 0)
+        self.assertTrue(
+                draw["seconds"]["sum"] >= draw["db_seconds"]["sum"] > 0)
+
+    def test_stats_view(self):
+        """
+        Check the histograms are exported to internal clients only
+        """
+        instrument.enable()
+        self.pile.shuffle(seed=3)
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1")
+        request.user = AnonymousUser()
+        self.assertEqual(method_stats_view(request).status_code, 403)
+        with override_settings(INTERNAL_IPS=("10.0.0.1",)):
+            response = method_stats_view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("# TYPE game_method_queries histogram\n"
+                in response.content)
+        self.assertTrue('game_method_seconds_bucket{method="Deck.shuffle",'
+                'le="+Inf"} 1\n' in response.content)
+        self.assertTrue('game_method_db_seconds_count{method="Deck.shuffle"}'
+                ' 1\n' in response.content)
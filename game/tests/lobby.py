@@ -0,0 +1,140 @@
+"""
+Lobby listing unit testing
+"""
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipUnless
+from game.lobby import open_sessions
+from game.management.schema import drop_columns
+from game.models.deck import Deck
+from game.models.game_info import GameInfo
+from game.models.session import Session
+from game.models.user import UserProfile
+from StringIO import StringIO
+
+
+class LobbyTestCase(TestCase):
+    """
+    Test listing the sessions players can join
+    """
+
+    def setUp(self):
+        self.game = GameInfo.objects.create(
+                name="Carta de Amor", ref="CartaDeAmor", desc="Love letters")
+        self.other = GameInfo.objects.create(
+                name="Hanabi", ref="Hanabi", desc="Fireworks")
+        self.profiles = [ UserProfile.objects.create(
+                user=User.objects.create(username=name))
+                for name in ["Tachibana Kanade", "Otonashi Yuzuru"] ]
+
+    def test_seats(self):
+        """
+        Check the seat columns follow players and status
+        """
+        session = Session.objects.create(game=self.game, max_players=2)
+        self.assertEqual(list(Session.objects.joinable(self.game)), [session])
+        for profile in self.profiles:
+            session.add_player(profile)
+        self.assertEqual(Session.objects.get(id=session.id).seats_taken, 2)
+        self.assertEqual(list(Session.objects.joinable(self.game)), [])
+        session.remove_player(index=0)
+        self.assertEqual(list(Session.objects.joinable(self.game)), [session])
+        session.status = "playing"
+        session.save()
+        self.assertEqual(list(Session.objects.joinable(self.game)), [])
+
+    def test_pages(self):
+        """
+        Check pages follow each other newest first in one query each
+        """
+        sessions = [ Session.objects.create(game=self.game, max_players=4,
+                name="Table %d" % cnt) for cnt in range(7) ]
+        Session.objects.create(game=self.other, max_players=4)
+        sessions[3].add_player(self.profiles[0])
+        seen = []
+        before = None
+        while True:
+            with self.assertNumQueries(1):
+                page, before = open_sessions(
+                        self.game, before=before, limit=3)
+            seen.extend(page)
+            if before is None:
+                break
+        self.assertEqual([ row["id"] for row in seen ],
+                [ session.id for session in reversed(sessions) ])
+        self.assertEqual(seen[3]["open_seats"], 3)
+        self.assertFalse(seen[3]["locked"])
+        self.assertRaises(ValueError, open_sessions, self.game, limit=0)
+
+
+@skipUnless(connection.vendor == "sqlite", "reads the sqlite query plan")
+class LobbyIndexTestCase(TestCase):
+    """
+    Test the lobby index, kept apart from any test data because sqlite
+    commits before running EXPLAIN
+    """
+
+    def test_index(self):
+        """
+        Check the lobby query is answered from the lobby index
+        """
+        sql, params = Session.objects.joinable(1).values(
+                "deckuser_ptr")[:25].query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = " ".join([ str(row[-1]) for row in cursor.fetchall() ])
+        self.assertTrue("game_session_lobby" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+
+
+@skipUnless(connection.vendor == "sqlite", "builds the old schema with sqlite DDL")
+class SessionMigrationTestCase(TransactionTestCase):
+    """
+    Test adding the lobby, seat, revision and event number columns to an
+    older database
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=2)
+        self.session.add_player(UserProfile.objects.create(
+                user=User.objects.create(username="Yui")))
+        self.deck = self.session.add_deck("pile")
+        # sqlite cannot drop game_id, a column of a foreign key
+        cursor = connection.cursor()
+        cursor.execute("DROP INDEX game_session_lobby")
+        drop_columns(cursor, "game_session",
+                ["seats_taken", "joinable", "version", "event_seq"], "default")
+        drop_columns(cursor, "game_deck", ["revision"], "default")
+        drop_columns(cursor, "game_gameevent", ["seq"], "default")
+
+    def tearDown(self):
+        # Dropping the columns commits, leave no rows behind for later tests
+        call_command("flush", verbosity=0, interactive=False)
+
+    def test_migrate(self):
+        """
+        Check the columns and the index are added once and the seat
+        columns filled from the player list
+        """
+        output = StringIO()
+        call_command("migrate_session_columns", stdout=output)
+        self.assertIn("Session.joinable", output.getvalue())
+        self.assertIn("game_session_lobby", output.getvalue())
+        self.assertNotIn("Session.game,", output.getvalue())
+        session = Session.objects.get(id=self.session.id)
+        self.assertEqual(session.seats_taken, 1)
+        self.assertTrue(session.joinable)
+        self.assertEqual(session.version, 0)
+        self.assertIn(session, Session.objects.joinable())
+        self.assertEqual(Deck.objects.no_cache().get(
+                id=self.deck.id).revision, 0)
+        seqs = list(session.events.values_list("seq", flat=True))
+        self.assertEqual(seqs, range(1, len(seqs) + 1))
+        self.assertEqual(session.event_seq, len(seqs))
+        session.next_phase()
+        self.assertEqual(Session.objects.get(id=session.id).version, 1)
+        output = StringIO()
+        call_command("migrate_session_columns", stdout=output)
+        self.assertIn("already migrated", output.getvalue())
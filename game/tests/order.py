@@ -0,0 +1,101 @@
+"""
+Engine card order unit testing
+"""
+from django.test import SimpleTestCase
+from controller.order import DeckOrder
+from game.models.deck import shuffle_order
+from game.models.event import GameEvent
+from game.replay import GameState
+import random
+
+
+class DeckOrderTestCase(SimpleTestCase):
+    """
+    Test DeckOrder against plain lists
+    """
+
+    def test_ends(self):
+        """
+        Check cards come off both ends in list order
+        """
+        order = DeckOrder([1, 2, 3])
+        order.push_top(0)
+        for card_id in range(4, 40):
+            order.push_bottom(card_id)
+        self.assertEqual(list(order), range(40))
+        self.assertEqual(order.pop_top(), 0)
+        self.assertEqual(order.pop_bottom(), 39)
+        self.assertEqual(order.take_top(3), [1, 2, 3])
+        self.assertEqual([ order.pop_bottom() for cnt in range(30) ],
+                range(38, 8, -1))
+        self.assertEqual(list(order), range(4, 9))
+        self.assertEqual(len(order), 5)
+        self.assertRaises(IndexError, order.take_top, 6)
+
+    def test_lazy_shuffle(self):
+        """
+        Check a lazy shuffle ends like shuffle_order and only settles the
+        cards drawn
+        """
+        cards = range(10000)
+        order = DeckOrder(cards)
+        order.shuffle(42)
+        drawn = order.take_top(5)
+        self.assertTrue(order.shuffling)
+        self.assertEqual(order.top(2), list(order)[:2])
+        self.assertFalse(order.shuffling)
+        shuffle_order(cards, 42)
+        self.assertEqual(drawn, cards[:5])
+        self.assertEqual(list(order), cards[5:])
+
+    def test_matches_list(self):
+        """
+        Check random moves give the same order as on a list
+        """
+        for seed in range(20):
+            rng = random.Random(seed)
+            expected = range(rng.randrange(0, 30))
+            order = DeckOrder(expected)
+            next_id = len(expected)
+            for move in range(200):
+                choice = rng.randrange(7)
+                if choice == 0:
+                    shuffle_seed = rng.getrandbits(32)
+                    order.shuffle(shuffle_seed)
+                    shuffle_order(expected, shuffle_seed)
+                elif choice == 1:
+                    order.push_top(next_id)
+                    expected.insert(0, next_id)
+                    next_id = next_id + 1
+                elif choice == 2:
+                    order.push_bottom(next_id)
+                    expected.append(next_id)
+                    next_id = next_id + 1
+                elif choice == 3:
+                    index = rng.randrange(-5, 5)
+                    order.insert(index, next_id)
+                    expected.insert(index, next_id)
+                    next_id = next_id + 1
+                elif not expected:
+                    self.assertRaises(IndexError, order.pop_top)
+                elif choice == 4:
+                    self.assertEqual(order.pop_top(), expected.pop(0))
+                elif choice == 5:
+                    self.assertEqual(order.pop_bottom(), expected.pop())
+                else:
+                    index = rng.randrange(-len(expected), len(expected))
+                    self.assertEqual(order.pop(index), expected.pop(index))
+                self.assertEqual(len(order), len(expected))
+            self.assertEqual(list(order), expected)
+
+    def test_replay(self):
+        """
+        Check shuffles logged before shuffle_order still replay the same
+        """
+        state = GameState({"orders": {1: range(20), 2: range(20)}})
+        state.apply(GameEvent(action="shuffle", args=[1, 7]))
+        state.apply(GameEvent(action="shuffle", args=[2, 7, True]))
+        old, new = range(20), range(20)
+        random.Random(7).shuffle(old)
+        shuffle_order(new, 7)
+        self.assertEqual(state.orders, {1: old, 2: new})
@@ -0,0 +1,259 @@
+"""
+Push channel unit and load testing
+"""
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import RequestFactory
+from controller.engine import GameEngine
+from controller.push import LocalBroker, channel_name, get_broker
+from game.models.event import logging_transaction
+from game.models.session import DeckUser, Session
+from game.models.user import UserProfile
+from game.tests.card import create_card
+from game.views import session_events
+import json
+import threading
+import time
+
+
+class LocalBrokerTestCase(TestCase):
+    """
+    Test the in-process broker
+    """
+
+    def test_listen(self):
+        """
+        Check listeners get the messages after their sequence number
+        """
+        broker = LocalBroker(backlog=4)
+        self.assertEqual(broker.listen(1, 0, timeout=0), [])
+        for cnt in range(3):
+            broker.publish(1, {"cnt": cnt})
+        self.assertEqual(broker.listen(1, 1, timeout=0),
+                [(2, {"cnt": 1}), (3, {"cnt": 2})])
+        self.assertEqual(broker.listen(2, 0, timeout=0), [])
+        for cnt in range(3, 6):
+            broker.publish(1, {"cnt": cnt})
+        # Messages 1 and 2 fell out of the backlog
+        self.assertEqual(broker.listen(1, 0, timeout=0), None)
+        self.assertEqual(broker.listen(1, 2, timeout=0)[0], (3, {"cnt": 2}))
+        # A sequence number from another broker means a restart
+        self.assertEqual(broker.listen(1, 50, timeout=0), None)
+
+    def test_idle(self):
+        """
+        Check channels only exist while they have listeners or had within
+        the idle time
+        """
+        broker = LocalBroker(idle_time=0.05)
+        self.assertEqual(broker.publish("idle", {"cnt": 0}), None)
+        self.assertFalse(broker.subscribed("idle"))
+        self.assertEqual(broker.listen("idle", 0, timeout=0), [])
+        self.assertTrue(broker.subscribed("idle"))
+        self.assertEqual(broker.publish("idle", {"cnt": 1}), 1)
+        time.sleep(0.1)
+        self.assertFalse(broker.subscribed("idle"))
+        self.assertEqual(broker.last("idle"), 0)
+        listener = threading.Thread(target=broker.listen,
+                args=("idle", 0, 0.3))
+        listener.start()
+        time.sleep(0.1)
+        self.assertTrue(broker.subscribed("idle"))
+        listener.join()
+
+    def test_load(self):
+        """
+        Check every connected listener gets every message once, with one
+        publish per message
+        """
+        broker = LocalBroker(backlog=1000)
+        publish = broker.publish
+        published = []
+
+        def counted_publish(session_id, message):
+            published.append(message)
+            return publish(session_id, message)
+        broker.publish = counted_publish
+
+        num_messages = 200
+        received = {}
+        for session_id in range(4):
+            broker.listen(session_id, 0, timeout=0)
+
+        def listener(name, session_id):
+            seen = []
+            since = 0
+            while len(seen) < num_messages:
+                messages = broker.listen(session_id, since, timeout=5)
+                if not messages:
+                    break
+                seen.extend([ message["cnt"] for seq, message in messages ])
+                since = messages[-1][0]
+            received[name] = seen
+
+        threads = [ threading.Thread(target=listener, args=(cnt, cnt % 4))
+                for cnt in range(100) ]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        for cnt in range(num_messages):
+            for session_id in range(4):
+                broker.publish(session_id, {"cnt": cnt})
+        for thread in threads:
+            thread.join(30)
+        self.assertTrue(time.time() - start < 30)
+        self.assertEqual(len(published), 4 * num_messages)
+        self.assertEqual(len(received), 100)
+        for seen in received.values():
+            self.assertEqual(seen, range(num_messages))
+
+
+class SessionEventsTestCase(TestCase):
+    """
+    Test pushing logged game events to players
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=2)
+        for phase in ["Draw", "Play"]:
+            self.session.add_phase(phase)
+        self.players = []
+        for name in ["Izumi Konata", "Hiiragi Kagami"]:
+            test_user = User.objects.create(username=name)
+            self.players.append(self.session.add_player(
+                UserProfile.objects.create(user=test_user)))
+        self.factory = RequestFactory()
+        self.broker = get_broker()
+        # Subscribe, nothing is published to a session nobody listens to
+        self.broker.listen(channel_name(self.session.id), 0, timeout=0)
+
+    def last(self):
+        return self.broker.last(channel_name(self.session.id))
+
+    def get(self, player_key, **params):
+        params["player_key"] = player_key
+        request = self.factory.get("/", params, **params.pop("headers", {}))
+        return session_events(request, str(self.session.id))
+
+    def test_player_key(self):
+        """
+        Check only players of the session can listen
+        """
+        self.assertTrue(self.players[0].player_key)
+        self.assertNotEqual(
+                self.players[0].player_key, self.players[1].player_key)
+        response = self.get("not a key", timeout=0)
+        self.assertEqual(response.status_code, 403)
+        other = Session.objects.create(max_players=1)
+        request = self.factory.get("/", {
+                "player_key": self.players[0].player_key, "timeout": 0})
+        self.assertEqual(
+                session_events(request, str(other.id)).status_code, 403)
+
+    def test_long_poll(self):
+        """
+        Check a move is pushed with a single query for the player check
+        """
+        since = self.last()
+        self.session.next_phase()
+        with self.assertNumQueries(1):
+            response = self.get(
+                    self.players[1].player_key, since=since, timeout=0)
+        data = json.loads(response.content)
+        self.assertEqual(data["last"], since + 1)
+        self.assertEqual(data["events"],
+                [{"seq": since + 1, "action": "next_phase", "args": []}])
+        response = self.get(
+                self.players[1].player_key, since=data["last"], timeout=0)
+        self.assertEqual(json.loads(response.content)["events"], [])
+
+    def test_engine_batch(self):
+        """
+        Check a flushed engine batch is published once, with every move
+        """
+        since = self.last()
+        engine = GameEngine(self.session, flush_on_turn=False)
+        engine.next_phase()
+        engine.swap_players(0, 1)
+        self.assertEqual(self.last(), since)
+        engine.flush()
+        self.assertEqual(self.last(), since + 1)
+        response = self.get(self.players[0].player_key, since=since)
+        self.assertEqual(
+                [ event["action"] for event in
+                    json.loads(response.content)["events"] ],
+                ["next_phase", "swap_players"])
+
+    def test_event_stream(self):
+        """
+        Check server-sent events resume from Last-Event-ID
+        """
+        since = self.last()
+        self.session.swap_players(0, 1)
+        response = self.get(self.players[0].player_key, headers={
+                "HTTP_ACCEPT": "text/event-stream",
+                "HTTP_LAST_EVENT_ID": str(since),
+                })
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunk = iter(response).next()
+        self.assertEqual(chunk, "id: %d\ndata: %s\n\n" % (since + 1,
+                json.dumps({"action": "swap_players", "args": [0, 1]})))
+
+    def test_hidden_cards(self):
+        """
+        Check players are only sent the card ids they can see and never a
+        shuffle seed
+        """
+        pile = self.session.add_deck("pile")
+        hand = self.players[1].add_deck("hand")
+        pile.insert_cards([ create_card("Choco Cornet %d" % cnt)
+            for cnt in range(4) ])
+        since = self.last()
+        pile.shuffle(seed=3)
+        DeckUser.draw_cards(pile, hand, num_cards=2)
+        card = hand.remove_card()
+        messages = [ json.loads(self.get(player.player_key,
+                since=since, timeout=0).content)["events"]
+                for player in self.players ]
+        self.assertEqual([ event["args"] for event in messages[0] ], [
+                [pile.id],
+                [pile.id, hand.id, 2, [None, None]],
+                [hand.id, 0, None],
+                ])
+        self.assertEqual(messages[1][0]["args"], [pile.id])
+        self.assertEqual(messages[1][1]["args"][3],
+                [ card_id for card_id in messages[1][1]["args"][3]
+                    if card_id ])
+        self.assertEqual(messages[1][2]["args"], [hand.id, 0, card.id])
+
+    def test_after_commit(self):
+        """
+        Check events are published once their transaction committed and
+        never if it was rolled back
+        """
+        since = self.last()
+        with logging_transaction():
+            self.session.next_phase()
+            self.assertEqual(self.last(), since)
+        self.assertEqual(self.last(), since + 1)
+        try:
+            with logging_transaction():
+                self.session.next_phase()
+                raise ValueError("rolled back")
+        except ValueError:
+            pass
+        self.assertEqual(self.last(), since + 1)
+
+    def test_no_listener(self):
+        """
+        Check moves of a session nobody listens to are not published and
+        cost no query
+        """
+        session = Session.objects.create(max_players=1)
+        session.add_phase("Draw")
+        # The session update, the event number update and read, and the
+        # event insert
+        with self.assertNumQueries(4):
+            session.next_phase()
+        self.assertFalse(self.broker.subscribed(channel_name(session.id)))
+        self.assertEqual(self.broker.last(channel_name(session.id)), 0)
@@ -0,0 +1,73 @@
+"""
+Migration schema helper unit testing
+"""
+from django.db import connection, IntegrityError
+from django.test import TestCase
+from django.utils.unittest import skipUnless
+from game.management.schema import rebuild_table, table_columns
+
+
+@skipUnless(connection.vendor == "sqlite", "rebuilds sqlite tables")
+class RebuildTableTestCase(TestCase):
+    """
+    Test dropping columns on SQLite releases without DROP COLUMN, on
+    scratch tables as sqlite commits before DDL
+    """
+
+    def setUp(self):
+        self.cursor = connection.cursor()
+        self.cursor.execute("CREATE TABLE scratch_owner "
+                "(id integer NOT NULL PRIMARY KEY)")
+        self.cursor.execute("CREATE TABLE scratch_card ("
+                "id integer NOT NULL PRIMARY KEY, "
+                "name varchar(16) NOT NULL UNIQUE, "
+                "owner_id integer NULL REFERENCES scratch_owner (id), "
+                "position integer NOT NULL DEFAULT 0, "
+                "legacy text NOT NULL)")
+        self.cursor.execute("CREATE INDEX scratch_card_owner "
+                "ON scratch_card (owner_id)")
+        self.cursor.execute("CREATE INDEX scratch_card_legacy "
+                "ON scratch_card (legacy, position)")
+        self.cursor.execute("INSERT INTO scratch_owner (id) VALUES (1)")
+        self.cursor.executemany("INSERT INTO scratch_card "
+                "(id, name, owner_id, position, legacy) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [(1, "Suzumiya Haruhi", 1, 2, "a"),
+                    (2, "Nagato Yuki", None, 1, "b")])
+
+    def tearDown(self):
+        for table in ("scratch_card", "scratch_owner"):
+            self.cursor.execute("DROP TABLE IF EXISTS %s" % table)
+
+    def indexes(self):
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = 'scratch_card' "
+                "AND sql IS NOT NULL")
+        return sorted([ row[0] for row in self.cursor.fetchall() ])
+
+    def test_rebuild(self):
+        """
+        Check the rows, constraints and indexes of the other columns
+        survive
+        """
+        rebuild_table(self.cursor, "scratch_card", ["legacy"], "default")
+        self.assertEqual(
+                table_columns(self.cursor, "scratch_card", "default"),
+                ["id", "name", "owner_id", "position"])
+        self.cursor.execute("SELECT id, name, owner_id, position "
+                "FROM scratch_card ORDER BY id")
+        self.assertEqual(self.cursor.fetchall(),
+                [(1, "Suzumiya Haruhi", 1, 2), (2, "Nagato Yuki", None, 1)])
+        self.assertEqual(self.indexes(), ["scratch_card_owner"])
+        self.cursor.execute("PRAGMA foreign_key_list(scratch_card)")
+        self.assertEqual([ row[2:5] for row in self.cursor.fetchall() ],
+                [("scratch_owner", "owner_id", "id")])
+        # Inserts leaving out the dropped column work again
+        self.cursor.execute("INSERT INTO scratch_card (id, name) "
+                "VALUES (3, 'Asahina Mikuru')")
+        self.cursor.execute(
+                "SELECT position FROM scratch_card WHERE id = 3")
+        self.assertEqual(self.cursor.fetchone(), (0,))
+        self.assertRaises(IntegrityError, self.cursor.execute,
+                "INSERT INTO scratch_card (id, name) "
+                "VALUES (4, 'Nagato Yuki')")
@@ -3,11 +3,22 @@ Session models unit testing
 """
 from django.contrib.auth.models import User
 from django.utils.datastructures import SortedDict
-from game.models.session import DeckUser, Session
+from game.models.session import DeckUser, SeatConflict, Session
 from game.models.user import UserProfile
+from game.tests.card import create_card
 from game.models.card import Card
-from django.test import TestCase
+from game.models.deck import Deck
+from game.models.event import GameCheckpoint, GameEvent
+from game.models.game_info import GameInfo
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.utils.unittest import skipUnless
 from game.models.player import Player
+from game.snapshot import SnapshotError
+from game.tests.concurrency import SharedConnectionMixin
+from cStringIO import StringIO
+import struct
 
 
 class DeckUserTestCase(TestCase):
@@ -18,19 +29,19 @@ class DeckUserTestCase(TestCase):
     def setUp(self):
         self.test_data = SortedDict([
                 ("FF8", [
-                    Card.objects.create(name="Laguna Loire"),
-                    Card.objects.create(name="Quistis Trepe"),
-                    Card.objects.create(name="Irvine Kinneas"),
+                    create_card("Laguna Loire"),
+                    create_card("Quistis Trepe"),
+                    create_card("Irvine Kinneas"),
                     ]),
                 ("FF9", [
-                    Card.objects.create(name="Vivi"),
-                    Card.objects.create(name="Garnet"),
-                    Card.objects.create(name="Eiko"),
+                    create_card("Vivi"),
+                    create_card("Garnet"),
+                    create_card("Eiko"),
                     ]),
                 ("FF12", [
-                    Card.objects.create(name="Vaan"),
-                    Card.objects.create(name="Ashe"),
-                    Card.objects.create(name="Bathier"),
+                    create_card("Vaan"),
+                    create_card("Ashe"),
+                    create_card("Bathier"),
                     ]),
                 ])
         test_user = User.objects.create(username="final_fantasy")
@@ -68,6 +79,18 @@ class DeckUserTestCase(TestCase):
                 DeckUser.objects.get(id=self.session.id).get_class(),
                 self.session)
 
+    def test_resolve_classes(self):
+        """
+        Check resolving rows to subclasses costs one query per subclass
+        """
+        query_set = DeckUser.objects.no_cache().filter(
+                id__in=[self.player.id, self.session.id]).order_by("id")
+        with self.assertNumQueries(3):
+            resolved = query_set.resolve_classes()
+        self.assertEqual(resolved, [self.session, self.player])
+        self.assertEqual(
+                [ obj.__class__ for obj in resolved ], [Session, Player])
+
     def test_draw_card(self):
         """
         Check draw engine
@@ -90,6 +113,45 @@ class DeckUserTestCase(TestCase):
         self.assertEqual(deck_list[2].card_list, [])
         self.assertEqual(deck_list[1].card_list, deck_2[::-1] + deck_0[::-1] + deck_1)
 
+    def test_draw_negative(self):
+        """
+        Check drawing a negative number of cards moves and logs nothing
+        """
+        deck = self.player.add_deck("FF8")
+        hand = self.player.add_deck("hand")
+        deck.insert_cards(self.test_data["FF8"])
+        events = self.session.events.count()
+        self.assertRaises(ValueError, DeckUser.draw_cards, deck, hand,
+                num_cards=-2)
+        self.assertEqual(deck.card_list, self.test_data["FF8"][::-1])
+        self.assertEqual(Deck.objects.get(id=hand.id).length, 0)
+        self.assertEqual(self.session.events.count(), events)
+
+    def test_draw_card_queries(self):
+        """
+        Check drawing a whole deck costs the same as drawing one card
+        """
+        small = self.player.add_deck("small")
+        large = self.player.add_deck("large")
+        hand = self.player.add_deck("hand")
+        small.insert_cards(self.test_data["FF8"][:1])
+        large.insert_cards(self.test_data["FF9"] + self.test_data["FF12"])
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            DeckUser.draw_cards(small, hand, all=True)
+            small_cnt = len(connection.queries) - start
+            start = len(connection.queries)
+            DeckUser.draw_cards(large, hand, all=True)
+            large_cnt = len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = False
+        self.assertEqual(small_cnt, large_cnt)
+        self.assertEqual(hand.length, 7)
+        self.assertEqual(hand.cards.count(), 7)
+        self.assertEqual(
+                Deck.objects.get(id=hand.id).card_list, hand.card_list)
+
 
 class SessionTestCase(TestCase):
     """
@@ -188,6 +250,34 @@ class SessionTestCase(TestCase):
                 ]
         self.assertEqual(self.session.player_list, check_list)
 
+    def test_stale_save(self):
+        """
+        Check a session loaded before a join keeps the new player seated
+        when it advances the phase
+        """
+        self.session.add_phase("Draw")
+        self.session.add_phase("Play")
+        joined = self.session.add_player(self.user_list[0])
+        stale = Session.objects.get(id=self.session.id)
+        other = self.session.add_player(self.user_list[1])
+        stale.next_phase()
+        session = Session.objects.get(id=self.session.id)
+        self.assertEqual(session._player_list, [joined.id, other.id])
+        self.assertEqual(session.seats_taken, 2)
+        self.assertEqual(session.phase, 1)
+        self.assertEqual(session.version, self.session.version + 1)
+        self.assertEqual(stale._player_list, session._player_list)
+        # The outdated instance retries its own save on the new version
+        self.session.next_phase()
+        self.assertEqual(Session.objects.get(id=self.session.id).version,
+                self.session.version)
+        self.assertEqual(self.session._player_list, [joined.id, other.id])
+        # Seats changed in memory are not written over a newer version
+        stale._change_seats(lambda seats: seats.reverse(), save=False)
+        self.assertRaises(SeatConflict, stale.save)
+        self.assertEqual(Session.objects.get(id=self.session.id)._player_list,
+                [joined.id, other.id])
+
     def test_num_players(self):
         for user in self.user_list:
             self.player_list.append(self.session.add_player(user))
@@ -218,3 +308,274 @@ class SessionTestCase(TestCase):
                 self.player_list[4],
                 ]
         self.assertEqual(self.session.player_list, check_list)
+
+    def test_player_list_queries(self):
+        """
+        Check every seat and the current player cost one query until the
+        seating changes
+        """
+        for user in self.user_list:
+            self.player_list.append(self.session.add_player(user))
+        self.session.remove_player(index=3)
+        session = Session.objects.get(id=self.session.id)
+        with self.assertNumQueries(1):
+            players = session.player_list
+            self.assertEqual(players[3], None)
+            self.assertEqual(
+                    [ player and player.user.user.username
+                        for player in players ],
+                    [ player.user.user.username if cnt != 3 else None
+                        for cnt, player in enumerate(self.player_list) ])
+            self.assertEqual(players[0].session, session)
+            self.assertEqual(session.current_player(), self.player_list[0])
+            self.assertEqual(session.player_list, players)
+        session.swap_players(0, 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(session.current_player(), self.player_list[1])
+
+
+class SessionSnapshotTestCase(TestCase):
+    """
+    Test exporting and importing whole sessions
+    """
+
+    def setUp(self):
+        self.session = Session.objects.create(name="Tokyo", max_players=4)
+        for phase in ["Draw", "Play"]:
+            self.session.add_phase(phase)
+        for name in ["Okabe Rintarou", "Shiina Mayuri", "Makise Kurisu"]:
+            test_user = User.objects.create(username=name)
+            player = self.session.add_player(
+                    UserProfile.objects.create(user=test_user))
+            hand = player.add_deck("hand")
+            hand.insert_cards([ create_card("%s %d" % (name, cnt))
+                for cnt in range(3) ])
+        self.session.remove_player(index=1)
+        pile = self.session.add_deck("pile")
+        pile.insert_cards([ create_card("D-Mail %d" % cnt)
+            for cnt in range(10) ])
+        pile.shuffle()
+        self.session.next_phase()
+        self.session.next_phase()
+        self.session.next_phase()
+
+    def game_state(self, session):
+        """
+        Read a session back into plain python values
+        """
+        session = Session.objects.get(id=session.id)
+        decks = {}
+        for deck in Deck.objects.filter(user=session):
+            decks[("session", deck.name)] = [
+                    card.name for card in deck.card_list ]
+        for player in session.players.all():
+            for deck in Deck.objects.filter(user=player):
+                decks[(player.user.user.username, deck.name)] = [
+                        card.name for card in deck.card_list ]
+        return {
+                "name": session.name,
+                "turn": session.turn,
+                "phase": session.phase,
+                "phase_list": session.phase_list,
+                "seats": [ player and player.user.user.username
+                    for player in session.player_list ],
+                "decks": decks,
+                }
+
+    def test_round_trip(self):
+        """
+        Check a restored session matches the original
+        """
+        restored = Session.restore(self.session.snapshot())
+        self.assertNotEqual(restored.id, self.session.id)
+        self.assertEqual(
+                self.game_state(restored), self.game_state(self.session))
+        self.assertEqual(self.game_state(restored)["seats"][1], None)
+
+    def test_player_keys(self):
+        """
+        Check restored players get new keys unless they are kept for a
+        move to another database
+        """
+        keys = set(Player.objects.filter(
+                session=self.session).values_list("player_key", flat=True))
+        restored = Session.restore(self.session.snapshot())
+        restored_keys = set(Player.objects.filter(
+                session=restored).values_list("player_key", flat=True))
+        self.assertEqual(len(restored_keys), len(keys))
+        self.assertFalse(keys & restored_keys)
+        moved = Session.restore(self.session.snapshot(), keep_keys=True)
+        self.assertEqual(set(Player.objects.filter(
+                session=moved).values_list("player_key", flat=True)), keys)
+
+    def test_stream(self):
+        """
+        Check snapshots can be streamed through file-like objects
+        """
+        stream = StringIO()
+        self.session.snapshot(stream)
+        stream.seek(0)
+        restored = Session.restore(stream)
+        self.assertEqual(
+                self.game_state(restored), self.game_state(self.session))
+
+    def test_bad_snapshot(self):
+        """
+        Check garbage and truncated snapshots are rejected
+        """
+        data = self.session.snapshot()
+        self.assertRaises(SnapshotError, Session.restore, "JUNK" + data[4:])
+        self.assertRaises(SnapshotError, Session.restore, data[:-3])
+        self.assertRaises(SnapshotError, Session.restore,
+                data[:4] + struct.pack("<H", 99) + data[6:])
+
+    def test_game(self):
+        """
+        Check the game of a session survives a snapshot and a version 1
+        snapshot, which has none, is restored without a game
+        """
+        self.session.game = GameInfo.objects.create(
+                name="Steins;Gate", ref="SteinsGate", desc="Divergence")
+        self.session.save()
+        data = self.session.snapshot()
+        self.assertEqual(Session.restore(data).game_id, self.session.game_id)
+        # The game id follows the name, password and status strings
+        offset = 6
+        for cnt in range(3):
+            offset += 2 + struct.unpack("<H", data[offset:offset + 2])[0]
+        legacy = data[:4] + struct.pack("<H", 1) + data[6:offset] + \
+                data[offset + 4:]
+        restored = Session.restore(legacy)
+        self.assertEqual(restored.game_id, None)
+        self.assertEqual(
+                self.game_state(restored), self.game_state(self.session))
+
+
+
+@skipUnless("other" in settings.DATABASES, "needs an \"other\" database")
+class SnapshotDatabaseTestCase(TestCase):
+    """
+    Test restoring a snapshot into another database, with an "other"
+    alias in DATABASES
+    """
+
+    multi_db = True
+
+    def test_restore_using(self):
+        """
+        Check every row of a restored session, checkpoint included, is
+        written to the database it is restored into
+        """
+        session = Session.objects.create(name="Akihabara", max_players=2)
+        session.add_player(UserProfile.objects.create(
+                user=User.objects.create(username="Hashida Itaru")))
+        pile = session.add_deck("pile")
+        pile.insert_cards([ create_card("IBN 5100 %d" % cnt)
+            for cnt in range(3) ])
+        checkpoints = GameCheckpoint.objects.count()
+        restored = Session.restore(session.snapshot(), using="other")
+        self.assertEqual(restored._state.db, "other")
+        self.assertFalse(Session.objects.filter(name="Akihabara").exclude(
+                id=session.id).exists())
+        self.assertEqual(Session.objects.using("other").get(
+                id=restored.id)._player_list, restored._player_list)
+        decks = Deck.objects.using("other").filter(user=restored)
+        self.assertEqual([ deck.name for deck in decks ], ["pile"])
+        self.assertEqual(Card.objects.using("other").filter(
+                deck=decks[0]).count(), 3)
+        checkpoint = GameCheckpoint.objects.using("other").filter(
+                session=restored.id).order_by("-id")[0]
+        self.assertEqual(checkpoint.state["orders"], {decks[0].id: list(
+                Card.objects.using("other").filter(deck=decks[0]).order_by(
+                    "position").values_list("id", flat=True))})
+        self.assertEqual(GameCheckpoint.objects.count(), checkpoints)
+
+    def test_play_card(self):
+        """
+        Check a card moves and its events are logged in the database the
+        session was restored into
+        """
+        session = Session.objects.create(name="Akihabara", max_players=2)
+        player = session.add_player(UserProfile.objects.create(
+                user=User.objects.create(username="Hashida Itaru")))
+        player.add_deck("hand").insert_cards([
+                create_card("IBN 5100 %d" % cnt) for cnt in range(2) ])
+        session.add_deck("pile")
+        restored = Session.restore(session.snapshot(), using="other")
+        # Nothing of the session is left to find in the default database
+        session.delete()
+        decks = Deck.objects.using("other")
+        hand = decks.get(name="hand", user__in=Player.objects.using(
+                "other").filter(session=restored))
+        pile = decks.get(name="pile", user=restored)
+        card = hand.play_card(pile)
+        self.assertEqual(decks.get(id=pile.id).card_list, [card])
+        self.assertEqual(decks.get(id=hand.id).length, 1)
+        event = GameEvent.objects.using("other").filter(
+                session=restored.id).order_by("-id")[0]
+        self.assertEqual((event.action, event.args),
+                ("insert_card", [pile.id, card.id, 0]))
+
+
+class SessionJoinTestCase(SharedConnectionMixin, TransactionTestCase):
+    """
+    Test seat changes racing each other from many threads
+    """
+
+    SEATS = 5
+
+    def setUp(self):
+        self.session = Session.objects.create(max_players=self.SEATS)
+        self.profiles = [ UserProfile.objects.create(
+                user=User.objects.create(username="Worker %d" % cnt))
+                for cnt in range(self.WORKERS) ]
+        self.share_connection()
+
+    def tearDown(self):
+        self.unshare_connection()
+
+    def hammer(self, work):
+        """
+        Run work(session, cnt) once per worker, every worker starting from
+        the same version of the session
+        """
+        return super(SessionJoinTestCase, self).hammer(
+                lambda: Session.objects.get(id=self.session.id), work)
+
+    def test_concurrent_joins(self):
+        """
+        Check racing joins fill every seat exactly once
+        """
+        results = self.hammer(
+                lambda session, cnt: session.add_player(self.profiles[cnt]))
+        seated = [ result for result in results
+                if isinstance(result, Player) ]
+        self.assertEqual(len(seated), self.SEATS)
+        for result in results:
+            if not isinstance(result, Player):
+                self.assertTrue(isinstance(result, ValueError))
+        session = Session.objects.get(id=self.session.id)
+        self.assertEqual(sorted(session._player_list),
+                sorted([ player.id for player in seated ]))
+        self.assertEqual(sorted(session._player_list), sorted(
+                Player.objects.filter(session=session).values_list(
+                    "id", flat=True)))
+        self.assertEqual(session.seats_taken, self.SEATS)
+        self.assertFalse(session.joinable)
+        self.assertEqual(session.version, self.SEATS)
+
+    def test_concurrent_swaps(self):
+        """
+        Check racing reseats never lose or duplicate a player
+        """
+        for profile in self.profiles[:self.SEATS]:
+            self.session.add_player(profile)
+        players = sorted(self.session._player_list)
+        results = self.hammer(lambda session, cnt: session.swap_players(
+                cnt % self.SEATS, (cnt + 1) % self.SEATS))
+        session = Session.objects.get(id=self.session.id)
+        self.assertEqual(sorted(session._player_list), players)
+        conflicts = len([ result for result in results
+                if isinstance(result, SeatConflict) ])
+        self.assertEqual(session.version,
+                self.SEATS + self.WORKERS - conflicts)
@@ -0,0 +1,71 @@
+"""
+Headless game simulator unit testing
+"""
+from django.test import TestCase
+from game.models.deck import Deck
+from game.models.session import Session
+from game.simulator import count_retries, percentile, play_turn, run_turn, \
+        setup_game, _retries
+import random
+
+
+class SimulatorTestCase(TestCase):
+    """
+    Test simulated games keep their cards and count contention
+    """
+
+    def setUp(self):
+        self.session = setup_game(20, "Tea party", players=3, seed=5)
+
+    def cards(self):
+        return sum([ deck.length for deck in Deck.objects.no_cache().filter(
+            user__in=[self.session.id] + [ player.id for player in
+                self.session.player_list ]) ])
+
+    def test_play_turn(self):
+        """
+        Check turns move cards around without losing any, shuffling the
+        discard pile back into the pile once it runs out
+        """
+        steps = []
+
+        def step(action, func, *args, **kwargs):
+            steps.append(action)
+            return func(*args, **kwargs)
+
+        rng = random.Random(1)
+        for turn in range(6):
+            play_turn(self.session, rng, step)
+        self.assertEqual(self.session.turn, 6)
+        self.assertEqual(self.cards(), 20)
+        self.assertTrue("shuffle" in steps)
+        self.assertEqual(steps.count("next_phase"), 12)
+
+    def test_run_turn(self):
+        """
+        Check a pool task reports its timings, and that moves from a stale
+        deck are counted as retries
+        """
+        restore = count_retries()
+        try:
+            pile = self.session.deck_list["pile"]
+            stale = Deck.objects.no_cache().get(id=pile.id)
+            stale.card_list
+            result = run_turn((self.session.id, 3))
+            self.assertEqual(result["failure"], None)
+            self.assertEqual([ action for action, seconds in
+                result["timings"] ], ["draw_cards", "next_phase",
+                    "play_card", "next_phase"])
+            retries = _retries.count
+            stale.shuffle(seed=2)
+            self.assertEqual(_retries.count, retries + 1)
+        finally:
+            restore()
+        self.assertEqual(Session.objects.get(id=self.session.id).turn, 1)
+        self.assertEqual(self.cards(), 20)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+        self.assertEqual(percentile([], 0.5), None)
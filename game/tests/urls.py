@@ -0,0 +1,12 @@
+"""
+Site urls for the view tests, without the social_auth dependency
+"""
+from django.conf.urls import patterns, url
+import game.views
+
+urlpatterns = patterns('',
+    url(r'^$', game.views.HomeView.as_view()),
+    url(r'^games/$', game.views.GameList.as_view()),
+    url(r'^login/(?P<backend>[^/]+)/$', game.views.HomeView.as_view(),
+        name="socialauth_begin"),
+)
@@ -0,0 +1,80 @@
+"""
+Page view unit testing
+"""
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from game.models.game_info import GameInfo
+from game.views import HomeView
+
+
+class PageViewTestCase(TestCase):
+    """
+    Test cached page rendering
+    """
+
+    urls = "game.tests.urls"
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_home(self):
+        """
+        Check the landing page costs no queries for anonymous visitors
+        """
+        for cnt in range(2):
+            with self.assertNumQueries(0):
+                response = self.client.get("/")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue("Login with Google" in response.content)
+
+    def test_game_list(self):
+        """
+        Check the game list is rendered once per version of the games
+        """
+        game = GameInfo.objects.create(
+                name="Carta de Amor", ref="CartaDeAmor", desc="Love letters")
+        self.assertTrue("Carta de Amor" in self.client.get("/games/").content)
+        with self.assertNumQueries(0):
+            response = self.client.get("/games/")
+        self.assertTrue("Carta de Amor" in response.content)
+        game.name = "Love Letter"
+        game.save()
+        response = self.client.get("/games/")
+        self.assertTrue("Love Letter" in response.content)
+        self.assertFalse("Carta de Amor" in response.content)
+
+    def test_game_list_etag(self):
+        """
+        Check a current copy of the game list is answered with a 304
+        before anything is rendered
+        """
+        game = GameInfo.objects.create(
+                name="Carta de Amor", ref="CartaDeAmor", desc="Love letters")
+        etag = self.client.get("/games/")["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get("/games/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+        game.save()
+        response = self.client.get("/games/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_message(self):
+        """
+        Check the session is only written when a message is shown
+        """
+        store = SessionStore()
+        store["message"] = {"text": "Hello", "type": "alert-success"}
+        store.save()
+        for message in [store["message"], None]:
+            request = RequestFactory().get("/")
+            request.session = SessionStore(store.session_key)
+            request.user = AnonymousUser()
+            response = HomeView.as_view()(request)
+            self.assertEqual(response.context_data.get("message"), message)
+            self.assertEqual(request.session.modified, bool(message))
+            request.session.save()
@@ -7,8 +7,33 @@ from django.views.generic.base import TemplateView
 from django.utils.datastructures import SortedDict
 from django.shortcuts import redirect
 from django.contrib.auth import logout
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponseForbidden, HttpResponseNotAllowed
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from controller.actions import ActionError, apply_actions
+from controller.delta import changes_since, revision
+from controller.engine import GameEngine
+from controller.push import channel_name, get_broker, player_events, \
+        TIMEOUT, STREAM_TIME
+from game.instrument import stats as method_stats
+from game.lobby import open_sessions
+from game.models.cache import stats as cache_stats
+from game.models.deck import DeckConflict
 from game.models.game_info import GameInfo
+from game.models.player import Player
+from game.models.session import SeatConflict, Session
 from game.models.user import UserProfile
+import json
+import time
+
+
+# Seconds a rendered fragment is kept, stale ones are retired by version
+FRAGMENT_TIMEOUT = getattr(settings, "GAME_FRAGMENT_TIMEOUT", 60 * 60)
 
 
 def template_factory(base_class):
@@ -28,17 +53,29 @@ def template_factory(base_class):
         script_list = [
                 ]
 
+        @classmethod
+        def get_script_list(cls):
+            """
+            Join the base and view scripts once per view class
+            """
+            if "_all_scripts" not in cls.__dict__:
+                cls._all_scripts = cls.base_script_list + cls.script_list
+            return cls._all_scripts
+
         def get_context_data(self, **kwargs):
             """
             Give base site context
             """
             context = super(BaseView, self).get_context_data(**kwargs)
-            if self.request.session.get("message"):
-                context['message'] = self.request.session.get("message")
-                self.request.session["message"] = None
+            # pop only marks the session modified when there was a message
+            message = self.request.session.pop("message", None)
+            if message:
+                context['message'] = message
             context['nav_list'] = self.__class__.nav_list
+            context['nav_key'] = self.__class__.__name__
             context['page_title'] = self.__class__.page_title
-            context['script_list'] = self.__class__.base_script_list + self.__class__.script_list
+            context['script_list'] = self.get_script_list()
+            context['fragment_timeout'] = FRAGMENT_TIMEOUT
             return context
 
     return BaseView
@@ -83,6 +120,17 @@ def logout_view(request):
     return redirect('/')
 
 
+def game_list_etag(request, *args, **kwargs):
+    """
+    Tag the game list with the games version and the user it was
+    rendered for, pages showing a flash message are never matched
+    """
+    if request.session.get("message"):
+        return None
+    return "games-%d-%s" % (GameInfo.cache_version(),
+            request.user.pk if request.user.is_authenticated() else "anon")
+
+
 class GameList(LView):
     """
     View class for list of games
@@ -91,4 +139,250 @@ class GameList(LView):
     page_title = 'Games List'
     model = GameInfo
 
+    @method_decorator(condition(etag_func=game_list_etag))
+    def dispatch(self, request, *args, **kwargs):
+        """
+        Answer 304 before rendering when the client's copy is current
+        """
+        return super(GameList, self).dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        """
+        Key the cached list on the games version, the queryset is only
+        run when the fragment has to be rendered again
+        """
+        context = super(GameList, self).get_context_data(**kwargs)
+        context['game_list_version'] = GameInfo.cache_version()
+        return context
+
+
+def _json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+            content_type="application/json")
+
+
+def _not_modified(request, etag):
+    """
+    @return: a 304 response if the client already holds etag, else None
+    """
+    if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        response = HttpResponseNotModified()
+        response["ETag"] = quote_etag(etag)
+        return response
+    return None
+
+
+def lobby_view(request, game_ref):
+    """
+    List the joinable sessions of a game as JSON, newest first
+
+    GET parameters:
+        before: id of the last session of the previous page (optional)
+    """
+    try:
+        game = GameInfo.objects.get(ref=game_ref)
+    except GameInfo.DoesNotExist:
+        return _json_response({"error": "Unknown game"}, status=404)
+    try:
+        before = request.GET.get("before")
+        sessions, next_before = open_sessions(
+                game, before=int(before) if before else None)
+    except ValueError:
+        return _json_response({"error": "Invalid page"}, status=400)
+    return _json_response({"sessions": sessions, "next": next_before})
+
+
+def session_events(request, session_id):
+    """
+    Push the game events of a session to one of its players, as that
+    player may see them, see controller.push.player_events
+
+    Clients asking for text/event-stream get server-sent events until
+    GAME_PUSH_STREAM_TIME passes, every other request is a long-poll
+    answered with JSON as soon as an event arrives or timeout passes.
 
+    GET parameters:
+        player_key: key of a Player of the session (or X-Player-Key header)
+        since: last event sequence number seen (or Last-Event-ID header),
+            default only events from now on
+        timeout: seconds to wait, capped at GAME_PUSH_TIMEOUT
+    """
+    session_id = int(session_id)
+    player_key = request.GET.get(
+            "player_key", request.META.get("HTTP_X_PLAYER_KEY"))
+    player_ids = player_key and list(Player.objects.filter(
+            session=session_id, player_key=player_key).values_list(
+            "id", flat=True)[:1])
+    if not player_ids:
+        return HttpResponseForbidden("Invalid player key")
+    player_id = player_ids[0]
+    channel = channel_name(session_id)
+    broker = get_broker()
+    try:
+        since = request.GET.get("since",
+                request.META.get("HTTP_LAST_EVENT_ID"))
+        since = broker.last(channel) if since is None else int(since)
+        timeout = min(float(request.GET.get("timeout", TIMEOUT)), TIMEOUT)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid since or timeout")
+    if "text/event-stream" in request.META.get("HTTP_ACCEPT", ""):
+        response = HttpResponse(
+                _event_stream(broker, channel, since, player_id),
+                content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        return response
+    messages = broker.listen(channel, since, timeout)
+    if messages is None:
+        data = {"reload": True, "last": broker.last(channel)}
+    else:
+        data = {
+                "last": messages[-1][0] if messages else since,
+                "events": player_events(messages, player_id),
+                }
+    return _json_response(data)
+
+
+def _event_stream(broker, channel, since, player_id):
+    """
+    Yield server-sent events of a channel as a player may see them until
+    STREAM_TIME passes, the events of a commit share its id
+    """
+    end = time.time() + STREAM_TIME
+    while time.time() < end:
+        messages = broker.listen(channel, since, TIMEOUT)
+        if messages is None:
+            yield "event: reload\ndata: {}\n\n"
+            return
+        if not messages:
+            yield ": keepalive\n\n"
+            continue
+        for event in player_events(messages, player_id):
+            seq = event.pop("seq")
+            yield "id: %d\ndata: %s\n\n" % (seq, json.dumps(event))
+        since = messages[-1][0]
+
+
+def session_state(request, session_id):
+    """
+    Send a player what changed in a session since a revision, see
+    controller.delta. Responses carry an ETag of the session revision
+    and a request holding the current one gets a 304.
+
+    GET parameters:
+        player_key: key of a Player of the session (or X-Player-Key header)
+        revision: last revision the player has seen (default everything)
+    """
+    player_key = request.GET.get(
+            "player_key", request.META.get("HTTP_X_PLAYER_KEY"))
+    try:
+        player = Player.objects.get(
+                session=int(session_id), player_key=player_key)
+    except Player.DoesNotExist:
+        return HttpResponseForbidden("Invalid player key")
+    try:
+        since = int(request.GET.get("revision", 0))
+    except ValueError:
+        return _json_response({"error": "Invalid revision"}, status=400)
+    session = Session.objects.get(id=player.session_id)
+    # The revision only moves when an event is logged, so a matching tag
+    # is answered before the delta is read
+    etag = "session-%d-%d-%d" % (session.id, player.id, revision(session))
+    response = _not_modified(request, etag)
+    if response is None:
+        response = _json_response(changes_since(session, player, since))
+        response["ETag"] = quote_etag(etag)
+    return response
+
+
+@csrf_exempt
+def session_actions(request, session_id):
+    """
+    Apply a batch of game actions for one player, see controller.actions
+
+    The POST body is a JSON object:
+        {"player_key": "...", "actions": [{"action": "draw", ...}, ...]}
+    The player key may also be sent as the X-Player-Key header. The whole
+    batch is applied in one transaction and answered with the state delta
+    of what it touched, or a 400 with an error if any action failed.
+
+    Every request loads the engine afresh and drops it once the batch is
+    written, so it sees the seats and decks as they are now. A batch that
+    lost against a concurrent write gets a 409 and can be sent again.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        return _json_response({"error": "Invalid JSON"}, status=400)
+    if not isinstance(body, dict):
+        return _json_response({"error": "Invalid JSON"}, status=400)
+    player_key = body.get(
+            "player_key", request.META.get("HTTP_X_PLAYER_KEY"))
+    try:
+        player = Player.objects.get(
+                session=int(session_id), player_key=player_key)
+    except Player.DoesNotExist:
+        return HttpResponseForbidden("Invalid player key")
+    engine = GameEngine(Session.objects.get(id=player.session_id))
+    try:
+        delta = apply_actions(engine, player, body.get("actions"))
+    except ActionError, error:
+        return _json_response({"error": str(error)}, status=400)
+    except (DeckConflict, SeatConflict), error:
+        return _json_response({"error": str(error)}, status=409)
+    return _json_response(delta)
+
+
+def _internal(request):
+    """
+    @return: True for staff and for scrapers listed in INTERNAL_IPS
+    """
+    return request.user.is_staff or request.META.get("REMOTE_ADDR") in \
+            getattr(settings, "INTERNAL_IPS", ())
+
+
+def cache_stats_view(request):
+    """
+    Cache hit, miss and invalidation counters per model in the Prometheus
+    text format, for staff and for scrapers listed in INTERNAL_IPS
+    """
+    if not _internal(request):
+        return HttpResponseForbidden()
+    lines = []
+    counters = cache_stats.snapshot()
+    for kind in cache_stats.KINDS:
+        lines.append("# TYPE game_cache_%s counter" % kind)
+        for name in sorted(counters):
+            lines.append('game_cache_%s{model="%s"} %d' % (
+                    kind, name, counters[name][kind]))
+    return HttpResponse("\n".join(lines) + "\n",
+            content_type="text/plain; version=0.0.4")
+
+
+def method_stats_view(request):
+    """
+    Per call query count, database time and wall time histograms of the
+    instrumented model methods in the Prometheus text format, see
+    game.instrument, with the same access rules as cache_stats_view
+    """
+    if not _internal(request):
+        return HttpResponseForbidden()
+    lines = []
+    methods = method_stats.snapshot()
+    for histogram, bounds in method_stats.HISTOGRAMS:
+        metric = "game_method_%s" % histogram
+        lines.append("# TYPE %s histogram" % metric)
+        for name in sorted(methods):
+            values = methods[name][histogram]
+            total = 0
+            for bound, count in zip(bounds + ("+Inf",), values["buckets"]):
+                total = total + count
+                lines.append('%s_bucket{method="%s",le="%s"} %d' % (
+                        metric, name, bound, total))
+            lines.append('%s_sum{method="%s"} %s' % (
+                    metric, name, values["sum"]))
+            lines.append('%s_count{method="%s"} %d' % (
+                    metric, name, methods[name]["calls"]))
+    return HttpResponse("\n".join(lines) + "\n",
+            content_type="text/plain; version=0.0.4")
@@ -11,6 +11,12 @@ urlpatterns = patterns('',
     url(r'', include('social_auth.urls')),
     url(r'^$', game.views.HomeView.as_view()),
     url(r'^games/$', game.views.GameList.as_view()),
+    url(r'^games/(?P<game_ref>\w+)/lobby/$', game.views.lobby_view),
+    url(r'^games/(?P<session_id>\d+)/events/$', game.views.session_events),
+    url(r'^games/(?P<session_id>\d+)/actions/$', game.views.session_actions),
+    url(r'^games/(?P<session_id>\d+)/state/$', game.views.session_state),
+    url(r'^stats/cache/$', game.views.cache_stats_view),
+    url(r'^stats/methods/$', game.views.method_stats_view),
     url(r'^logged/$', game.views.logged_view),
     url(r'^logout/$', game.views.logout_view),
     url(r'^login-error/$', game.views.login_error_view),